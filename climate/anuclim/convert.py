@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 import os
 import os.path
-import zipfile
-import glob
 import json
-import tempfile
 import shutil
 import sys
-import re
+
+from data_conversion.governor import estimate_layer_memory
+from data_conversion.packaging import DatasetPackager
+from data_conversion.pipeline import run_jobs, translate_layer
+from data_conversion.utils import vsi_path
 
 CURRENT_CITATION = u'"Hutchinson M, Kesteven J, Xu T (2014) Monthly climate data: ANUClimate 1.0, 0.01 degree, Australian Coverage, 1976-2005. Australian National University, Canberra, Australia. Made available by the Ecosystem Modelling and Scaling Infrastructure (eMAST, http://www.emast.org.au) of the Terrestrial Ecosystem Research Network (TERN, http://www.tern.org.au).'
 CURRENT_TITLE = u'ANUClim (Australia), Current Climate {month} (1976-2005) , 30arcsec (~1km)'
@@ -79,50 +80,31 @@ LAYER_MAP = {
 MONTH_LIST = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
 SOURCE_DATASETS = [('tmax', 'tif'), ('tmin', 'tif'), ('precSUM', 'tif'), ('vapp', 'asc.gz'), ('evap', 'asc.gz')]
 
-def ungz(filename):
-    """gunzip given filename.
-    """
-    ret = os.system('gunzip {0}'.format(filename))
-    if ret != 0:
-        raise Exception("can't gunzip {0} ({1})".format(filename, ret))
-
-
-def unpack(zipname, path):
-    """unpack zipfile to path
-    """
-    zipf = zipfile.ZipFile(zipname, 'r')
-    zipf.extractall(path)
-
-def gdal_translate(src, dest):
-    """Use gdal_translate to copy file from src to dest"""
-    ret = os.system('gdal_translate -of GTiff {0} {1}'.format(src, dest))
-
-    if ret != 0:
-        raise Exception("can't gdal_translate {0} ({1})".format(src, ret))
-
 def convert(srcdir, ziproot, month):
-    """copy tmax, tmin and prep files and convert if necessary to zip preparation dir.
+    """collect jobs to copy tmax, tmin and prep files and convert if necessary
+    to zip preparation dir.
     """
+    jobs = []
     for layer, ext in SOURCE_DATASETS:
-        if os.name == 'nt':
-            srcfile = "/".join([srcdir, layer, '{0}_{1:02d}.{2}'.format(layer, month, ext)])
-        else:
-            srcfile = os.path.join(srcdir, layer, '{0}_{1:02d}.{2}'.format(layer, month, ext))
-
-        if ext == 'asc.gz':
-            ungz(srcfile)
-            srcfile = srcfile[:-len('.gz')]
+        # read layer straight from source zip (and .gz within it)
+        srczip = os.path.join(srcdir, layer + '.zip')
+        srcfile = vsi_path(srczip, '{0}_{1:02d}.{2}'.format(layer, month, ext))
 
         # convert to tiff file
         destfile = '{0}_{1:02d}.tif'.format(layer, month)
-        gdal_translate(srcfile, os.path.join(ziproot, 'data', destfile))
+        jobs.append((
+            estimate_layer_memory(srcfile), translate_layer,
+            (srcfile, os.path.join(ziproot, 'data', destfile), ['-of', 'GTiff'])
+        ))
+    return jobs
 
 
-def gen_metadatajson(template, dest, month):
+def gen_metadatajson(template, dest, month, layers):
     """read metadata template and populate rest of fields
     and write to dest + '/bccvl/metadata.json'
+
+    layers ... paths of converted layers (already moved into the zip file)
     """
-    base = os.path.basename(dest)
     # parse info from filename
     # check for future climate dataset:
     md = json.load(open(template, 'r'))
@@ -142,9 +124,9 @@ def gen_metadatajson(template, dest, month):
     }
 
     # Update layer info
-    for filename in glob.glob(os.path.join(dest, '*', '*.tif')):
-        filename = filename[len(os.path.dirname(dest)):].lstrip('/')
-	md['files'][filename] = {
+    for filename in layers:
+        filename = os.path.relpath(filename, os.path.dirname(dest))
+        md['files'][filename] = {
             'layer': LAYER_MAP[os.path.basename(filename)]
         }
 
@@ -153,25 +135,6 @@ def gen_metadatajson(template, dest, month):
     mdfile.close()
 
 
-def unzip_dataset(dsfile, tmpdir=None):
-    """unzip source dataset and return unzip location
-    """
-    if tmpdir is None:
-        tmpdir = tempfile.mkdtemp()
-    else:
-        if os.path.exists(tmpdir):
-            shutil.rmtree(tmpdir)
-        os.makedirs(tmpdir)
-
-    try:
-        print "unpack dataset %s" %dsfile
-        unpack(dsfile, tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        raise
-    return tmpdir
-
-
 def create_target_dir(destdir, resolution, month):
     """create zip folder structure in tmp location.
     return root folder
@@ -184,49 +147,40 @@ def create_target_dir(destdir, resolution, month):
     return root
 
 
-def zipbccvldataset(ziproot, dest):
-    try:
-        pwd = os.getcwd()
-        workdir = os.path.dirname(ziproot)
-        zipdir = os.path.basename(ziproot)
-        os.chdir(workdir)
-        shutil.make_archive(zipdir, "zip", base_dir=zipdir)
-        shutil.rmtree(zipdir)
-    except:
-        raise Exception("can't zip {0}".format(ziproot))
-    finally:
-        os.chdir(pwd)
-
-
 def main(argv):
-    ziproot = None
-    srctmpdir = {}
+    packager = DatasetPackager()
+    ziproots = []
     try:
         if len(argv) != 3:
-            print "Usage: {0} <srcdir> <destdir>".format(argv[0])
+            print("Usage: {0} <srcdir> <destdir>".format(argv[0]))
             sys.exit(1)
         srcdir = argv[1]
         dest = argv[2]
 
-        # source contains 5 zipped datasets: tmax, tmin, precSUM, vapp, eval. unzip them.
-        source_dirs = []
-        for filename, _ in SOURCE_DATASETS:
-            srcfile = os.path.join(srcdir, filename + '.zip')
-            tempdir = unzip_dataset(srcfile, os.path.join(srcdir, filename))
-            source_dirs.append(tempdir)
-
-        # package monthly datasets for each month
+        # source contains 5 zipped datasets: tmax, tmin, precSUM, vapp, eval.
+        # layers are read from within the zip files.
+        # convert layers of all months in parallel
+        jobs = []
         for month in range(0, 12):
             ziproot = create_target_dir(dest, '1km', month)
-            convert(srcdir, ziproot, month+1)
-            gen_metadatajson(JSON_TEMPLATE, ziproot, MONTH_LIST[month])
-            zipbccvldataset(ziproot, dest)
+            ziproots.append(ziproot)
+            packager.open(ziproot, dest)
+            jobs.extend(convert(srcdir, ziproot, month+1))
+        # each layer goes into the zip file of its month as soon as it is
+        # done
+        run_jobs(jobs, on_done=packager.add)
+
+        # finish monthly datasets for each month
+        for month, ziproot in enumerate(ziproots):
+            gen_metadatajson(JSON_TEMPLATE, ziproot, MONTH_LIST[month],
+                             packager.layers(ziproot))
+            packager.close(ziproot)
     finally:
+        packager.abort()
         # cleanup temp location
-        if os.path.exists(ziproot):
-            shutil.rmtree(ziproot)
-        for tempdir in source_dirs:
-            shutil.rmtree(tempdir)
+        for ziproot in ziproots:
+            if os.path.exists(ziproot):
+                shutil.rmtree(ziproot)
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,18 +1,19 @@
 #!/usr/bin/env python
 import os
 import os.path
-import zipfile
-import glob
 import json
-import tempfile
 import shutil
 import sys
 import re
 
+from data_conversion.governor import estimate_layer_memory
+from data_conversion.packaging import DatasetPackager
+from data_conversion.pipeline import run_jobs, translate_layer
+from data_conversion.utils import vsi_path, zip_members
+
 CURRENT_TEMPLATE = u'Current climate layers for Australia, 9arcsec (~250m)'
 FUTURE_TEMPLATE = u'Climate Projection {0} based on {1}, 9arcsec (~250m) - {2}'
 JSON_TEMPLATE = 'bccvl_australia_250m.template.json'
-TMP_DIR = '/mnt/playground'
 
 LAYER_MAP = {
     'bioclim_01.tif': 'B01',
@@ -36,41 +37,27 @@ LAYER_MAP = {
     'bioclim_19.tif': 'B19',
 }
 
-def ungz(filename):
-    """gunzip given filename.
-    """
-    ret = os.system('gunzip {0}'.format(filename))
-    if ret != 0:
-        raise Exception("can't gunzip {0} ({1})".format(filename, ret))
-
-
-def unpack(zipname, path):
-    """unpack zipfile to path
-    """
-    zipf = zipfile.ZipFile(zipname, 'r')
-    zipf.extractall(path)
-
-
-def convert(folder, dest):
-    """convert .asc.gz files in folder to .tif in dest
+def convert(srcfile, dest):
+    """collect jobs to convert .asc.gz files in zip file srcfile to .tif in
+    dest
     """
-    for srcfile in glob.glob(os.path.join(folder, '*/*.asc.gz')):
-        ungz(srcfile)
-        srcfile = srcfile[:-len('.gz')]
-        basename = os.path.basename(srcfile)
+    jobs = []
+    for member in zip_members(srcfile, '*/*.asc.gz'):
+        # read gzipped grid straight from zip file
+        srcurl = vsi_path(srcfile, member)
+        basename = os.path.basename(member)
         destfile = os.path.join(dest, 'data',
-                                basename[:-len('.asc')]) + '.tif'
-        ret = os.system('gdal_translate -of GTiff -co "COMPRESS=LZW" -co "TILED=YES" {0} {1}'.format(srcfile,
-        #ret = os.system('gdal_translate -of GTiff {0} {1}'.format(srcfile,
-                                                                  destfile))
-        if ret != 0:
-            raise Exception("can't gdal_translate {0} ({1})".format(srcfile,
-                                                                    ret))
+                                basename[:-len('.asc.gz')]) + '.tif'
+        jobs.append((estimate_layer_memory(srcurl), translate_layer,
+                     (srcurl, destfile)))
+    return jobs
 
 
-def gen_metadatajson(template, dest):
+def gen_metadatajson(template, dest, layers):
     """read metadata template and populate rest of fields
     and write to dest + '/bccvl/metadata.json'
+
+    layers ... paths of converted layers (already moved into the zip file)
     """
     base = os.path.basename(dest)
     # parse info from filename
@@ -78,10 +65,10 @@ def gen_metadatajson(template, dest):
     md = json.load(open(template, 'r'))
     m = re.match(r'(\w*)_([\w-]*)_(\d*)', base)
     if m:
-        md[u'temporal_coverage'][u'start'] = unicode(m.group(3))
-        md[u'temporal_coverage'][u'end'] = unicode(m.group(3))
-        md[u'emsc'] = unicode(m.group(1))
-        md[u'gcm'] = unicode(m.group(2))
+        md[u'temporal_coverage'][u'start'] = str(m.group(3))
+        md[u'temporal_coverage'][u'end'] = str(m.group(3))
+        md[u'emsc'] = str(m.group(1))
+        md[u'gcm'] = str(m.group(2))
         md[u'title'] = FUTURE_TEMPLATE.format(
             md[u'emsc'].upper(),
             md[u'gcm'].upper(),
@@ -92,9 +79,9 @@ def gen_metadatajson(template, dest):
         md[u'temporal_coverage'][u'end'] = u'2005'
         md[u'title'] = CURRENT_TEMPLATE
     md['files'] = {}
-    for filename in glob.glob(os.path.join(dest, '*', '*.tif')):
-        filename = filename[len(os.path.dirname(dest)):].lstrip('/')
-	md['files'][filename] = {
+    for filename in layers:
+        filename = os.path.relpath(filename, os.path.dirname(dest))
+        md['files'][filename] = {
             'layer': LAYER_MAP[os.path.basename(filename)]
         }
     if 'current' in dest.lower():
@@ -106,18 +93,6 @@ def gen_metadatajson(template, dest):
     mdfile.close()
 
 
-def unzip_dataset(dsfile):
-    """unzip source dataset and return unzip location
-    """
-    tmpdir = tempfile.mkdtemp(dir=TMP_DIR)
-    try:
-        unpack(dsfile, tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        raise
-    return tmpdir
-
-
 def create_target_dir(destdir, srcfile):
     """create zip folder structure in tmp location.
     return root folder
@@ -130,40 +105,30 @@ def create_target_dir(destdir, srcfile):
     return root
 
 
-def zipbccvldataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system('cd {0}; zip -r {1} {2}'.format(workdir,
-                                                    zipname,
-                                                    zipdir))
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-
-
 def main(argv):
+    packager = DatasetPackager()
     ziproot = None
-    srctmpdir = None
     try:
         if len(argv) != 3:
-            print "Usage: {0} <srczip> <destdir>".format(argv[0])
+            print("Usage: {0} <srczip> <destdir>".format(argv[0]))
             sys.exit(1)
         srcfile = argv[1]
         dest = argv[2]
         # TODO: check src exists and is zip?
         # TODO: check dest exists
-        srctmpdir = unzip_dataset(srcfile)
-        # unpack contains one destination datasets
+        # zip file contains one destination datasets
         ziproot = create_target_dir(dest, srcfile)
-        convert(srctmpdir, ziproot)
-        gen_metadatajson(JSON_TEMPLATE, ziproot)
-        zipbccvldataset(ziproot, dest)
+        packager.open(ziproot, dest)
+        # convert all layers in parallel, each one goes into the zip file
+        # as soon as it is done
+        run_jobs(convert(srcfile, ziproot), on_done=packager.add)
+        gen_metadatajson(JSON_TEMPLATE, ziproot, packager.layers(ziproot))
+        packager.close(ziproot)
     finally:
+        packager.abort()
         # cleanup temp location
-        if ziproot:
+        if ziproot and os.path.exists(ziproot):
             shutil.rmtree(ziproot)
-        if srctmpdir:
-            shutil.rmtree(srctmpdir)
 
 if __name__ == "__main__":
     main(sys.argv)
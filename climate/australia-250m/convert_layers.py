@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 import os
 import os.path
-import zipfile
-import glob
-import tempfile
-import shutil
 import sys
-import re
-import time
+
+from data_conversion.governor import estimate_layer_memory
+from data_conversion.pipeline import run_jobs, translate_layer
+from data_conversion.staging import Stager
+from data_conversion.utils import vsi_path, zip_members
 
 LAYER_MD = {
     'bioclim_01.tif': ('B01', 'annual mean temperature', 'degree_Celsius', None),
@@ -32,34 +31,15 @@ LAYER_MD = {
 }
 
 
-def unpack(zipname, path):
-    """unpack zipfile to path
-    """
-    tries = 0
-    while True:
-        try:
-            tries += 1
-            zipf = zipfile.ZipFile(zipname, 'r')
-            zipf.extractall(path)
-            print "File {0} is online".format(zipname)
-            break
-        except Exception as e:
-            if tries > 10:
-                print "Fail to make file {0} online!!".format(zipname)
-                raise Exception("Error: File {0} is not online".format(zipname))
-            print "Waiting for file {0} to be online ...".format(zipname)
-            time.sleep(60)
-
-
 def get_emsc_str(emsc):
     if emsc == 'RCP3PD':
-	   return 'RCP 2.6'
+        return 'RCP 2.6'
     if emsc == 'RCP6':
-	   return 'RCP 6.0'
+        return 'RCP 6.0'
     if emsc == 'RCP45':
-	   return 'RCP 4.5'
+        return 'RCP 4.5'
     if emsc == 'RCP85':
-	   return 'RCP 8.5'
+        return 'RCP 8.5'
     return emsc
 
 
@@ -77,7 +57,7 @@ def metadata_options(filename, destdir):
     if not md:
         raise Exception("layer {0} is missing metadata".format(filename))
 
-    options = '-of GTiff -co "COMPRESS=LZW" -co "TILED=YES"'
+    options = ['-of', 'GTiff', '-co', 'COMPRESS=LZW', '-co', 'TILED=YES']
     if os.path.basename(destdir).startswith("current_"):
         _, year =  os.path.basename(destdir).split('_')
         emsc = gcms = None
@@ -86,52 +66,38 @@ def metadata_options(filename, destdir):
 
     if emsc:
         emsc = emsc.replace('RCP', 'RCP ')
-        options += ' -mo "emission_scenario={}"'.format(emsc)
+        options += ['-mo', 'emission_scenario={}'.format(emsc)]
     if gcms:
-        options += ' -mo "general_circulation_models={}"'.format(gcms.upper())
+        options += ['-mo', 'general_circulation_models={}'.format(gcms.upper())]
     if year:
-        options += ' -mo "year={}"'.format(year)
+        options += ['-mo', 'year={}'.format(year)]
     if md[0]:
-        options += ' -mo "standard_name={}"'.format(md[0])
+        options += ['-mo', 'standard_name={}'.format(md[0])]
     if md[1]:
-        options += ' -mo "long_name={}"'.format(md[1])
+        options += ['-mo', 'long_name={}'.format(md[1])]
     if md[2]:
-        options += ' -mo "unit={}"'.format(md[2])
+        options += ['-mo', 'unit={}'.format(md[2])]
     return options
 
-def convert(folder, dest):
-    """convert .asc.gz files in folder to .tif in dest
+def convert(srcfile, dest):
+    """collect jobs to convert .asc files in zip file srcfile to .tif in dest
     """
-
-    for srcfile in glob.glob(os.path.join(folder, '*/*.asc')):
-        filename = os.path.basename(srcfile)[:-len('.asc')] + '.tif'
-        options = metadata_options(filename, dest)     
+    jobs = []
+    for member in zip_members(srcfile, '*/*.asc'):
+        # read grid straight from zip file
+        srcurl = vsi_path(srcfile, member)
+        filename = os.path.basename(member)[:-len('.asc')] + '.tif'
+        options = metadata_options(filename, dest)
         # dest filename = dirname_variablename.tif
         dfilename = os.path.basename(dest) + '_' + LAYER_MD.get(filename)[0] + '.tif'
-        destfile = os.path.join(dest, dfilename) 
-        ret = os.system('gdal_translate {2} {0} {1}'.format(srcfile, 
-                                                            destfile, 
-                                                            options))
-        if ret != 0:
-            raise Exception("can't gdal_translate {0} ({1})".format(srcfile,
-                                                                    ret))
+        destfile = os.path.join(dest, dfilename)
         # Add factor and offset metedata to the band data
         scale = LAYER_MD.get(filename)[3]
         if scale is not None:
-            ret = os.system('gdal_edit.py -scale {0} -offset {1} {2}'.format(scale, 0, destfile))
-            if ret != 0:
-                raise Exception("can't gdal_edit.py {0} ({1})".format(destfile, scale))
-
-def unzip_dataset(dsfile):
-    """unzip source dataset and return unzip location
-    """
-    tmpdir = tempfile.mkdtemp()
-    try:
-        unpack(dsfile, tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        raise
-    return tmpdir
+            options += ['-a_scale', str(scale), '-a_offset', '0']
+        jobs.append((estimate_layer_memory(srcurl), translate_layer,
+                     (srcurl, destfile, options)))
+    return jobs
 
 
 def create_target_dir(destdir, srcfile):
@@ -149,25 +115,24 @@ def create_target_dir(destdir, srcfile):
 
 
 def main(argv):
-    ziproot = None
-    srctmpdir = None
-
-    try:
-        if len(argv) != 3:
-            print "Usage: {0} <srczip> <destdir>".format(argv[0])
-            sys.exit(1)
-        srcfile = argv[1]
-        dest = argv[2]
-        # TODO: check src exists and is zip?
-        # TODO: check dest exists
-        srctmpdir = unzip_dataset(srcfile)
-        # unpack contains one destination datasets
-        ziproot = create_target_dir(dest, srcfile)
-        convert(srctmpdir, ziproot)
-    finally:
-        # cleanup temp location
-        if srctmpdir:
-            shutil.rmtree(srctmpdir)
+    if len(argv) != 3:
+        print("Usage: {0} <srczip> <destdir>".format(argv[0]))
+        sys.exit(1)
+    srcfile = argv[1]
+    dest = argv[2]
+    # TODO: check src exists and is zip?
+    # TODO: check dest exists
+    # recall srcfile from tape (with retries) before reading it
+    with Stager([srcfile]) as stager:
+        for srcfile, error in stager:
+            if error is not None:
+                print("Fail to make file {0} online!!".format(srcfile))
+                raise Exception("Error: File {0} is not online".format(srcfile))
+            print("File {0} is online".format(srcfile))
+    # zip file contains one destination datasets
+    ziproot = create_target_dir(dest, srcfile)
+    # convert all layers in parallel
+    run_jobs(convert(srcfile, ziproot))
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -3,16 +3,26 @@ from concurrent import futures
 import glob
 import os
 import os.path
-import tempfile
 import zipfile
 import argparse
-import shutil
 
 from osgeo import gdal
 import tqdm
 
-from data_conversion.vocabs import VAR_DEFS, PREDICTORS
-from data_conversion.utils import ensure_directory, move_files, retry_run_cmd
+from data_conversion.vocabs import VAR_DEFS, compression_options
+from data_conversion.calc import copy_raster
+from data_conversion.narrow import narrow_raster
+from data_conversion.overviews import build_overviews
+from data_conversion.costs import plan_jobs
+from data_conversion.governor import (
+    ResourceGovernor, estimate_layer_disk, estimate_layer_memory
+)
+from data_conversion.plan import plan_archive, print_plan
+from data_conversion.scratch import scratch_path, raster_size, remove_scratch, translate
+from data_conversion.publish import (
+    atomic_output, recover, remove_empty_dirs, remove_stale
+)
+from data_conversion.utils import ensure_directory
 
 # map source file id's to our idea of RCP id's
 EMSC_MAP = {
@@ -40,30 +50,25 @@ def parse_zip_filename(srcfile):
     return EMSC_MAP.get(emsc, emsc), gcm, year
 
 
-def gdal_options(srcfile):
+def layer_metadata(srcfile):
     """
-    options to add metadata for the tiff file
+    metadata to add to the tiff file
     """
     emsc, gcm, year = parse_zip_filename(srcfile)
 
-    options = ['-of', 'GTiff', '-co', 'TILED=YES']
-    options += ['-co', 'COMPRESS=DEFLATE', '-norat']
+    metadata = {}
     if emsc == 'current':
         years = [int(x) for x in year.split('-')]
-        options += ['-mo', 'year_range={}-{}'.format(years[0], years[1])]
-        options += [
-            '-mo', 'year={}'.format(
-                int((years[1] - years[0] + 1 / 2) + years[0])
-            )
-        ]
+        metadata['year_range'] = '{}-{}'.format(years[0], years[1])
+        metadata['year'] = int((years[1] - years[0] + 1 / 2) + years[0])
     else:
         year = int(year)
         years = [year - 4, year + 5]
-        options += ['-mo', 'emission_scenario={}'.format(emsc)]
-        options += ['-mo', 'general_circulation_models={}'.format(gcm.upper())]
-        options += ['-mo', 'year_range={}-{}'.format(years[0], years[1])]
-        options += ['-mo', 'year={}'.format(year)]
-    return options
+        metadata['emission_scenario'] = emsc
+        metadata['general_circulation_models'] = gcm.upper()
+        metadata['year_range'] = '{}-{}'.format(years[0], years[1])
+        metadata['year'] = year
+    return metadata
 
 
 def get_layer_id(filename):
@@ -71,55 +76,77 @@ def get_layer_id(filename):
     return layerid
 
 
-def run_gdal(cmd, infile, outfile, layerid):
-    _, tfname = tempfile.mkstemp(suffix='.tif')
+def run_gdal(metadata, infile, outfile, layerid, threads=1):
+    # keep intermediate files in memory if they are small enough
+    tfname = scratch_path(raster_size(infile))
+    scratch = [tfname]
     try:
-        retry_run_cmd(cmd + [infile, tfname])
+        # band stats are collected while the layer is copied
+        rstats = copy_raster(infile, tfname, metadata, norat=True,
+                             num_threads=threads)
+        # store layer in narrowest data type that holds all values
+        # exactly, before overviews are built from it
+        narrowed = scratch_path(raster_size(infile))
+        scratch.append(narrowed)
+        if narrow_raster(tfname, narrowed, rstats) is not None:
+            tfname = narrowed
         # add band metadata
         # this is our temporary geo tiff, we should be able to open that
         # without problems
         ds = gdal.Open(tfname, gdal.GA_Update)
         band = ds.GetRasterBand(1)
-        # ensure band stats
-        band.ComputeStatistics(False)
         for key, value in VAR_DEFS[layerid].items():
-            band.SetMetadataItem(key, value)
+            band.SetMetadataItem(key, str(value))
         # just for completeness
         band.SetUnitType(VAR_DEFS[layerid]['units'])
         # band.SetScale(1.0)
         # band.SetOffset(0.0)
         ds.FlushCache()
+        # build overviews now, so that they end up in front of the full
+        # resolution data with COPY_SRC_OVERVIEWS
+        build_overviews(ds, VAR_DEFS[layerid].get('measure_type'))
         # build command
         cmd = [
             'gdal_translate',
             '-of', 'GTiff',
             '-co', 'TILED=yes',
             '-co', 'COPY_SRC_OVERVIEWS=YES',
-            '-co', 'COMPRESS=DEFLATE',
-            '-co', 'PREDICTOR={}'.format(PREDICTORS[band.DataType]),
+            # compress blocks in parallel
+            '-co', 'NUM_THREADS={}'.format(threads),
         ]
+        # tuned compression options, lossy within documented precision of
+        # variable if known
+        for option in compression_options(
+                band.DataType, VAR_DEFS[layerid].get('max_error'),
+                band.GetScale(), collection='australia-5km'):
+            cmd.extend(['-co', option])
         # check rs
         if not ds.GetProjection():
             cmd.extend(['-a_srs', 'EPSG:4326'])
         # close dataset
         del band
         del ds
-        # gdal_translate once more to cloud optimise geotiff
-        cmd.extend([tfname, outfile])
-        retry_run_cmd(cmd)
+        # gdal_translate once more to cloud optimise geotiff, write it
+        # next to outfile and rename it when complete
+        with atomic_output(outfile) as partial:
+            translate(cmd, tfname, partial)
     except Exception as e:
         print('Error:', e)
         raise e
     finally:
-        os.remove(tfname)
+        for path in scratch:
+            remove_scratch(path)
 
 
-def convert(srcfile, destdir):
-    """convert .asc.gz files in folder to .tif in dest
-    """
+def collect_layers(srcfile, destdir):
+    """list .asc files in srcfile to convert to .tif in dest
 
-    pool = futures.ProcessPoolExecutor()
-    results = []
+    Only reads the zip directory.
+
+    returns list of (member, args) with member the name of the layer in
+    the zip file and args the arguments for run_gdal
+    """
+    layers = []
     with zipfile.ZipFile(srcfile) as srczip:
         for zipinfo in tqdm.tqdm(srczip.filelist, desc="build jobs"):
             if zipinfo.is_dir():
@@ -137,25 +164,43 @@ def convert(srcfile, destdir):
                 '.tif'
             )
             srcurl = '/vsizip/' + srcfile + '/' + zipinfo.filename
-            gdaloptions = gdal_options(srcfile)
+            metadata = layer_metadata(srcfile)
             # output file name
             destpath = os.path.join(destdir, destfilename)
-            # run gdal translate
-            cmd = ['gdal_translate']
-            cmd.extend(gdaloptions)
-            results.append(
-                pool.submit(run_gdal, cmd, srcurl, destpath, layerid)
-            )
+            layers.append((zipinfo.filename, (metadata, srcurl, destpath, layerid)))
+    return layers
+
+
+def convert(srcfile, destdir):
+    """convert .asc.gz files in folder to .tif in dest
+    """
+    governor = ResourceGovernor()
+    jobs = [
+        (estimate_layer_memory(args[1]), estimate_layer_disk(args[1], args[2]),
+         args)
+        for _, args in collect_layers(srcfile, destdir)
+    ]
+
+    # start longest jobs first (see data_conversion.costs), as many in
+    # parallel as cores, memory and disk space allow
+    planned = plan_jobs('australia-5km', [
+        (memory, args[1], run_gdal, args, disk) for memory, disk, args in jobs
+    ])
+    pool = governor.executor([job[0] for job in planned])
+    results = governor.submit_all(pool, planned, threads=governor.threads)
 
     for result in tqdm.tqdm(futures.as_completed(results),
                             desc=os.path.basename(srcfile),
                             total=len(results)):
         if result.exception():
             print("Job failed")
-            raise result.excption()
+            raise result.exception()
 
+    # all layers of this collection
+    return [args[2] for _, _, args in jobs]
 
-def create_target_dir(destdir, srcfile):
+
+def create_target_dir(destdir, srcfile, create=True):
     """create zip folder structure in tmp location.
     return root folder
     """
@@ -165,6 +210,8 @@ def create_target_dir(destdir, srcfile):
     else:
         dirname = '{0}_{1}_{2}'.format(emsc, gcm, year).replace(' ', '')
     root = os.path.join(destdir, dirname)
+    if not create:
+        return root
     os.makedirs(root, exist_ok=True)
     return root
 
@@ -181,9 +228,13 @@ def parse_args():
     )
     parser.add_argument(
         '--workdir', action='store',
-        default='/mnt/workdir/australia-5km_work',
-        help=('folder to store working files before moving to final '
-              'destination')
+        help=('folder for intermediate files too large to keep in memory '
+              '(defaults to $CONVERSION_SCRATCH or the system temp dir)')
+    )
+    parser.add_argument(
+        '--plan', action='store_true',
+        help=('only list layers that would be converted with estimated '
+              'sizes and runtime')
     )
     return parser.parse_args()
 
@@ -196,20 +247,39 @@ def main():
     else:
         srcfiles = [srcfile]
 
-    workdir = ensure_directory(opts.workdir)
+    if opts.plan:
+        # dry run, reads only zip directories
+        dest = os.path.abspath(opts.destdir)
+        rows = []
+        for srcfile in srcfiles:
+            target_dir = create_target_dir(dest, srcfile, create=False)
+            rows.extend(plan_archive('australia-5km', srcfile, [
+                (member, args[2])
+                for member, args in collect_layers(srcfile, target_dir)
+            ]))
+        print_plan(rows)
+        return
+
+    if opts.workdir:
+        # picked up by scratch_path (in worker processes too)
+        os.environ['CONVERSION_SCRATCH'] = ensure_directory(opts.workdir)
     dest = ensure_directory(opts.destdir)
     # unpack contains one destination datasets
     for srcfile in tqdm.tqdm(srcfiles):
-        target_work_dir = create_target_dir(workdir, srcfile)
+        target_dir = create_target_dir(dest, srcfile)
+        # remove unfinished files of crashed runs (only in target_dir,
+        # other source files may be converted at the same time)
+        for path in recover(target_dir):
+            print('Removed partial file {}'.format(path))
         try:
-            # convert files into workdir
-            convert(srcfile, target_work_dir)
-            # move results to dest
-            target_dir = create_target_dir(dest, srcfile)
-            move_files(target_work_dir, target_dir)
+            # convert files straight into destination
+            layers = convert(srcfile, target_dir)
+            # remove layers which are not part of the collection anymore
+            for path in remove_stale(target_dir, layers):
+                print('Removed stale file {}'.format(path))
         finally:
-            # cleanup
-            shutil.rmtree(target_work_dir)
+            # don't leave empty dirs behind
+            remove_empty_dirs(target_dir, dest)
 
 
 if __name__ == "__main__":
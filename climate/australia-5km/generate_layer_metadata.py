@@ -11,8 +11,10 @@ import re
 import tqdm
 
 from data_conversion.coverage import (
+    changed_coverages,
     gen_tif_metadata,
     gen_tif_coverage,
+    has_approximate_statistics,
     get_coverage_extent,
     gen_coverage_uuid,
     gen_dataset_coverage,
@@ -152,6 +154,12 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--force', action='store_true',
                         help='Re generate data.json form tif files.')
+    parser.add_argument('--update', action='store_true',
+                        help=('Update data.json for new, changed and removed '
+                              'tif files only.'))
+    parser.add_argument('--approx-stats', action='store_true',
+                        help=('Estimate missing statistics from overviews or '
+                              'a sample of blocks instead of a full scan.'))
     parser.add_argument('srcdir')
     return parser.parse_args()
 
@@ -166,17 +174,26 @@ def main():
 
     datajson = os.path.join(opts.srcdir, 'data.json')
     print("Generate data.json")
-    if not os.path.exists(datajson) or opts.force:
-        print("Rebuild data.json")
-        # rebuild data.json
-        coverages = []
-        # generate all coverages inside source folder
+    if not os.path.exists(datajson) or opts.force or opts.update:
         tiffiles = sorted(glob.glob(os.path.join(opts.srcdir, '**/*.tif'),
                                     recursive=True))
+        if os.path.exists(datajson) and not opts.force:
+            print("Update data.json")
+            # only generate coverages of new and changed tif files
+            coverages, tiffiles = changed_coverages(
+                json.load(open(datajson)), tiffiles, opts.srcdir,
+                SWIFT_CONTAINER, os.path.getmtime(datajson)
+            )
+        else:
+            print("Rebuild data.json")
+            coverages = []
         for tiffile in tqdm.tqdm(tiffiles):
             try:
                 md = gen_tif_metadata(tiffile, opts.srcdir, SWIFT_CONTAINER)
-                coverage = gen_tif_coverage(tiffile, md['url'])
+                coverage = gen_tif_coverage(tiffile, md['url'],
+                                            approx_ok=opts.approx_stats)
+                if has_approximate_statistics(coverage):
+                    md['approximate'] = True
                 md['extent_wgs84'] = get_coverage_extent(coverage)
                 md['resolution'] = RESOLUTION
                 if md['genre'] == 'DataGenreCC':
@@ -188,6 +205,8 @@ def main():
                 print('Failed to generate metadata for:', tiffile, e)
                 raise
 
+        # same order as a rebuild
+        coverages.sort(key=lambda cov: cov['bccvl:metadata']['url'])
         print("Write data.json")
         with open(datajson, 'w') as mdfile:
             json.dump(coverages, mdfile, indent=2)
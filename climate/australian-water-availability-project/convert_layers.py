@@ -1,16 +1,18 @@
 #!/usr/bin/env python
 import os
 import os.path
-import zipfile
 import glob
-import tempfile
-import shutil
 import sys
-import re
-import time
 import argparse
 from datetime import datetime
 
+from data_conversion.plan import plan_archive, print_plan
+from data_conversion.publish import atomic_output
+from data_conversion.scratch import translate
+from data_conversion.staging import Stager
+from data_conversion.utils import cached_dataset, vsi_path, zip_members
+from data_conversion.vocabs import VAR_DEFS, compression_options
+
 LAYER_MD = {
     'mth_FWDis': ('mth_FWDis', 'monthly local discharge (tunoff+drainage) (average)', 'mm/d', None),
     'pcr_mth_FWDis': ('pcr_mth_FWDis', 'monthly local discharge (runoff+drainage) (percentile rank data)', '%', None),
@@ -53,25 +55,6 @@ LAYER_MD = {
 }
 
 
-def unpack(zipname, path):
-    """unpack zipfile to path
-    """
-    tries = 0
-    while True:
-        try:
-            tries += 1
-            zipf = zipfile.ZipFile(zipname, 'r')
-            zipf.extractall(path)
-            print "File {0} is online".format(zipname)
-            break
-        except Exception as e:
-            if tries > 10:
-                print "Fail to make file {0} online!!".format(zipname)
-                raise Exception("Error: File {0} is not online".format(zipname))
-            print "Waiting for file {0} to be online ...".format(zipname)
-            time.sleep(60)
-
-
 def get_md(filename):
     # Get the layer md
     nameparts = os.path.splitext(filename)[0].split('_')
@@ -84,62 +67,84 @@ def get_md(filename):
 
 def metadata_options(md, year):
     # options to add metadata for the tiff file
-    options = '-of GTiff -co "COMPRESS=LZW" -co "TILED=YES" -a_srs EPSG:4326'
+    options = ['-a_srs', 'EPSG:4326']
 
     if year:
-        options += ' -mo "year={}"'.format(year)
+        options.extend(['-mo', 'year={}'.format(year)])
     if md[0]:
-        options += ' -mo "standard_name={}"'.format(md[0])
+        options.extend(['-mo', 'standard_name={}'.format(md[0])])
     if md[1]:
-        options += ' -mo "long_name={}"'.format(md[1])
+        options.extend(['-mo', 'long_name={}'.format(md[1])])
     if md[2]:
-        options += ' -mo "unit={}"'.format(md[2])
+        options.extend(['-mo', 'unit={}'.format(md[2])])
     return options
 
-def convert(folder, dest, only_year=None):
-    """convert .flt files in folder to .tif in dest
+
+def run_gdal(md, year, infile, outfile, layerid):
+    cmd = [
+        'gdal_translate',
+        '-of', 'GTiff',
+        '-co', 'TILED=YES',
+    ] + metadata_options(md, year)
+    # Add factor and offset metedata to the band data
+    scale = md[3]
+    if scale is not None:
+        cmd.extend(['-a_scale', str(scale), '-a_offset', '0'])
+    ds = cached_dataset(infile)
+    if ds is None:
+        raise Exception("can't open {0}".format(infile))
+    # tuned compression options, lossy within documented precision of
+    # variable
+    for option in compression_options(
+            ds.GetRasterBand(1).DataType, VAR_DEFS[layerid].get('max_error'),
+            scale, collection='awap'):
+        cmd.extend(['-co', option])
+    # write it next to outfile and rename it when complete
+    with atomic_output(outfile) as partial:
+        translate(cmd, infile, partial)
+
+
+def collect_layers(zipname, dest, only_year=None):
+    """list annual .flt grids in zip file to convert to .tif in dest
+
+    Only reads the zip directory.
+
+    returns list of (member, args) with member the name of the grid in
+    the zip file and args the arguments for run_gdal
     """
     # only interested in annual data
     glob_filename = '*/*/*/*ann*.flt' 
     if only_year is not None:
         glob_filename = '*/*/*/*ann*{}*.flt'.format(only_year)
 
-    for srcfile in glob.glob(os.path.join(folder, glob_filename)):
-        filename = os.path.basename(srcfile)[:-len('.flt')] + '.tif'
+    layers = []
+    for member in zip_members(zipname, glob_filename):
+        # fnmatch's * matches '/' too, only take grids at the depth of
+        # the pattern
+        if member.count('/') != glob_filename.count('/'):
+            continue
+        # read grid (and .hdr next to it) straight from zip file
+        srcfile = vsi_path(zipname, member)
+        filename = os.path.basename(member)[:-len('.flt')] + '.tif'
         md, year = get_md(filename)
         if md is None:
             continue
-        options = metadata_options(md, year)   
         # dest filename = dirname_variablename.tif
         dfilename = os.path.basename(dest) + '_' + filename
         destfile = os.path.join(dest, dfilename) 
-        ret = os.system('gdal_translate {2} {0} {1}'.format(srcfile, 
-                                                            destfile, 
-                                                            options))
-        if ret != 0:
-            raise Exception("can't gdal_translate {0} ({1})".format(srcfile,
-                                                                    ret))
-        # Add factor and offset metedata to the band data
-        scale = md[3]
-        if scale is not None:
-            ret = os.system('gdal_edit.py -scale {0} -offset {1} {2}'.format(scale, 0, destfile))
-            if ret != 0:
-                raise Exception("can't gdal_edit.py {0} ({1})".format(destfile, scale))
-
-
-def unzip_dataset(dsfile):
-    """unzip source dataset and return unzip location
+        layers.append((member, (md, year, srcfile, destfile, md[0])))
+    return layers
+
+
+def convert(zipname, dest, only_year=None):
+    """convert .flt files in zip file to .tif in dest
     """
-    tmpdir = tempfile.mkdtemp()
-    try:
-        unpack(dsfile, tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        raise
-    return tmpdir
+    # file has been recalled by Stager
+    for _, args in collect_layers(zipname, dest, only_year):
+        run_gdal(*args)
 
 
-def create_target_dir(destdir, srcfile):
+def create_target_dir(destdir, srcfile, create=True):
     """create zip folder structure in tmp location.
     return root folder
     """
@@ -147,7 +152,7 @@ def create_target_dir(destdir, srcfile):
     filename = os.path.basename(srcfile)
     date = filename.split('.')[0].split('_')[1]
     root = os.path.join(destdir, 'awap_ann_{}'.format(date))
-    if not os.path.isdir(root):
+    if create and not os.path.isdir(root):
         os.mkdir(root)
     return root
 
@@ -159,35 +164,49 @@ def main(argv):
     parser.add_argument('destdir', type=str, help='output directory')
     parser.add_argument('--dstype', type=str, choices=LAYER_TYPES, help='layer type')
     parser.add_argument('--year', type=int, help='year')
+    parser.add_argument('--plan', action='store_true',
+                        help=('only list layers that would be converted with '
+                              'estimated sizes and runtime'))
     params = vars(parser.parse_args(argv[1:]))
-    import pdb; pdb.set_trace()
     srcdir = params.get('srcdir')
     destdir = params.get('destdir')
     year = params.get('year')
     dstypes = LAYER_TYPES if params.get('dstype') is None else [params.get('dstype')]
 
+    if params.get('plan'):
+        # dry run, reads only zip directories
+        rows = []
+        for dstype in dstypes:
+            for srcfile in sorted(glob.glob(os.path.join(srcdir, dstype, '*.zip'))):
+                ziproot = create_target_dir(destdir, srcfile, create=False)
+                rows.extend(plan_archive('awap', srcfile, [
+                    (member, args[3])
+                    for member, args in collect_layers(srcfile, ziproot, year)
+                ]))
+        print_plan(rows, workers=1)
+        return
+
     ziproot = None
-    srctmpdir = None
 
     for dstype in LAYER_TYPES:
         if dstype not in dstypes:
             continue
-        for srcfile in glob.glob(os.path.join(srcdir, dstype, '*.zip')):
-            try:
-                # TODO: check src exists and is zip?
-                # TODO: check destdir exists
-                srctmpdir = unzip_dataset(srcfile)
-                # unpack contains one destination datasets
-                ziproot = create_target_dir(destdir, srcfile)
-                convert(srctmpdir, ziproot, year)
-                if srctmpdir:
-                    shutil.rmtree(srctmpdir)
-            except Exception as e:
-                # cleanup temp location
-                if srctmpdir:
-                    shutil.rmtree(srctmpdir)
-
-                print("Error: Cannot convert {}".format(srcfile))
+        srcfiles = sorted(glob.glob(os.path.join(srcdir, dstype, '*.zip')))
+        # recall next files from tape while converting the current one
+        with Stager(srcfiles) as stager:
+            for srcfile, error in stager:
+                if error is not None:
+                    print("Error: Cannot convert {}".format(srcfile))
+                    continue
+                try:
+                    # TODO: check src exists and is zip?
+                    # TODO: check destdir exists
+                    # zip file contains one destination datasets
+                    ziproot = create_target_dir(destdir, srcfile)
+                    convert(srcfile, ziproot, year)
+                except Exception as e:
+                    print("Error: Cannot convert {}: {}".format(srcfile, e))
+                    raise e
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import os
 import os.path
-import glob
 import json
 import tempfile
 import shutil
@@ -9,6 +8,11 @@ import sys
 import re
 import zipfile
 import time
+import argparse
+
+from data_conversion.governor import estimate_layer_memory
+from data_conversion.packaging import DatasetPackager
+from data_conversion.pipeline import run_jobs, scale_layer, translate_layer
 
 
 JSON_TEMPLATE = "climond.template.json"
@@ -25,34 +29,11 @@ def create_target_dir(basename):
     return tmpdir
 
 
-def gdal_translate(src, dest):
-    """Use gdal_translate to copy file from src to dest"""
-    ret = os.system('gdal_translate -of GTiff -co "COMPRESS=LZW" -co "TILED=YES" {0} {1}'
-                    .format(src, dest))
-    if ret != 0:
-        raise Exception("can't gdal_translate {0} ({1})".format(src, ret))
-
-def scale(src, factor, tmpdir):
-    print "scaling {0} by a factor {1}".format(src, factor)
-    tmpdest = os.path.join(tmpdir, 'tmpfile_scale.tif')
-    cmd = 'gdal_calc.py -A {outfile} --calc="A*{scale}" --co="COMPRESS=LZW" --co="TILED=YES" --outfile {destfile} --type "Float64"'.format(
-                outfile=src,
-                scale=factor,
-                destfile=tmpdest)
-    ret = os.system(cmd)
-    if ret != 0:
-        raise Exception("COMMAND '{}' failed.".format(cmd))
-
-    """Use gdal_translate to recompute statistic"""
-    ret = os.system('gdal_translate -of GTiff -stats -co "COMPRESS=LZW" -co "TILED=YES" {0} {1}'
-                    .format(tmpdest, src))
-    if ret != 0:
-        raise Exception("can't gdal_translate to compute statstics {0} ({1})".format(src, ret))
-
-
-def convert(srcdir, ziproot, basename, filename, year):
-    """copy all files and convert if necessary to zip preparation dir.
+def convert(srcdir, ziproot, basename, filename, year, metadata_scale=False):
+    """collect jobs to copy all files and convert if necessary to zip
+    preparation dir.
     """
+    jobs = []
     # 35 layers
     for layer in range(1, 36):
         if year:
@@ -65,16 +46,21 @@ def convert(srcdir, ziproot, basename, filename, year):
         # just copy all the files
         destfname = 'CLIMOND_{0:02d}.tif'.format(layer)
         destfile = os.path.join(ziproot, basename, 'data', destfname)
-        gdal_translate(vsizip_src_dir, destfile)
-
-        # scale B04 by a factor of 100
+        memory = estimate_layer_memory(vsizip_src_dir)
         if layer == 4:
-            scale(destfile, 100.0, ziproot)
+            # scale B04 by a factor of 100
+            jobs.append((memory, scale_layer,
+                         (vsizip_src_dir, destfile, 100.0, metadata_scale)))
+        else:
+            jobs.append((memory, translate_layer, (vsizip_src_dir, destfile)))
+    return jobs
 
 
-def gen_metadatajson(template, ziproot, basename, year):
+def gen_metadatajson(template, ziproot, basename, year, layers):
     """read metadata template and populate rest of fields
     and write to ziproot + '/bccvl/metadata.json'
+
+    layers ... paths of converted layers (already moved into the zip file)
     """
     md = json.load(open(template, 'r'))
     
@@ -98,11 +84,11 @@ def gen_metadatajson(template, ziproot, basename, year):
 
     # update layer info
     md['files'] = {}
-    for filename in glob.glob(os.path.join(ziproot, basename, 'data', '*.tif')):
+    for filename in layers:
         # get zip root relative path
         zippath = os.path.relpath(filename, ziproot)
         layer_num = re.match(r'.*(\d\d).tif', os.path.basename(filename)).group(1)
-	md['files'][zippath] = {
+        md['files'][zippath] = {
             'layer': 'B{0}'.format(layer_num)
         }
     mdfile = open(os.path.join(ziproot, basename, 'bccvl', 'metadata.json'), 'w')
@@ -111,24 +97,21 @@ def gen_metadatajson(template, ziproot, basename, year):
     mdfile.close()
 
 
-def zipbccvldataset(ziproot, destdir, basename):
-    zipname = os.path.abspath(os.path.join(destdir, basename + '.zip'))
-    ret = os.system('cd {0}; zip -r {1} {2}'.format(ziproot,
-                                                    zipname,
-                                                    basename))
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-
-
 def main(argv):
-    ziproot = None
+    packager = DatasetPackager()
+    ziproots = []
     srcdir = None
     try:
-        if len(argv) != 3:
-            print "Usage: {0} <srczip> <destdir>".format(argv[0])
-            sys.exit(1)
-        srcdir = argv[1]
-        destdir = argv[2]
+        parser = argparse.ArgumentParser(description='Convert CliMond datasets')
+        parser.add_argument('srczip', type=str, help='source zip file')
+        parser.add_argument('destdir', type=str, help='output directory')
+        parser.add_argument('--metadata-scale', action='store_true',
+                            help=('store scale factors as band metadata '
+                                  'instead of rewriting pixels as Float64'))
+        params = vars(parser.parse_args(argv[1:]))
+        srcdir = params.get('srczip')
+        destdir = params.get('destdir')
+        metadata_scale = params.get('metadata_scale')
         fname, ext = os.path.splitext(os.path.basename(srcdir))
 
         # Replace the short emsc with full emsc name
@@ -145,42 +128,49 @@ def main(argv):
             try:
                 tries += 1
                 zf = zipfile.ZipFile(srcdir)
-                print "File {0} is online".format(srcdir)
+                print("File {0} is online".format(srcdir))
                 break
-            except Exception as e:
+            except Exception:
                 if tries > 10:
-                    print "Fail to make file {0} online!!".format(srcdir)
+                    print("Fail to make file {0} online!!".format(srcdir))
                     break
-                print "Waiting for file {0} to be online ...".format(srcdir)
+                print("Waiting for file {0} to be online ...".format(srcdir))
                 time.sleep(60)
 
+        datasets = []
         if dest_filename.startswith('CLIMOND_CURRENT'):
-            # Current climate dataset        
-            base_dir = dest_filename
-            ziproot = create_target_dir(base_dir)
-
-            convert(srcdir, ziproot, base_dir, fname, None)
-            gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, None)
-            zipbccvldataset(ziproot, destdir, base_dir)
-            if ziproot:
-                shutil.rmtree(ziproot)
+            # Current climate dataset
+            datasets.append((dest_filename, None))
         else:
             # Future climate dataset
             yearlist = list(set([os.path.dirname(fp) for fp in zf.namelist()]))
-            for year in yearlist: 
+            for year in yearlist:
                 # unpack contains one destination datasets
-                base_dir = dest_filename + '_' + year
-                ziproot = create_target_dir(base_dir)
-
-                convert(srcdir, ziproot, base_dir, fname, year)
-                gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, year)
-                zipbccvldataset(ziproot, destdir, base_dir)
-                if ziproot:
-                    shutil.rmtree(ziproot)
+                datasets.append((dest_filename + '_' + year, year))
+
+        jobs = []
+        for base_dir, year in datasets:
+            ziproot = create_target_dir(base_dir)
+            ziproots.append(ziproot)
+            packager.open(os.path.join(ziproot, base_dir), destdir)
+            jobs.extend(convert(srcdir, ziproot, base_dir, fname, year, metadata_scale))
+
+        # convert layers of all datasets in parallel, each one goes into the
+        # zip file of its dataset as soon as it is done
+        run_jobs(jobs, on_done=packager.add)
+
+        for ziproot, (base_dir, year) in zip(ziproots, datasets):
+            dsdir = os.path.join(ziproot, base_dir)
+            gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, year,
+                             packager.layers(dsdir))
+            packager.close(dsdir)
+            shutil.rmtree(ziproot)
     finally:
+        packager.abort()
         # cleanup temp location
-        if ziproot and os.path.exists(ziproot):
-            shutil.rmtree(ziproot)
+        for ziproot in ziproots:
+            if os.path.exists(ziproot):
+                shutil.rmtree(ziproot)
 
 
 if __name__ == '__main__':
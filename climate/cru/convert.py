@@ -8,6 +8,8 @@ import shutil
 import sys
 import re
 
+from data_conversion.packaging import zip_directory
+
 
 CURRENT_PREFIX = "cruclim_current_1976-2005"
 JSON_TEMPLATE = "cru.template.json"
@@ -80,7 +82,7 @@ def gen_metadatajson(template, ziproot, basename):
         # get zip root relative path
         zippath = os.path.relpath(filename, ziproot)
         layer_num = re.match(r'.*_(\d\d)_.*\.tif', os.path.basename(filename)).group(1)
-	md['files'][zippath] = {
+        md['files'][zippath] = {
             'layer': 'B{0}'.format(layer_num)
         }
     mdfile = open(os.path.join(ziproot, basename, 'bccvl', 'metadata.json'), 'w')
@@ -89,12 +91,7 @@ def gen_metadatajson(template, ziproot, basename):
 
 
 def zipbccvldataset(ziproot, destdir, basename):
-    zipname = os.path.abspath(os.path.join(destdir, basename + '.zip'))
-    ret = os.system('cd {0}; zip -r {1} {2}'.format(ziproot,
-                                                    zipname,
-                                                    basename))
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+    return zip_directory(os.path.join(ziproot, basename), destdir)
 
 
 def main(argv):
@@ -102,7 +99,7 @@ def main(argv):
     srcdir = None
     try:
         if len(argv) != 3:
-            print "Usage: {0} <srczip> <destdir>".format(argv[0])
+            print("Usage: {0} <srczip> <destdir>".format(argv[0]))
             sys.exit(1)
         srcdir = argv[1]
         destdir = argv[2]
@@ -5,6 +5,12 @@ import zipfile
 import json
 import shutil
 import sys
+import argparse
+
+from osgeo import gdal
+
+from data_conversion.calc import scale_raster
+from data_conversion.packaging import zip_directory
 
 
 TMPDIR = os.getenv("BCCVL_TMP", "/mnt/playground/")
@@ -24,18 +30,22 @@ def gen_metadatajson(template, dest):
 
 def main(argv):
     dataroot = None
-    if len(argv) != 3:
-        print "Usage: {0} <srcdir> <destdir>".format(argv[0])
-        sys.exit(1)
-    src = argv[1]  # TODO: check src exists and is zip?
-    dest = argv[2]
+    parser = argparse.ArgumentParser(description='Convert Global PET and Aridity datasets')
+    parser.add_argument('srcdir', type=str, help='source directory')
+    parser.add_argument('destdir', type=str, help='output directory')
+    parser.add_argument('--metadata-scale', action='store_true',
+                        help=('store aridity scale factor as band metadata '
+                              'instead of rewriting pixels as Float32'))
+    params = vars(parser.parse_args(argv[1:]))
+    src = params.get('srcdir')  # TODO: check src exists and is zip?
+    dest = params.get('destdir')
 
     try:
         # fail if destination exists but is not a directory
         if os.path.exists(
                 os.path.abspath(dest)) and not os.path.isdir(
                 os.path.abspath(dest)):
-            print "Path {} exists and is not a directory.".format(os.path.abspath(dest))
+            print("Path {} exists and is not a directory.".format(os.path.abspath(dest)))
             raise
 
         # try to create destination if it doesn't exist
@@ -43,7 +53,7 @@ def main(argv):
             try:
                 os.makedirs(os.path.abspath(dest))
             except Exception:
-                print "Failed to create directory at {}.".format(os.path.abspath(dest))
+                print("Failed to create directory at {}.".format(os.path.abspath(dest)))
             raise
 
         # extract pet and air to TMPDIR
@@ -68,25 +78,17 @@ def main(argv):
         ))
         if ret != 0:
             raise Exception("can't gdal_translate")
-        ret = os.system('gdal_calc.py -A "{srcfile}" --calc="A*{scale}" --co="COMPRESS=LZW" --NoDataValue=-9999 --co="TILED=YES" --outfile "{destfile}" --type "Float32"'.format(
-            scale='0.0001',
-            srcfile=os.path.join(TMPDIR, 'AI_annual', 'ai_yr/'),
-            destfile=os.path.join(datadir, 'ai_yr.tif'))
+        scale_raster(
+            os.path.join(TMPDIR, 'AI_annual', 'ai_yr/'),
+            os.path.join(datadir, 'ai_yr.tif'), 0.0001,
+            metadata_only=params.get('metadata_scale'),
+            datatype=gdal.GDT_Float32, nodata=-9999,
+            creation_options=['COMPRESS=LZW', 'TILED=YES']
         )
-        if ret != 0:
-            raise Exception(
-                "can't gdal_calc")
         # build metadatafile
         gen_metadatajson('bccvl_metadata_gpeta-template.json', os.path.join(metadatadir, 'metadata.json'))
         # zip result
-        ret = os.system(
-            'cd {0}; zip -r {1} {2} -x *.aux.xml*'.format(
-                TMPDIR,
-            os.path.join(os.path.abspath(dest), 'global-pet-and-aridity.zip'),
-            'global-pet-and-aridity')
-        )
-        if ret != 0:
-            raise Exception("can't zip dataset")
+        zip_directory(dataroot, dest, exclude=['*.aux.xml*'])
     finally:
         if dataroot and os.path.exists(dataroot):
             shutil.rmtree(dataroot)
@@ -7,7 +7,12 @@ import shutil
 import sys
 import re
 import zipfile
-import time
+import argparse
+
+from data_conversion.governor import estimate_layer_memory
+from data_conversion.packaging import DatasetPackager
+from data_conversion.pipeline import run_jobs, scale_layer, translate_layer
+from data_conversion.staging import Stager
 
 
 JSON_TEMPLATE = "narclim.template.json"
@@ -25,51 +30,14 @@ def create_target_dir(basename):
     return tmpdir
 
 def read_zipfile(zipname):
-    zipf = None
-    tries = 0
-    # Make sure file is online
-    while True:
-        try:
-            tries += 1
-            zipf = zipfile.ZipFile(zipname, 'r')
-            print "File {0} is online".format(zipname)
-            break
-        except Exception as e:
-            if tries > 10:
-                print "Fail to make file {0} online!!".format(zipname)
-                raise Exception("Fail to make file {0} online!!".format(zipname))
-            print "Waiting for file {0} to be online ...".format(zipname)
-            time.sleep(60)
-    return zipf
-
-def scale(src, factor, tmpdir):
-    print "scaling {0} by a factor {1}".format(src, factor)
-    tmpdest = os.path.join(tmpdir, 'tmpfile_scale.tif')
-    cmd = 'gdal_calc.py -A {outfile} --calc="A*{scale}" --co="COMPRESS=LZW" --co="TILED=YES" --outfile {destfile} --type "Float64"'.format(
-                outfile=src,
-                scale=factor,
-                destfile=tmpdest)
-    ret = os.system(cmd)
-    if ret != 0:
-        raise Exception("COMMAND '{}' failed.".format(cmd))
-
-    """Use gdal_translate to recompute statistic"""
-    ret = os.system('gdal_translate -of GTiff -stats -co "COMPRESS=LZW" -co "TILED=YES" {0} {1}'
-                    .format(tmpdest, src))
-    if ret != 0:
-        raise Exception("can't gdal_translate to compute statstics {0} ({1})".format(src, ret))
-
-def gdal_translate(src, dest):
-    """Use gdal_translate to copy file from src to dest"""
-    ret = os.system('gdal_translate -of GTiff -co "COMPRESS=LZW" -co "TILED=YES" {0} {1}'
-                    .format(src, dest))
-    if ret != 0:
-        raise Exception("can't gdal_translate {0} ({1})".format(src, ret))
-
-def convert(srczip, ziproot, basename):
-    """copy all files and convert if necessary to zip preparation dir.
-    """
+    # file has been recalled by Stager
+    return zipfile.ZipFile(zipname, 'r')
 
+def convert(srczip, ziproot, basename, metadata_scale=False):
+    """collect jobs to copy all files and convert if necessary to zip
+    preparation dir.
+    """
+    jobs = []
     zf = read_zipfile(srczip)
     for filename in zf.namelist():
         vsizip_src_dir = "/vsizip/" + os.path.join(srczip, filename)
@@ -77,17 +45,22 @@ def convert(srczip, ziproot, basename):
         # just copy all the files
         destfname = 'NARCLIM_{0}'.format(parts[-1])
         destfile = os.path.join(ziproot, basename, 'data', destfname)
-        gdal_translate(vsizip_src_dir, destfile)
-
-        # Scale the layer 15
+        memory = estimate_layer_memory(vsizip_src_dir)
         if parts[-1] == "15.tif":
-            scale(destfile, 0.01, ziproot)
+            # Scale the layer 15
+            jobs.append((memory, scale_layer,
+                         (vsizip_src_dir, destfile, 0.01, metadata_scale)))
+        else:
+            jobs.append((memory, translate_layer, (vsizip_src_dir, destfile)))
     zf.close()
+    return jobs
 
 
-def gen_metadatajson(template, ziproot, basename, year, resolution):
+def gen_metadatajson(template, ziproot, basename, year, resolution, layers):
     """read metadata template and populate rest of fields
     and write to ziproot + '/bccvl/metadata.json'
+
+    layers ... paths of converted layers (already moved into the zip file)
     """
     md = json.load(open(template, 'r'))
 
@@ -109,11 +82,11 @@ def gen_metadatajson(template, ziproot, basename, year, resolution):
 
     # update layer info
     md['files'] = {}
-    for filename in glob.glob(os.path.join(ziproot, basename, 'data', '*.tif')):
+    for filename in layers:
         # get zip root relative path
         zippath = os.path.relpath(filename, ziproot)
         layer_num = re.match(r'.*(\d\d).tif', os.path.basename(filename)).group(1)
-	md['files'][zippath] = {
+        md['files'][zippath] = {
             'layer': 'B{0}'.format(layer_num)
         }
     mdfile = open(os.path.join(ziproot, basename, 'bccvl', 'metadata.json'), 'w')
@@ -122,75 +95,97 @@ def gen_metadatajson(template, ziproot, basename, year, resolution):
     mdfile.close()
 
 
-def zipbccvldataset(ziproot, destdir, basename):
-    zipname = os.path.abspath(os.path.join(destdir, basename + '.zip'))
-    ret = os.system('cd {0}; zip -r {1} {2}'.format(ziproot,
-                                                    zipname,
-                                                    basename))
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+def prepare_file(srczip, metadata_scale=False):
+    """create zip preparation dir for srczip and collect conversion jobs.
 
-def convert_file(srczip, destdir):
-    ziproot = None
+    returns ((ziproot, basename, year, resolution), jobs)
+    """
+    print("Converting {0} ...".format(srczip))
+    fname, ext = os.path.splitext(os.path.basename(srczip))
+
+    # Replace the short emsc with full emsc name
+    nameparts = fname.split('_')
+    if fname.startswith('NaRCLIM_projected_'):
+        resolution = '36 arcsec (1km)'
+        year = int(nameparts[2])
+        gcm = nameparts[3]
+        rcm = nameparts[4]
+        dest_filename = 'NaRCLIM_{gcm}_{rcm}_{year}'.format(gcm=gcm, rcm=rcm, year=year)
+    elif fname.startswith('NaRCLIM_baseline_'):
+        resolution = '36 arcsec (1km)'
+        dest_filename = fname
+        year = 2000
+    elif fname.startswith('NaRCLIM_baseline'):
+        resolution = '9 arcsec (250m)'
+        dest_filename = fname
+        year = 2000
+    elif fname.startswith('NaRCLIM_'):
+        resolution = '9 arcsec (250m)'
+        year = int(nameparts[1])
+        gcm = nameparts[2]
+        rcm = nameparts[3]
+        dest_filename = 'NaRCLIM_{gcm}_{rcm}_{year}'.format(gcm=gcm, rcm=rcm, year=year)
+    else:
+        raise Exception("Unexpected file {}".format(srczip))
+
+    base_dir = dest_filename
+    ziproot = create_target_dir(base_dir)
     try:
-        print "Converting {0} ...".format(srczip)
-        fname, ext = os.path.splitext(os.path.basename(srczip))
-
-        # Replace the short emsc with full emsc name
-        nameparts = fname.split('_')
-        if fname.startswith('NaRCLIM_projected_'):
-            resolution = '36 arcsec (1km)'
-            year = int(nameparts[2])
-            gcm = nameparts[3]
-            rcm = nameparts[4]
-            dest_filename = 'NaRCLIM_{gcm}_{rcm}_{year}'.format(gcm=gcm, rcm=rcm, year=year)
-        elif fname.startswith('NaRCLIM_baseline_'):
-            resolution = '36 arcsec (1km)'
-            dest_filename = fname
-            year = 2000
-        elif fname.startswith('NaRCLIM_baseline'):
-            resolution = '9 arcsec (250m)'
-            dest_filename = fname
-            year = 2000
-        elif fname.startswith('NaRCLIM_'):
-            resolution = '9 arcsec (250m)'
-            year = int(nameparts[1])
-            gcm = nameparts[2]
-            rcm = nameparts[3]
-            dest_filename = 'NaRCLIM_{gcm}_{rcm}_{year}'.format(gcm=gcm, rcm=rcm, year=year)
-        else:
-            raise Exception("Unexpected file {}".format(srczip))
+        jobs = convert(srczip, ziproot, base_dir, metadata_scale)
+    except Exception:
+        shutil.rmtree(ziproot)
+        raise
+    return (ziproot, base_dir, year, resolution), jobs
 
-        base_dir = dest_filename
-        ziproot = create_target_dir(base_dir)
 
-        convert(srczip, ziproot, base_dir)
-        gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, year, resolution)
-        zipbccvldataset(ziproot, destdir, base_dir)
-        if ziproot:
-            shutil.rmtree(ziproot)
-    finally:
-        # cleanup temp location
-        if ziproot and os.path.exists(ziproot):
-            shutil.rmtree(ziproot)
+def convert_files(srczips, destdir, metadata_scale=False):
+    """convert srczips one after the other (layers of each in parallel) and
+    package them.
+
+    The next srczips are recalled from tape while the current one is
+    converted. Layers go into the zip file of their dataset as soon as
+    they are done.
+    """
+    packager = DatasetPackager()
+    with Stager(srczips) as stager:
+        for srczip, error in stager:
+            if error is not None:
+                raise Exception("Fail to make file {0} online!!".format(srczip))
+            (ziproot, base_dir, year, resolution), jobs = prepare_file(
+                srczip, metadata_scale
+            )
+            dsdir = os.path.join(ziproot, base_dir)
+            try:
+                packager.open(dsdir, destdir)
+                run_jobs(jobs, on_done=packager.add)
+                gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, year,
+                                 resolution, packager.layers(dsdir))
+                packager.close(dsdir)
+            finally:
+                packager.abort()
+                # cleanup temp location
+                shutil.rmtree(ziproot)
 
 
 def main(argv):
-    srcdir = None
-    if len(argv) != 3:
-        print "Usage: {0} <srcdir> <destdir>".format(argv[0])
-        sys.exit(1)
-    srcdir = argv[1]
-    destdir = argv[2]
+    parser = argparse.ArgumentParser(description='Convert NaRCLIM datasets')
+    parser.add_argument('srcdir', type=str, help='source zip file or directory')
+    parser.add_argument('destdir', type=str, help='output directory')
+    parser.add_argument('--metadata-scale', action='store_true',
+                        help=('store scale factors as band metadata instead '
+                              'of rewriting pixels as Float64'))
+    params = vars(parser.parse_args(argv[1:]))
+    srcdir = params.get('srcdir')
+    destdir = params.get('destdir')
+    metadata_scale = params.get('metadata_scale')
 
 
     if os.path.isdir(srcdir):
-        for srczip in glob.glob(os.path.join(srcdir, '*.zip')):
-            convert_file(srczip, destdir)
+        convert_files(sorted(glob.glob(os.path.join(srcdir, '*.zip'))), destdir, metadata_scale)
     elif os.path.isfile(srcdir):
-        convert_file(srcdir, destdir)
+        convert_files([srcdir], destdir, metadata_scale)
     else:
-        print "Source {0} does not exist".format(srcdir)
+        print("Source {0} does not exist".format(srcdir))
         sys.exit(1)
 
 if __name__ == '__main__':
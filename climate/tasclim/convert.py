@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import os
 import os.path
-import glob
 import json
 import tempfile
 import shutil
@@ -9,6 +8,10 @@ import sys
 import re
 import zipfile
 
+from data_conversion.governor import estimate_layer_memory
+from data_conversion.packaging import DatasetPackager
+from data_conversion.pipeline import run_jobs, translate_layer
+
 
 JSON_TEMPLATE = "tas.template.json"
 
@@ -39,27 +42,27 @@ def create_target_dir(basename):
     return tmpdir
 
 
-def gdal_translate(src, dest):
-    """Use gdal_translate to copy file from src to dest"""
-    ret = os.system('gdal_translate -of GTiff -co "COMPRESS=LZW" -co "TILED=YES" {0} {1}'
-                    .format(src, dest))
-    if ret != 0:
-        raise Exception("can't gdal_translate {0} ({1})".format(src, ret))
-
 def convert(srcdir, ziproot, basename, year, filename):
-    """copy all files and convert if necessary to zip preparation dir.
+    """collect jobs to copy all files to zip preparation dir.
     """
+    jobs = []
     for i in range(1, 20):
         srcfile = '{0}_{1:02d}_{2}.tif'.format(SRC_FILE_MAP[filename], i, year)
         vsizip_src_dir = "/vsizip/" + os.path.join(srcdir, year, srcfile)
         # just copy all the files
         destfile = 'TASCLIM_{0:02d}.tif'.format(i)
-        gdal_translate(vsizip_src_dir, os.path.join(ziproot, basename, 'data', destfile))
+        jobs.append((
+            estimate_layer_memory(vsizip_src_dir), translate_layer,
+            (vsizip_src_dir, os.path.join(ziproot, basename, 'data', destfile))
+        ))
+    return jobs
 
 
-def gen_metadatajson(template, ziproot, basename, year):
+def gen_metadatajson(template, ziproot, basename, year, layers):
     """read metadata template and populate rest of fields
     and write to ziproot + '/bccvl/metadata.json'
+
+    layers ... paths of converted layers (already moved into the zip file)
     """
     md = json.load(open(template, 'r'))
     
@@ -71,11 +74,11 @@ def gen_metadatajson(template, ziproot, basename, year):
 
     # update layer info
     md['files'] = {}
-    for filename in glob.glob(os.path.join(ziproot, basename, 'data', '*.tif')):
+    for filename in layers:
         # get zip root relative path
         zippath = os.path.relpath(filename, ziproot)
         layer_num = re.match(r'.*(\d\d).tif', os.path.basename(filename)).group(1)
-	md['files'][zippath] = {
+        md['files'][zippath] = {
             'layer': 'B{0}'.format(layer_num)
         }
     mdfile = open(os.path.join(ziproot, basename, 'bccvl', 'metadata.json'), 'w')
@@ -84,21 +87,13 @@ def gen_metadatajson(template, ziproot, basename, year):
     mdfile.close()
 
 
-def zipbccvldataset(ziproot, destdir, basename):
-    zipname = os.path.abspath(os.path.join(destdir, basename + '.zip'))
-    ret = os.system('cd {0}; zip -r {1} {2}'.format(ziproot,
-                                                    zipname,
-                                                    basename))
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-
-
 def main(argv):
-    ziproot = None
+    packager = DatasetPackager()
+    ziproots = []
     srcdir = None
     try:
         if len(argv) != 3:
-            print "Usage: {0} <srczip> <destdir>".format(argv[0])
+            print("Usage: {0} <srczip> <destdir>".format(argv[0]))
             sys.exit(1)
         srcdir = argv[1]
         destdir = argv[2]
@@ -114,20 +109,33 @@ def main(argv):
 
         zf = zipfile.ZipFile(srcdir)
         yearlist = list(set([os.path.dirname(fp) for fp in zf.namelist()]))
-        for year in yearlist: 
+        datasets = []
+        jobs = []
+        for year in yearlist:
             # unpack contains one destination datasets
             base_dir = dest_filename + '_' + year
             ziproot = create_target_dir(base_dir)
-
-            convert(srcdir, ziproot, base_dir, year, fname)
-            gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, year)
-            zipbccvldataset(ziproot, destdir, base_dir)
-            if ziproot:
-                shutil.rmtree(ziproot)
+            ziproots.append(ziproot)
+            datasets.append((ziproot, base_dir, year))
+            packager.open(os.path.join(ziproot, base_dir), destdir)
+            jobs.extend(convert(srcdir, ziproot, base_dir, year, fname))
+
+        # convert layers of all years in parallel, each one goes into the
+        # zip file of its dataset as soon as it is done
+        run_jobs(jobs, on_done=packager.add)
+
+        for ziproot, base_dir, year in datasets:
+            dsdir = os.path.join(ziproot, base_dir)
+            gen_metadatajson(JSON_TEMPLATE, ziproot, base_dir, year,
+                             packager.layers(dsdir))
+            packager.close(dsdir)
+            shutil.rmtree(ziproot)
     finally:
+        packager.abort()
         # cleanup temp location
-        if ziproot and os.path.exists(ziproot):
-            shutil.rmtree(ziproot)
+        for ziproot in ziproots:
+            if os.path.exists(ziproot):
+                shutil.rmtree(ziproot)
 
 
 if __name__ == '__main__':
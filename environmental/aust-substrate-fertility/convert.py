@@ -12,6 +12,8 @@ from osgeo import gdal
 import re
 from collections import namedtuple
 
+from data_conversion.packaging import zip_directory
+
 JSON_TEMPLATE = 'aust-substrate-fertility.json'
 
 LAYER_MAP = {
@@ -27,7 +29,7 @@ LAYER_MAP = {
 def convert(src, dest):
     """convert .FLT files to .tif in dest
     """    
-    print "Converting {}".format(src)
+    print("Converting {}".format(src))
 
     #Use gdal_cal.py to convert FLT (Esri Grid Float format) file to geotif file
     ret = os.system(
@@ -59,20 +61,13 @@ def create_target_dir(destdir, destfile):
 
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2}'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+    return zip_directory(ziproot, dest)
 
 
 def main(argv):
     ziproot = None
     if len(argv) != 3:
-        print "Usage: {0} <srcdir> <destdir>".format(argv[0])
+        print("Usage: {0} <srcdir> <destdir>".format(argv[0]))
         sys.exit(1)
     srcdir  = argv[1]
     destdir = argv[2]
@@ -12,23 +12,17 @@ import shutil
 import sys
 import re
 import calendar
+import argparse
 import fpar_stats
 
+from osgeo import gdal
 
-JSON_TEMPLATE = 'fpar.template.json'
+from data_conversion.calc import scale_raster
+from data_conversion.utils import vsi_path
+from data_conversion.packaging import zip_directory
 
-def ungz(filename):
-    """gunzip given filename.
-    """
-    # unzip file
-    _gunzip = 'gunzip {0}'.format(filename)
-    ret = os.system(_gunzip)
-    if ret != 0:
-        raise Exception("can't gunzip {0} ({1})".format(filename, ret))
-    # get rid of .gz extension
-    filename, _ = os.path.splitext(filename)
-    return filename
 
+JSON_TEMPLATE = 'fpar.template.json'
 
 def gen_metadatajson(src, dest):
     """read metadata template and populate rest of fields
@@ -63,38 +57,38 @@ def create_target_dir(destdir, destfile):
     return root
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2} -x *.aux.xml*'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-    return zipname
+    return zip_directory(ziproot, dest, exclude=['*.aux.xml*'])
 
 
-def scale_down(tiffile):
+def scale_down(src, tiffile, metadata_only=False):
     # scale down the raster data by 10000, and save as float.
-    tmpfile = os.path.join(os.path.dirname(tiffile), 'result.tif')
-    calc = 'gdal_calc.py -A {0} --outfile={1} --calc="A/10000.0" --type="Float32" --overwrite --co "COMPRESS=LZW" --co "TILED=YES"'.format(tiffile, tmpfile)
-    ret = os.system(calc)
-    if ret != 0:
-        raise Exception("fail to scale down {0} ({1})".format(tiffile, ret))
-    # remove orig file
-    os.remove(tiffile)
-    # replace source file
-    shutil.move(tmpfile, tiffile)
+    # src is read in place (e.g. /vsigzip/...), result is written to tiffile
+    if metadata_only:
+        # keep integer data and just record the scale factor on the band
+        scale_raster(
+            src, tiffile, 0.0001, metadata_only=True,
+            creation_options=['COMPRESS=LZW', 'TILED=YES']
+        )
+        return
+    scale_raster(
+        src, tiffile, 0.0001,
+        datatype=gdal.GDT_Float32,
+        creation_options=['COMPRESS=LZW', 'TILED=YES']
+    )
 
 
 def main(argv):
-    year_range = map(str, xrange(2000,2015))
-    if len(argv) > 1:
-        if argv[1] not in year_range:
-            print "Usage: {0} [year]".format(argv(0))
-            print "Valid years: {}".format(','.join(year_range))
-            sys.exit(1)
-        year_range = [ argv[1] ]
+    year_range = [str(year) for year in range(2000, 2015)]
+    parser = argparse.ArgumentParser(description='Convert FPAR datasets')
+    parser.add_argument('year', type=str, nargs='?', choices=year_range,
+                        help='only convert given year')
+    parser.add_argument('--metadata-scale', action='store_true',
+                        help=('store scale factor as band metadata instead '
+                              'of rewriting pixels as Float32'))
+    params = vars(parser.parse_args(argv[1:]))
+    if params.get('year'):
+        year_range = [params.get('year')]
+    metadata_scale = params.get('metadata_scale')
 
     srcfolder = 'source/fpar'
     destfolder = 'bccvl'
@@ -104,9 +98,17 @@ def main(argv):
     try:
         # prepare fpar files if necessary
         for gzfile in glob.glob('{}/*.gz'.format(srcfolder)):
-            tiffile = ungz(gzfile)
-            # re-scale source files
-            scale_down(tiffile)
+            tiffile, _ = os.path.splitext(gzfile)
+            if os.path.exists(tiffile):
+                continue
+            # re-scale source files straight from gzip file
+            try:
+                scale_down(vsi_path(gzfile), tiffile, metadata_scale)
+            except Exception:
+                # don't leave a partial file, it would be skipped next time
+                if os.path.exists(tiffile):
+                    os.remove(tiffile)
+                raise
         for year in year_range:
             for monthfile in glob.glob('{}/fpar.{}.*.tif'.format(srcfolder, year)):
                 try:
@@ -123,7 +125,7 @@ def main(argv):
                     # clean up work dir
                     shutil.rmtree(ziproot)
                 except Exception as e:
-                    print "Error: ", e
+                    print("Error: ", e)
                     raise
 
         # Calculate the fpar statistics for the tiff files
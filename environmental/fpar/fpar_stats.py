@@ -10,6 +10,10 @@ import shutil
 from collections import defaultdict
 import logging
 
+from data_conversion.calc import RasterStats
+from data_conversion.packaging import zip_directory
+from data_conversion.utils import cached_dataset
+
 JSON_TEMPLATE = 'fpar.stats.template.json'
 
 
@@ -39,29 +43,46 @@ def initialise_logger():
     return logger
 
 
-def write_array_to_raster(outfile, dataset, template):
+def write_array_to_raster(outfile, dataset, template, scaled=True):
     """Write numpy array to raster (geoTIFF format).
 
     Keyword arguments:
     outfile -- name of the output file
     dataset -- numpy array to be written to file
     template -- path to a gdal dataset to use as template
+    scaled -- whether dataset is in template units and should keep
+              template band scale / offset
 
     Returns: None.
     """
     log.info("Writing to {}".format(outfile))
 
     # open template dataset
-    templateds = gdal.Open(template)
+    templateds = cached_dataset(template)
+    templateband = templateds.GetRasterBand(1)
 
     # create new dataset
-    outdata = templateds.GetDriver().CreateCopy(outfile, templateds, options=("COMPRESS=LZW", "TILED=YES"))
+    outdata = templateds.GetDriver().Create(
+        outfile, templateds.RasterXSize, templateds.RasterYSize, 1,
+        gdal.GDT_Float32, options=("COMPRESS=LZW", "TILED=YES")
+    )
+    outdata.SetProjection(templateds.GetProjection())
+    outdata.SetGeoTransform(templateds.GetGeoTransform())
+    nodata = templateband.GetNoDataValue()
+    if nodata is not None:
+        outdata.GetRasterBand(1).SetNoDataValue(nodata)
+    if scaled:
+        # source layers may store a scale factor as band metadata
+        outdata.GetRasterBand(1).SetScale(templateband.GetScale() or 1.0)
+        outdata.GetRasterBand(1).SetOffset(templateband.GetOffset() or 0.0)
 
     # write data to file
     outdata.GetRasterBand(1).WriteArray(dataset)
 
-    # calculate statistics
-    outdata.GetRasterBand(1).ComputeStatistics(False)
+    # calculate statistics from array instead of reading the file again
+    rstats = RasterStats()
+    rstats.update(dataset, nodata)
+    rstats.apply(outdata.GetRasterBand(1))
 
     # flush data to disk
     outdata.FlushCache()
@@ -88,7 +109,7 @@ def get_file_lists(fparroot):
     growyearlist = defaultdict(list)
     for year in range(2000, 2015, 1):
         calyearlist[year] = glob.glob(os.path.join(fparroot, 'fpar.{0}.*.aust.tif'.format(year)))
-        for month in range(01, 13, 1):
+        for month in range(1, 13, 1):
             fname = os.path.join(fparroot.replace("*", 'fpar.{0}.{1:02d}.aust'.format(year, month)), 'fpar.{0}.{1:02d}.aust.tif'.format(year, month))
             if os.path.isfile(fname):
                 if month < 7:
@@ -98,7 +119,7 @@ def get_file_lists(fparroot):
 
     # Create the lists - monthly
     monthlylist = defaultdict(list)
-    for month in range(01, 13, 1):
+    for month in range(1, 13, 1):
         monthlylist["{0:02d}".format(month)] = glob.glob(os.path.join(fparroot, 'fpar.*.{0:02d}.aust.tif'.format(month)))
 
     return globallist, monthlylist, growyearlist, calyearlist
@@ -248,7 +269,9 @@ def build_dataset(stats, template, destroot, workdir, fnameformat, year=0, month
     # Write the results to raster format with appropriate filenames
     for stattype, statarr in stats.items():
         outfile = os.path.join(ziproot, 'data', "fpar.{0}.{1}.aust.tif".format(descriptor, stattype))
-        write_array_to_raster(outfile, statarr, template)
+        # coefficient of variation is independent of source scale
+        write_array_to_raster(outfile, statarr, template,
+                              scaled=(stattype != 'cov'))
 
     # Write the metadata.json file
     write_metadatadotjson(ziproot, fnameformat, year, month)
@@ -312,17 +335,9 @@ def zip_dataset(ziproot, dest):
     ziproot -- location of zip target
     dest -- destination for zipfile
 
-    Returns: None.
+    Returns: path to zip file.
     """
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-
-    ret = os.system(
-        'cd {0}; zip -r {1} {2} -x *.aux.xml* -x *.DS_Store'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+    return zip_directory(ziproot, dest, exclude=['*.aux.xml*', '.DS_Store'])
 
 
 def check_or_create_target_dir(target):
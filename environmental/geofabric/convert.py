@@ -1,19 +1,20 @@
 #!/usr/bin/env python
 import os, sys
 import os.path
-import glob
 import json
-import tempfile
 import shutil
-import sys
-import re
-import zipfile
 import argparse
 import numpy
 import traceback
 from osgeo import gdal, ogr
 from osgeo.gdalconst import *
 
+from data_conversion.calc import RasterStats, get_numpy_type
+from data_conversion.narrow import narrowest_datatype, is_integer_type
+from data_conversion.vocabs import PREDICTORS
+from data_conversion.packaging import replace_member, zip_directory
+from data_conversion.utils import cached_dataset, vsi_path
+
 
 JSON_TEMPLATE = "geofabric.template.json"
 CATCHMENT_RASTER = 'NationalCatchmentBoundariesRaster1.tif'
@@ -338,12 +339,10 @@ def geotif_output_filename(destdir, boundtype, layername, attrname):
     return os.path.join(destdir, "data", "{}_{}_{}.tif".format(boundtype, layername, attrname))
 
 def getDataType(rasterfile):
-    rasterLayer = gdal.Open(rasterfile)
+    rasterLayer = cached_dataset(rasterfile)
     if rasterLayer is None:
         raise Exception('Could not open file {}'.format(rasterfile))
-    dtype = rasterLayer.GetRasterBand(1).DataType
-    rasterLayer = None
-    return dtype
+    return rasterLayer.GetRasterBand(1).DataType
 
 def create_target_dir(destdir, destfile):
     """create zip folder structure in tmp location.
@@ -365,17 +364,21 @@ def generate_metadatajson(dest, description, boundtype, layername, updatemd=Fals
     md['description'] = description
     md['genre'] = "Climate" if layername == 'climate' else 'Environmental'
 
-    # Add in the layer information. Unzip existing zip dataset if update metadata only
-    if updatemd:
-        unzip_dataset(dest, os.path.dirname(dest.strip('/')))
-
+    # Add in the layer information. Read layers within existing zip dataset
+    # if update metadata only
+    zipname = dest.rstrip('/') + '.zip'
+    zipdir = os.path.basename(dest.strip('/'))
     filesmd = {}
     for attrname in GEOFABRIC_ATTRIBUTES[boundtype].get(layername, {}):
-        full_pathname = geotif_output_filename(dest, boundtype, layername, attrname)
-        zip_pathname = geotif_output_filename(os.path.basename(dest.strip('/')), boundtype, layername, attrname)
+        zip_pathname = geotif_output_filename(zipdir, boundtype, layername, attrname)
+        if updatemd:
+            # only the tiff header is read from the zip file
+            full_pathname = vsi_path(zipname, zip_pathname)
+        else:
+            full_pathname = geotif_output_filename(dest, boundtype, layername, attrname)
         dtype = getDataType(full_pathname)
         data_type = "continuous"
-        if dtype == GDT_Int32 and BCCVL_LAYER_TYPES[attrname] not in ['watercoursearea', 'lakearea', 'springcount', 'waterholecount']:
+        if is_integer_type(dtype) and BCCVL_LAYER_TYPES[attrname] not in ['watercoursearea', 'lakearea', 'springcount', 'waterholecount']:
             data_type = "discrete"
 
         if BCCVL_LAYER_TYPES[attrname] in ['barrierdownstr', 'barrierupdownstr', 'barrierupstr', \
@@ -388,42 +391,20 @@ def generate_metadatajson(dest, description, boundtype, layername, updatemd=Fals
         }
     md['files'] = filesmd
 
+    if updatemd:
+        # Replace metadata file in the zipped dataset
+        print("Updating {0} with {1}".format(zipname, 'bccvl/metadata.json'))
+        replace_member(zipname, '/'.join([zipdir, 'bccvl', 'metadata.json']),
+                       json.dumps(md, indent=4))
+        return
+
     mdfile = open(os.path.join(dest, 'bccvl', 'metadata.json'), 'w')
     json.dump(md, mdfile, indent=4)
     mdfile.close()
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2}'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-
-def unzip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; unzip -o {1}'.format(workdir, zipname)
-    )
-    if ret != 0:
-        raise Exception("can't unzip {0} ({1})".format(zipname, ret))
-
-def update_dataset_file(ziproot, dest, datapath=os.path.join('bccvl', 'metadata.json')):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-
-    # Replace the specified file of the zip dataset
-    print "Updating {0} with {1}".format(ziproot, datapath)
-    ret = os.system(
-        'cd {0}; zip -m {1} {2}'.format(workdir, zipname, os.path.join(zipdir, datapath))
-    )
-    if ret != 0:
-        raise Exception("can't update {0} with {1} ({2})".format(zipname, datapath, ret))
+    return zip_directory(ziproot, dest)
+
 
 def get_attribute(attrname, tablename, attrgdbfile):
     # Extract the attribute values from the attribute table
@@ -458,21 +439,35 @@ def extractAsGeotif(rasterLayer, bandData, attrname, tablename, attrgdbfile, out
 
     try:
         outData = None
-        outDataset = driver.Create(outfilename, cols, rows, 1, pixel_dtype, ['COMPRESS=LZW', 'TILED=YES'])
-        if outDataset is None:
-            raise Exception('Could not create {}'.format(outfilename))
-
+        outDataset = None
         mapfunc = numpy.vectorize(values.get, otypes=[value_dtype])
         outData = mapfunc(bandData, NODATA_VALUE)
         del values
 
+        # store the layer in the narrowest data type that holds all values
+        # exactly; float attributes stay floats so that they are still
+        # classified as continuous layers
+        rstats = RasterStats()
+        rstats.update(outData, NODATA_VALUE)
+        pixel_dtype, nodata = narrowest_datatype(rstats, pixel_dtype, NODATA_VALUE,
+                                                 adjust_nodata=True, keep_kind=True)
+        if nodata != NODATA_VALUE:
+            outData[outData == NODATA_VALUE] = nodata
+        outData = outData.astype(get_numpy_type(pixel_dtype))
+
+        outDataset = driver.Create(outfilename, cols, rows, 1, pixel_dtype,
+                                   ['COMPRESS=LZW', 'TILED=YES', 'PREDICTOR={}'.format(PREDICTORS[pixel_dtype])])
+        if outDataset is None:
+            raise Exception('Could not create {}'.format(outfilename))
+
         # write the data
         outBand = outDataset.GetRasterBand(1)
         outBand.WriteArray(outData, 0, 0)
 
         # flush data to disk, set the NoData value and calculate stats
         outBand.FlushCache()
-        outBand.SetNoDataValue(NODATA_VALUE)
+        outBand.SetNoDataValue(nodata)
+        rstats.apply(outBand)
 
         # georeference the image and set the projection
         outDataset.SetGeoTransform(rasterLayer.GetGeoTransform())
@@ -510,7 +505,11 @@ def main(argv):
                 # Create a dataset for each boundary type and associated table
                 try:
                     destfile = 'geofabric_{}_{}'.format(boundtype, layername)
-                    ziproot = create_target_dir(destdir, destfile)
+                    if updmd:
+                        # metadata is updated within the existing zip file
+                        ziproot = os.path.join(destdir, destfile)
+                    else:
+                        ziproot = create_target_dir(destdir, destfile)
 
                     # generating geotif files if update metadata is not speciedied
                     if not updmd:
@@ -537,10 +536,7 @@ def main(argv):
 
                     # generate metada file and zip out/update the dataset
                     generate_metadatajson(ziproot, description, boundtype, layername, updmd)
-                    if updmd:
-                        # Replace metadata file in the zipped dataset
-                        update_dataset_file(ziproot, destdir, os.path.join('bccvl', 'metadata.json'))
-                    else:
+                    if not updmd:
                         zip_dataset(ziproot, destdir)
                 finally:
                     # delete temp directory for the dataset
@@ -548,7 +544,7 @@ def main(argv):
                         shutil.rmtree(ziproot)
     except Exception as e:
         traceback.print_exc()
-        print "Fail to convert: ", e
+        print("Fail to convert: ", e)
 
 if __name__ == '__main__':
     main(sys.argv)
\ No newline at end of file
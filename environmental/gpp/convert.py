@@ -13,6 +13,10 @@ from scipy import stats
 import re
 from collections import namedtuple
 
+from data_conversion.calc import raster_calc, RasterStats
+from data_conversion.packaging import zip_directory
+from data_conversion.utils import cached_dataset
+
 JSON_TEMPLATE = 'gpp.template.json'
 TITLE_TEMPLATE = u'Gross Primary Productivity for {} ({})'
 
@@ -45,7 +49,7 @@ def set_nodata(filename, destdir, nodatavalue):
     destpath = None
     srcfile = os.path.splitext(os.path.basename(filename))[0].lower()
     destfile = '{}.tif'.format(srcfile)
-    print "Setting NoDataValue for {}".format(filename)
+    print("Setting NoDataValue for {}".format(filename))
     destpath = os.path.join(destdir, destfile)
     ret = os.system(
         'gdal_translate -of GTiff {0} {1} -a_nodata {2}'.format(filename, destpath, nodatavalue)
@@ -64,17 +68,14 @@ def convert(filename, dest, maskfile):
     srcfile = os.path.splitext(os.path.basename(filename))[0].lower()
     destfile = '{}.tif'.format(srcfile)
     if destfile in LAYER_MAP:
-        print "Converting {}".format(filename)
+        print("Converting {}".format(filename))
         destpath = os.path.join(dest, 'data', destfile)
-        ret = os.system(
-            'gdal_calc.py -A {0} -B {1} --outfile={2} --calc="A*B" --NoDataValue=-9999'.format(maskfile, filename, destpath)
+        raster_calc(
+            'A*B', {'A': maskfile, 'B': filename}, destpath,
+            nodata=-9999, creation_options=[]
         )
-        if ret != 0:
-            raise Exception(
-                "can't gdal_cal.py {0} ({1})".format(filename, ret)
-            )
     else:
-        print "Skipping {}".format(filename)
+        print("Skipping {}".format(filename))
     return destpath
 
 def gen_metadatajson(src, dest):
@@ -110,14 +111,7 @@ def create_target_dir(destdir, destfile):
 
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2} -x *.aux.xml*'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+    return zip_directory(ziproot, dest, exclude=['*.aux.xml*'])
 
 
 def calc_cov(dsfiles):
@@ -171,7 +165,7 @@ def write_array_to_raster(outfile, dataset, template):
     #log.info("Writing to {}".format(outfile))
 
     # open template dataset
-    templateds = gdal.Open(template)
+    templateds = cached_dataset(template)
 
     # get gtiff driver
     driver = gdal.GetDriverByName('GTiff')
@@ -192,8 +186,10 @@ def write_array_to_raster(outfile, dataset, template):
     # write data to file
     outdata.GetRasterBand(1).WriteArray(dataset)
 
-    # calculate statistics
-    outdata.GetRasterBand(1).ComputeStatistics(False)
+    # calculate statistics from array instead of reading the file again
+    rstats = RasterStats()
+    rstats.update(dataset, -9999)
+    rstats.apply(outdata.GetRasterBand(1))
 
     # flush data to disk
     outdata.FlushCache()
@@ -202,12 +198,12 @@ def write_array_to_raster(outfile, dataset, template):
 def main(argv):
     ziproot = None
     if len(argv) != 4:
-        print "Usage: {0} <srcdir> <destdir> <maskfile>".format(argv[0])
+        print("Usage: {0} <srcdir> <destdir> <maskfile>".format(argv[0]))
         sys.exit(1)
     src  = argv[1]
     srcfolder = os.path.basename(src)
     if srcfolder not in FOLDERS:
-        print "Folder unknown, valid options are {}".format(', '.join(FOLDERS))
+        print("Folder unknown, valid options are {}".format(', '.join(FOLDERS)))
         return
     dest = argv[2]
     maskfile_orig = argv[3]      # mask file to apply to dataset
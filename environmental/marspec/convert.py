@@ -2,7 +2,6 @@
 # coding: latin-1
 import os
 import os.path
-import zipfile
 import glob
 import json
 import tempfile
@@ -15,6 +14,9 @@ import calendar
 from osgeo import gdal, ogr
 import numpy as np
 
+from data_conversion.utils import vsi_path, zip_members
+from data_conversion.packaging import zip_directory
+
 JSON_TEMPLATE = 'bccvl_marspec-template-2018v1.json'
 
 def gen_metadatajson(src, dest):
@@ -54,43 +56,17 @@ def create_target_dir(destdir, destfile):
 
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2}'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-
-
-def unpack(zipname, path):
-    """unpack zipfile to path
-    """
-    zipf = zipfile.ZipFile(zipname, 'r')
-    zipf.extractall(path)
-
+    return zip_directory(ziproot, dest)
 
-def unzip_dataset(dsfile):
-    """unzip source dataset and return unzip location
-    """
-    tmpdir = tempfile.mkdtemp()
-    try:
-        unpack(dsfile, tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        raise
-    return tmpdir
 
 def _conver_dataset(dsname, srcfolder, dsglob, ziproot):
-    for zipfile in glob.glob(os.path.join(srcfolder, dsglob)):
-        srctmpdir = None
+    for zipname in glob.glob(os.path.join(srcfolder, dsglob)):
         try:
-            print "converting ", dsname, zipfile
-            srctmpdir = unzip_dataset(zipfile)
-            
-            # find all tif files in srctmpdir:
-            for tiffile in glob.glob(os.path.join(srctmpdir, '*.tif')):
+            print("converting ", dsname, zipname)
+
+            # read all tif files straight from zip file
+            for member in zip_members(zipname, '*.tif'):
+                tiffile = vsi_path(zipname, member)
                 # open dataset
                 ds = gdal.Open(tiffile)
                 # create new dataset in ziproot/data
@@ -109,10 +85,7 @@ def _conver_dataset(dsname, srcfolder, dsglob, ziproot):
                 newds.FlushCache()
                 ds = None
         except Exception as e:
-            print "Error:", e
-        finally:
-            if srctmpdir:
-                shutil.rmtree(srctmpdir)
+            print("Error:", e)
 
 
 def convert_dataset(srcfolder, dsname):
@@ -139,7 +112,6 @@ def main(argv):
     
     if bathymetry:
         srcfolder = 'source/bathymetry'
-        period = '1955-2010'
         dsname = 'bathymetry_5m'
         try:
             tmpdest = convert_dataset(srcfolder, dsname)
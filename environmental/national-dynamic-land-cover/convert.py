@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import os
 import os.path
-import zipfile
+import fnmatch
 import glob
 import json
 import tempfile
@@ -13,6 +13,12 @@ import calendar
 from osgeo import gdal, ogr
 import numpy as np
 
+from data_conversion.calc import RasterStats, compute_stats, get_numpy_type
+from data_conversion.narrow import narrowest_datatype
+from data_conversion.utils import vsi_path, zip_members
+from data_conversion.vocabs import PREDICTORS
+from data_conversion.packaging import zip_directory
+
 JSON_TEMPLATE = 'bccvl_national-dynamic-land-cover-dataset-2014090101.json'
 REDUCED_RAT   = 'bccvl_national-dynamic-land-cover-rat-reduced.tif.aux.xml'
 
@@ -103,33 +109,7 @@ def create_target_dir(destdir, destfile):
 
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2}'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
-
-
-def unpack(zipname, path):
-    """unpack zipfile to path
-    """
-    zipf = zipfile.ZipFile(zipname, 'r')
-    zipf.extractall(path)
-
-
-def unzip_dataset(dsfile):
-    """unzip source dataset and return unzip location
-    """
-    tmpdir = tempfile.mkdtemp()
-    try:
-        unpack(dsfile, tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        raise
-    return tmpdir
+    return zip_directory(ziproot, dest)
 
 
 def get_rat_from_vat(filename):
@@ -179,11 +159,23 @@ def reclassify(tiffname, class_map, destfile):
         for i in list_vals:
             data[data==i] = newval
 
+    # pick narrowest data type for the reclassified values
+    nodata = band.GetNoDataValue()
+    rstats = RasterStats()
+    rstats.update(data, nodata)
+    datatype, new_nodata = narrowest_datatype(rstats, band.DataType, nodata,
+                                              adjust_nodata=True)
+    if new_nodata != nodata:
+        data[data == nodata] = new_nodata
+    data = data.astype(get_numpy_type(datatype))
+
     # create new file
-    file2 = driver.Create(destfile, tiffile.RasterXSize , tiffile.RasterYSize , 1)
+    file2 = driver.Create(destfile, tiffile.RasterXSize , tiffile.RasterYSize , 1, datatype,
+                          ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR={}'.format(PREDICTORS[datatype])])
     file2.GetRasterBand(1).WriteArray(data)
-    nodata = band.GetNoDataValue()
-    file2.GetRasterBand(1).SetNoDataValue(nodata)
+    if new_nodata is not None:
+        file2.GetRasterBand(1).SetNoDataValue(new_nodata)
+    rstats.apply(file2.GetRasterBand(1))
 
     # spatial ref system
     proj = tiffile.GetProjection()
@@ -203,18 +195,19 @@ def convert_dataset(srcfolder, dsname):
     dsglob = DATASET_INFO[dsname].get('fileglob')
     dsttmpdir = tempfile.mkdtemp()
     ziproot = create_target_dir(dsttmpdir, destdir)
-    for zipfile in glob.glob(os.path.join(srcfolder, dsglob)):
+    for zipname in glob.glob(os.path.join(srcfolder, dsglob)):
         try:
-            print "converting ", dsname, zipfile
-            srctmpdir = unzip_dataset(zipfile)
-            
-            # find all tif files in srctmpdir:
-            for tiffile in glob.glob(os.path.join(srctmpdir, '*.tif')):
+            print("converting ", dsname, zipname)
+            members = zip_members(zipname)
+
+            # read all tif files straight from zip file
+            for member in fnmatch.filter(members, '*.tif'):
+                tiffile = vsi_path(zipname, member)
                 # do we have an associated .vat.dbf?
-                ratfile = '{}.vat.dbf'.format(tiffile)
+                ratmember = '{}.vat.dbf'.format(member)
                 rat = None
-                if os.path.exists(ratfile):
-                    rat = get_rat_from_vat(ratfile)
+                if ratmember in members:
+                    rat = get_rat_from_vat(vsi_path(zipname, ratmember))
                 # open dataset
                 ds = gdal.Open(tiffile)
                 # create new dataset in ziproot/data
@@ -229,7 +222,7 @@ def convert_dataset(srcfolder, dsname):
                 )
                 # generate band stats
                 band = newds.GetRasterBand(1)
-                band.ComputeStatistics(False)
+                compute_stats(band)
                 # attach RAT if we have one
                 if rat is not None:
                     band.SetDefaultRAT(rat)
@@ -241,10 +234,7 @@ def convert_dataset(srcfolder, dsname):
                     class_map = {1: range(1,11), 2: range(11,24), 3: range(24,31), 4: range(31,33), 5: range(33,35)}
                     reclassify(tiffile, class_map, os.path.join(ziproot, 'data', new_tiffile))
         except Exception as e:
-            print "Error:", e
-        finally:
-            if srctmpdir:
-                shutil.rmtree(srctmpdir)
+            print("Error:", e)
 
     # add metadata.json for the dataset
     gen_metadatajson(dsname, JSON_TEMPLATE, ziproot)
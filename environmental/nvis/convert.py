@@ -12,6 +12,8 @@ from osgeo import gdal
 import re
 from collections import namedtuple
 
+from data_conversion.packaging import zip_directory
+
 JSON_TEMPLATE = 'nvis.template.json'
 
 LAYER_MAP = {
@@ -46,7 +48,7 @@ def gdal_translate(src, dest):
 def convert(src, dest):
     """convert .ovr files to .tif in dest
     """    
-    print "Converting {}".format(src)
+    print("Converting {}".format(src))
     gdal_translate(src, dest)
 
 def copy_metadatajson(dest):
@@ -70,20 +72,13 @@ def create_target_dir(destdir, destfile):
 
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2}'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+    return zip_directory(ziproot, dest)
 
 
 def main(argv):
     ziproot = None
     if len(argv) != 3:
-        print "Usage: {0} <srcdir> <destdir>".format(argv[0])
+        print("Usage: {0} <srcdir> <destdir>".format(argv[0]))
         sys.exit(1)
     srcdir  = argv[1]
     destdir = argv[2]
@@ -13,6 +13,8 @@ import calendar
 from osgeo import gdal, ogr
 import numpy as np
 
+from data_conversion.packaging import zip_directory
+
 JSON_TEMPLATE = 'bccvl_national-dynamic-land-cover-dataset-2014090101.json'
 REDUCED_RAT   = 'bccvl_national-dynamic-land-cover-rat-reduced.tif.aux.xml'
 
@@ -103,14 +105,7 @@ def create_target_dir(destdir, destfile):
 
 
 def zip_dataset(ziproot, dest):
-    workdir = os.path.dirname(ziproot)
-    zipdir = os.path.basename(ziproot)
-    zipname = os.path.abspath(os.path.join(dest, zipdir + '.zip'))
-    ret = os.system(
-        'cd {0}; zip -r {1} {2}'.format(workdir, zipname, zipdir)
-    )
-    if ret != 0:
-        raise Exception("can't zip {0} ({1})".format(ziproot, ret))
+    return zip_directory(ziproot, dest)
 
 
 def unpack(zipname, path):
@@ -205,7 +200,7 @@ def convert_dataset(srcfolder, dsname):
     ziproot = create_target_dir(dsttmpdir, destdir)
     for zipfile in glob.glob(os.path.join(srcfolder, dsglob)):
         try:
-            print "converting ", dsname, zipfile
+            print("converting ", dsname, zipfile)
             srctmpdir = unzip_dataset(zipfile)
             
             # find all tif files in srctmpdir:
@@ -241,7 +236,7 @@ def convert_dataset(srcfolder, dsname):
                     class_map = {1: range(1,11), 2: range(11,24), 3: range(24,31), 4: range(31,33), 5: range(33,35)}
                     reclassify(tiffile, class_map, os.path.join(ziproot, 'data', new_tiffile))
         except Exception as e:
-            print "Error:", e
+            print("Error:", e)
         finally:
             if srctmpdir:
                 shutil.rmtree(srctmpdir)
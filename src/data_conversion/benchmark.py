@@ -0,0 +1,267 @@
+"""Benchmark GeoTIFF compression and tiling options.
+
+Rewrites sample layers with a matrix of codecs, predictors and block sizes
+and measures file size, write time and decode time for random windows and
+full reads. The best combination per data type is stored in a compression
+profile, which converters pick up via the COMPRESSION_PROFILE environment
+variable (see data_conversion.vocabs.geotiff.compression_options).
+
+usage:
+
+    python -m data_conversion.benchmark --collection worldclim \\
+        --profile profile.json sample1.tif sample2.tif
+"""
+import argparse
+import json
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import time
+
+from osgeo import gdal
+
+from data_conversion.calc import iter_chunks
+from data_conversion.utils import open_gdal_dataset
+from data_conversion.vocabs import PREDICTORS
+
+
+CODECS = [
+    ['COMPRESS=LZW'],
+    ['COMPRESS=DEFLATE', 'ZLEVEL=1'],
+    ['COMPRESS=DEFLATE', 'ZLEVEL=6'],
+    ['COMPRESS=DEFLATE', 'ZLEVEL=9'],
+    ['COMPRESS=ZSTD', 'ZSTD_LEVEL=1'],
+    ['COMPRESS=ZSTD', 'ZSTD_LEVEL=9'],
+    ['COMPRESS=ZSTD', 'ZSTD_LEVEL=15'],
+    # without MAX_Z_ERROR LERC is lossless
+    ['COMPRESS=LERC_DEFLATE'],
+    ['COMPRESS=LERC_ZSTD'],
+]
+
+BLOCK_SIZES = [256, 512, 1024]
+
+
+def candidates(datatype):
+    """generate lists of creation options to benchmark for datatype.
+    """
+    predictors = sorted(set([1, PREDICTORS[datatype]]))
+    for codec in CODECS:
+        for predictor in predictors:
+            if predictor != 1 and codec[0].startswith('COMPRESS=LERC'):
+                # LERC does not support predictors
+                continue
+            for block_size in BLOCK_SIZES:
+                yield codec + [
+                    'PREDICTOR={}'.format(predictor),
+                    'BLOCKXSIZE={}'.format(block_size),
+                    'BLOCKYSIZE={}'.format(block_size),
+                ]
+
+
+def read_windows(path, count, size, seed):
+    """read count random windows of size x size pixels from path.
+    """
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    rnd = random.Random(seed)
+    xsize = min(size, band.XSize)
+    ysize = min(size, band.YSize)
+    for _ in range(count):
+        xoff = rnd.randint(0, band.XSize - xsize)
+        yoff = rnd.randint(0, band.YSize - ysize)
+        band.ReadAsArray(xoff, yoff, xsize, ysize)
+    del band
+    del ds
+
+
+def read_full(path):
+    """read all pixels from path.
+    """
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    for yoff, rows in iter_chunks(band):
+        band.ReadAsArray(0, yoff, band.XSize, rows)
+    del band
+    del ds
+
+
+def bench_options(srcds, options, workdir, windows=100, window_size=256,
+                  seed=0):
+    """write srcds with options and measure size and timings.
+
+    returns dict with results or None if options are not supported
+    """
+    dest = os.path.join(workdir, 'benchmark.tif')
+    start = time.perf_counter()
+    ds = gdal.Translate(dest, srcds, creationOptions=['TILED=YES'] + options)
+    if ds is None:
+        return None
+    ds.FlushCache()
+    del ds
+    write_time = time.perf_counter() - start
+    try:
+        size = os.path.getsize(dest)
+        # each read reopens the file, so that there are no cached blocks
+        start = time.perf_counter()
+        read_windows(dest, windows, window_size, seed)
+        window_time = time.perf_counter() - start
+        start = time.perf_counter()
+        read_full(dest)
+        read_time = time.perf_counter() - start
+    finally:
+        gdal.GetDriverByName('GTiff').Delete(dest)
+    return {
+        'options': options,
+        'size': size,
+        'write_time': write_time,
+        'window_time': window_time,
+        'read_time': read_time,
+    }
+
+
+def bench_layer(path, workdir, windows=100, window_size=256):
+    """benchmark all candidate options for layer at path.
+
+    returns (datatype name, list of results)
+    """
+    srcds = open_gdal_dataset(path)
+    if srcds is None:
+        raise Exception('Could not open {}'.format(path))
+    datatype = srcds.GetRasterBand(1).DataType
+    results = []
+    for options in candidates(datatype):
+        result = bench_options(srcds, options, workdir, windows, window_size)
+        if result is None:
+            print('Skipping unsupported options {}'.format(' '.join(options)))
+            continue
+        results.append(result)
+        print('{:>12} {:8.2f}s {:8.2f}s {:8.2f}s  {}'.format(
+            result['size'], result['write_time'], result['window_time'],
+            result['read_time'], ' '.join(options)))
+    return gdal.GetDataTypeName(datatype), results
+
+
+def recommend(results, max_slowdown=2.0):
+    """pick best options from results for a group of layers.
+
+    results are summed up per option combination across all layers. The
+    smallest output wins among all combinations which decode at most
+    max_slowdown times slower than the fastest one.
+
+    returns list of creation options
+    """
+    totals = {}
+    for result in results:
+        key = tuple(result['options'])
+        total = totals.setdefault(
+            key, {'size': 0, 'window_time': 0.0, 'read_time': 0.0, 'layers': 0}
+        )
+        total['size'] += result['size']
+        total['window_time'] += result['window_time']
+        total['read_time'] += result['read_time']
+        total['layers'] += 1
+    # only consider combinations that worked for all layers
+    layers = max(total['layers'] for total in totals.values())
+    totals = {
+        key: total for key, total in totals.items() if total['layers'] == layers
+    }
+    fastest_window = min(total['window_time'] for total in totals.values())
+    fastest_read = min(total['read_time'] for total in totals.values())
+    acceptable = [
+        key for key, total in totals.items()
+        if (total['window_time'] <= fastest_window * max_slowdown and
+            total['read_time'] <= fastest_read * max_slowdown)
+    ]
+    return list(min(acceptable, key=lambda key: totals[key]['size']))
+
+
+def parse_args():
+    """
+    parse cli
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark GeoTIFF compression options on sample layers'
+    )
+    parser.add_argument(
+        'layers', nargs='+',
+        help='sample layers (any gdal readable path)'
+    )
+    parser.add_argument(
+        '--collection', action='store', default='default',
+        help='collection name the recommended options are stored under'
+    )
+    parser.add_argument(
+        '--profile', action='store',
+        help=('compression profile to update with recommended options. '
+              'Existing entries for other collections are kept')
+    )
+    parser.add_argument(
+        '--report', action='store',
+        help='write all benchmark results as json to this file'
+    )
+    parser.add_argument(
+        '--max-slowdown', action='store', type=float, default=2.0,
+        help=('maximum decode time relative to fastest option for a '
+              'recommendation')
+    )
+    parser.add_argument(
+        '--windows', action='store', type=int, default=100,
+        help='number of random windows to read per layer'
+    )
+    parser.add_argument(
+        '--window-size', action='store', type=int, default=256,
+        help='size of random windows in pixels'
+    )
+    parser.add_argument(
+        '--workdir', action='store',
+        help='folder for temporary files (should be on the target disk)'
+    )
+    return parser.parse_args()
+
+
+def main():
+    """
+    main method
+    """
+    opts = parse_args()
+    workdir = tempfile.mkdtemp(dir=opts.workdir)
+    results = {}
+    try:
+        for layer in opts.layers:
+            print('Benchmarking {}'.format(layer))
+            print('{:>12} {:>9} {:>9} {:>9}  {}'.format(
+                'size', 'write', 'windows', 'read', 'options'))
+            dtype, layer_results = bench_layer(
+                layer, workdir, opts.windows, opts.window_size
+            )
+            for result in layer_results:
+                result['layer'] = layer
+            results.setdefault(dtype, []).extend(layer_results)
+    finally:
+        shutil.rmtree(workdir)
+
+    recommended = {}
+    for dtype, dtype_results in sorted(results.items()):
+        if not dtype_results:
+            continue
+        recommended[dtype] = recommend(dtype_results, opts.max_slowdown)
+        print('Recommended for {} {}: {}'.format(
+            opts.collection, dtype, ' '.join(recommended[dtype])))
+
+    if opts.report:
+        with open(opts.report, 'w') as report:
+            json.dump(results, report, indent=4)
+    if opts.profile:
+        profile = {}
+        if os.path.exists(opts.profile):
+            with open(opts.profile, 'r') as pfile:
+                profile = json.load(pfile)
+        profile.setdefault(opts.collection, {}).update(recommended)
+        with open(opts.profile, 'w') as pfile:
+            json.dump(profile, pfile, indent=4)
+
+
+if __name__ == "__main__":
+    main()
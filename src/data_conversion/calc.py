@@ -0,0 +1,490 @@
+"""In-process raster calculator.
+
+Evaluates a numpy expression over one or more named input rasters block by
+block and writes the result to a new raster. Band statistics are accumulated
+while the blocks are written, so there is no need for an extra
+gdal_translate -stats or ComputeStatistics pass afterwards.
+
+This replaces calls to gdal_calc.py, which spawn a new python interpreter
+(and re-import gdal and numpy) for every layer.
+"""
+import collections
+import json
+import math
+import threading
+from concurrent import futures
+
+import numpy as np
+from osgeo import gdal, gdal_array
+
+from data_conversion.utils import open_gdal_dataset
+
+
+DEFAULT_CREATION_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE']
+
+# aim for chunks of roughly this many pixels per read
+CHUNK_PIXELS = 4 * 1024 * 1024
+
+# number of histogram bins, must be even so that bins can be merged in pairs
+HISTOGRAM_BUCKETS = 256
+
+# number of pixels to look at for approximate statistics
+APPROX_PIXELS = 1024 * 1024
+
+
+class RasterStats(object):
+    """Accumulate band statistics over a sequence of blocks.
+
+    Besides min / max / mean / stddev this keeps a histogram with a fixed
+    number of equal width bins. As the value range is not known up front,
+    the histogram range starts at the range of the first block and is
+    doubled (merging neighbouring bins) whenever values fall outside.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.sum = 0.0
+        self.sumsq = 0.0
+        # all valid values are whole numbers
+        self.integral = True
+        # all valid values can be stored as float32 without loss
+        self.float32_exact = True
+        # number of pixels which are not nodata but NaN or +/-inf, they
+        # are left out of all other statistics
+        self.nonfinite = 0
+        self.histogram = None
+        self.histogram_min = None
+        self.histogram_width = None
+        # statistics are based on overviews or a sample of blocks
+        self.approximate = False
+
+    def update(self, data, nodata=None):
+        """add all valid pixels in data to statistics.
+        """
+        self.total += data.size
+        mask = np.ones(data.shape, dtype=bool)
+        if nodata is not None:
+            if np.isnan(nodata):
+                # NaN never compares equal to itself
+                mask &= ~np.isnan(data)
+            else:
+                mask &= data != nodata
+        if data.dtype.kind == 'f':
+            finite = np.isfinite(data)
+            self.nonfinite += int(np.count_nonzero(mask & ~finite))
+            mask &= finite
+        valid = data[mask]
+        if not valid.size:
+            return
+        # use float64 to avoid overflows when summing up integer data
+        valid = valid.astype(np.float64)
+        vmin = float(valid.min())
+        vmax = float(valid.max())
+        if self.minimum is None or vmin < self.minimum:
+            self.minimum = vmin
+        if self.maximum is None or vmax > self.maximum:
+            self.maximum = vmax
+        if data.dtype.kind == 'f':
+            if self.integral:
+                self.integral = bool(np.all(np.floor(valid) == valid))
+            if self.float32_exact and data.dtype.itemsize > 4:
+                self.float32_exact = bool(
+                    np.all(valid.astype(np.float32) == valid)
+                )
+        self.count += valid.size
+        self.sum += float(valid.sum())
+        self.sumsq += float(np.square(valid).sum())
+        self._update_histogram(valid, vmin, vmax, data.dtype.kind in 'iu')
+
+    def _update_histogram(self, valid, vmin, vmax, integer):
+        buckets = HISTOGRAM_BUCKETS
+        if self.histogram is None:
+            if integer:
+                # align bins with whole numbers
+                width = max(math.ceil((vmax - vmin + 1) / buckets), 1)
+                self.histogram_min = vmin - 0.5
+            else:
+                width = (vmax - vmin) / buckets or 1.0
+                self.histogram_min = vmin
+            self.histogram_width = float(width)
+            self.histogram = np.zeros(buckets, dtype=np.int64)
+        half = np.zeros(buckets // 2, dtype=np.int64)
+        while vmax > self.histogram_max:
+            # double range upwards
+            merged = self.histogram.reshape(-1, 2).sum(axis=1)
+            self.histogram = np.concatenate([merged, half])
+            self.histogram_width *= 2
+        while vmin < self.histogram_min:
+            # double range downwards
+            merged = self.histogram.reshape(-1, 2).sum(axis=1)
+            self.histogram = np.concatenate([half, merged])
+            self.histogram_min -= buckets * self.histogram_width
+            self.histogram_width *= 2
+        idx = ((valid - self.histogram_min) / self.histogram_width).astype(np.int64)
+        np.clip(idx, 0, buckets - 1, out=idx)
+        self.histogram += np.bincount(idx, minlength=buckets)
+
+    @property
+    def histogram_max(self):
+        if self.histogram is None:
+            return None
+        return self.histogram_min + len(self.histogram) * self.histogram_width
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    @property
+    def stddev(self):
+        if not self.count:
+            return None
+        variance = self.sumsq / self.count - self.mean ** 2
+        # rounding errors may produce tiny negative values
+        return math.sqrt(max(variance, 0.0))
+
+    def apply(self, band):
+        """store statistics on a gdal band.
+        """
+        if not self.count:
+            return
+        band.SetStatistics(self.minimum, self.maximum, self.mean, self.stddev)
+        band.SetMetadataItem(
+            'STATISTICS_VALID_PERCENT',
+            str(100.0 * self.count / self.total)
+        )
+        band.SetMetadataItem('STATISTICS_VALID_COUNT', str(self.count))
+        # the histogram is kept as band metadata as well, because a PAM
+        # default histogram does not survive gdal_translate
+        band.SetMetadataItem('STATISTICS_HISTOGRAM', json.dumps({
+            'min': self.histogram_min,
+            'max': self.histogram_max,
+            'buckets': self.histogram.tolist(),
+        }))
+        band.SetDefaultHistogram(
+            self.histogram_min, self.histogram_max, self.histogram.tolist()
+        )
+
+
+def get_numpy_type(datatype):
+    """map gdal data type to numpy dtype.
+    """
+    return np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(datatype))
+
+
+def iter_chunks(band):
+    """generate (yoff, rows) tuples of block aligned full width strips.
+    """
+    _, block_rows = band.GetBlockSize()
+    rows = max(CHUNK_PIXELS // band.XSize, 1)
+    # round to multiple of block height
+    rows = max(rows // block_rows, 1) * block_rows
+    for yoff in range(0, band.YSize, rows):
+        yield yoff, min(rows, band.YSize - yoff)
+
+
+def compute_stats(band):
+    """scan band and store statistics on it.
+
+    Unlike band.ComputeStatistics this also determines whether all values
+    are integral, which is needed to narrow data types, and stores the
+    valid pixel count and a histogram in the same pass.
+
+    returns RasterStats
+    """
+    rstats = RasterStats()
+    nodata = band.GetNoDataValue()
+    for yoff, rows in iter_chunks(band):
+        rstats.update(band.ReadAsArray(0, yoff, band.XSize, rows), nodata)
+    rstats.apply(band)
+    return rstats
+
+
+def approx_stats(band, max_pixels=APPROX_PIXELS):
+    """estimate statistics from an overview or a sample of blocks.
+
+    The largest overview with at most max_pixels pixels is used if there
+    is one; otherwise blocks spread evenly over the band are read until
+    about max_pixels have been seen. Nothing is stored on the band.
+
+    returns RasterStats (approximate is set unless the whole band was read)
+    """
+    rstats = RasterStats()
+    nodata = band.GetNoDataValue()
+    if band.XSize * band.YSize <= max_pixels:
+        for yoff, rows in iter_chunks(band):
+            rstats.update(band.ReadAsArray(0, yoff, band.XSize, rows), nodata)
+        return rstats
+    rstats.approximate = True
+    overviews = [band.GetOverview(idx) for idx in range(band.GetOverviewCount())]
+    overviews = [ovr for ovr in overviews if ovr.XSize * ovr.YSize <= max_pixels]
+    if overviews:
+        ovr = max(overviews, key=lambda ovr: ovr.XSize * ovr.YSize)
+        for yoff, rows in iter_chunks(ovr):
+            rstats.update(ovr.ReadAsArray(0, yoff, ovr.XSize, rows), nodata)
+        return rstats
+    # sample a regular grid of blocks
+    block_cols, block_rows = band.GetBlockSize()
+    xblocks = int(math.ceil(band.XSize / block_cols))
+    yblocks = int(math.ceil(band.YSize / block_rows))
+    ratio = xblocks * yblocks * block_cols * block_rows / max_pixels
+    xstride = min(xblocks, max(int(math.sqrt(ratio)), 1))
+    ystride = max(int(ratio / xstride), 1)
+    for yoff in range(0, band.YSize, ystride * block_rows):
+        for xoff in range(0, band.XSize, xstride * block_cols):
+            rstats.update(
+                band.ReadAsArray(xoff, yoff,
+                                 min(block_cols, band.XSize - xoff),
+                                 min(block_rows, band.YSize - yoff)),
+                nodata
+            )
+    return rstats
+
+
+def raster_calc(calc, inputs, outfile, datatype=None, nodata=None,
+                creation_options=None, driver='GTiff', stats=True,
+                num_threads=1):
+    """Evaluate calc over inputs and write result to outfile.
+
+    calc     ... numpy expression, e.g. 'A * B' or 'A / 10000.0'
+                 (numpy is available as 'np')
+    inputs   ... dict mapping names used in calc to gdal paths
+    outfile  ... path of raster to create
+    datatype ... gdal data type of result, defaults to union of input types
+    nodata   ... nodata value of result, defaults to nodata of first input;
+                 all pixels where any input is nodata will be set to it
+    creation_options ... list of driver creation options
+    num_threads ... number of threads to read and evaluate strips with.
+                 Strips are still written in order, and compressed with
+                 the same number of threads (GTiff NUM_THREADS), so the
+                 result is a normal single file.
+
+    returns RasterStats for the written band (None if stats is False)
+    """
+    if not inputs:
+        raise Exception('No inputs for raster_calc {}'.format(calc))
+    datasets = {}
+    for name, path in inputs.items():
+        ds = open_gdal_dataset(path)
+        if ds is None:
+            raise Exception('Could not open {}'.format(path))
+        datasets[name] = ds
+    shape = set((ds.RasterYSize, ds.RasterXSize) for ds in datasets.values())
+    if len(shape) != 1:
+        raise Exception('Raster have different shape')
+    bands = {name: ds.GetRasterBand(1) for name, ds in datasets.items()}
+    template = next(iter(datasets.values()))
+    first = next(iter(bands.values()))
+
+    if datatype is None:
+        datatype = first.DataType
+        for band in bands.values():
+            datatype = gdal.DataTypeUnion(datatype, band.DataType)
+    if nodata is None:
+        nodata = first.GetNoDataValue()
+    if creation_options is None:
+        creation_options = DEFAULT_CREATION_OPTIONS
+    creation_options = list(creation_options)
+    if num_threads > 1 and driver == 'GTiff' and not any(
+            opt.upper().startswith('NUM_THREADS=') for opt in creation_options):
+        creation_options.append('NUM_THREADS={}'.format(num_threads))
+    out_dtype = get_numpy_type(datatype)
+
+    outds = gdal.GetDriverByName(driver).Create(
+        outfile, template.RasterXSize, template.RasterYSize, 1, datatype,
+        options=creation_options
+    )
+    if outds is None:
+        raise Exception('Could not create {}'.format(outfile))
+    outds.SetGeoTransform(template.GetGeoTransform())
+    outds.SetProjection(template.GetProjection())
+    outband = outds.GetRasterBand(1)
+    if nodata is not None:
+        outband.SetNoDataValue(nodata)
+
+    code = compile(calc, '<raster_calc>', 'eval')
+    env = {'__builtins__': {}, 'np': np, 'numpy': np}
+    local = threading.local()
+    # datasets opened by worker threads, closed once all strips are done
+    thread_datasets = []
+
+    def calc_chunk(chunk):
+        yoff, rows = chunk
+        if num_threads > 1:
+            # gdal datasets must not be shared between threads
+            if not hasattr(local, 'bands'):
+                local.datasets = [
+                    open_gdal_dataset(path) for path in inputs.values()
+                ]
+                thread_datasets.append(local.datasets)
+                local.bands = dict(zip(
+                    inputs.keys(),
+                    (ds.GetRasterBand(1) for ds in local.datasets)
+                ))
+            chunk_bands = local.bands
+        else:
+            chunk_bands = bands
+        arrays = {}
+        mask = None
+        for name, band in chunk_bands.items():
+            data = band.ReadAsArray(0, yoff, band.XSize, rows)
+            arrays[name] = data
+            band_nodata = band.GetNoDataValue()
+            if band_nodata is not None:
+                if np.isnan(band_nodata):
+                    # NaN never compares equal to itself
+                    invalid = np.isnan(data)
+                else:
+                    invalid = data == band_nodata
+                mask = invalid if mask is None else mask | invalid
+        # ignore invalid operations (e.g. divide by zero) on nodata pixels
+        with np.errstate(all='ignore'):
+            result = eval(code, env, arrays)
+        result = np.broadcast_to(result, (rows, template.RasterXSize))
+        result = result.astype(out_dtype)
+        if mask is not None and nodata is not None:
+            result[mask] = nodata
+        return yoff, result
+
+    rstats = RasterStats() if stats else None
+    if num_threads > 1:
+        executor = futures.ThreadPoolExecutor(num_threads)
+        # limit number of strips held in memory
+        results = bounded_map(executor, calc_chunk, iter_chunks(first),
+                              2 * num_threads)
+    else:
+        executor = None
+        results = map(calc_chunk, iter_chunks(first))
+    try:
+        for yoff, result in results:
+            outband.WriteArray(result, 0, yoff)
+            if rstats is not None:
+                rstats.update(result, nodata)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+            # worker threads have exited (and with them their thread local
+            # bands), drop the last references to their datasets, which
+            # closes them
+            del thread_datasets[:]
+
+    if rstats is not None:
+        rstats.apply(outband)
+    outband.FlushCache()
+    del outband
+    del outds
+    return rstats
+
+
+def copy_raster(src, dest, metadata=None, creation_options=None,
+                norat=False, num_threads=1):
+    """Copy band 1 of src to dest and collect its statistics on the way.
+
+    Replaces a gdal_translate to an intermediate raster followed by a
+    compute_stats pass over it, pixels are decoded only once. Geo
+    transform, projection and nodata are kept (see raster_calc), dataset
+    and band metadata, scale, offset, unit type, color table and raster
+    attribute table (unless norat is set) are copied over.
+
+    metadata ... dict of dataset metadata items to add (like
+                 gdal_translate -mo)
+
+    returns RasterStats (stored on the band of dest)
+    """
+    rstats = raster_calc('A', {'A': src}, dest,
+                         creation_options=creation_options,
+                         num_threads=num_threads)
+    srcds = open_gdal_dataset(src)
+    if srcds is None:
+        raise Exception('Could not open {}'.format(src))
+    srcband = srcds.GetRasterBand(1)
+    ds = gdal.Open(dest, gdal.GA_Update)
+    band = ds.GetRasterBand(1)
+    ds.SetMetadata(srcds.GetMetadata())
+    for key, value in (metadata or {}).items():
+        ds.SetMetadataItem(key, str(value))
+    band.SetMetadata(srcband.GetMetadata())
+    band.SetScale(srcband.GetScale() or 1.0)
+    band.SetOffset(srcband.GetOffset() or 0.0)
+    if srcband.GetUnitType():
+        band.SetUnitType(srcband.GetUnitType())
+    if srcband.GetColorTable() is not None:
+        band.SetColorTable(srcband.GetColorTable())
+    if not norat and srcband.GetDefaultRAT() is not None:
+        band.SetDefaultRAT(srcband.GetDefaultRAT())
+    # statistics have been reset with band metadata, restore them
+    rstats.apply(band)
+    ds.FlushCache()
+    del band
+    del ds
+    return rstats
+
+
+def bounded_map(executor, func, iterable, limit):
+    """like executor.map, but with at most limit pending calls.
+
+    yields results in order of iterable
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def scale_raster(src, dest, scale, offset=0.0, metadata_only=False,
+                 datatype=gdal.GDT_Float32, nodata=None,
+                 creation_options=None, num_threads=1):
+    """Apply scale and offset to src and write result to dest.
+
+    If metadata_only is set, pixel values are copied unchanged in their
+    original (usually compact integer) data type and scale / offset are
+    recorded on the band instead. src and dest may be the same file in this
+    case, which just updates the band metadata in place.
+
+    Otherwise all pixels are rewritten as 'A * scale + offset' in datatype
+    and nodata (see raster_calc). Both are ignored with metadata_only, as
+    the source data type and nodata value are kept as they are.
+
+    num_threads ... number of threads to process and compress blocks with
+
+    returns RasterStats if pixels have been rewritten
+    """
+    if not metadata_only:
+        return raster_calc(
+            'A*{!r}+{!r}'.format(scale, offset), {'A': src}, dest,
+            datatype=datatype, nodata=nodata,
+            creation_options=creation_options, num_threads=num_threads
+        )
+    if creation_options is None:
+        creation_options = DEFAULT_CREATION_OPTIONS
+    creation_options = list(creation_options)
+    if num_threads > 1:
+        creation_options.append('NUM_THREADS={}'.format(num_threads))
+    if src == dest:
+        ds = gdal.Open(dest, gdal.GA_Update)
+        if ds is None:
+            raise Exception('Could not open {}'.format(dest))
+    else:
+        srcds = open_gdal_dataset(src)
+        if srcds is None:
+            raise Exception('Could not open {}'.format(src))
+        ds = gdal.Translate(
+            dest, srcds, stats=True,
+            creationOptions=creation_options
+        )
+        if ds is None:
+            raise Exception('Could not translate {} to {}'.format(src, dest))
+    band = ds.GetRasterBand(1)
+    band.SetScale(scale)
+    band.SetOffset(offset)
+    ds.FlushCache()
+    del band
+    del ds
+    return None
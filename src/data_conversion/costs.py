@@ -0,0 +1,276 @@
+"""Cost model for conversion jobs fitted from earlier runs.
+
+Runtime and peak memory of every job are recorded in a history file (json
+lines, CONVERSION_COST_HISTORY, defaults to
+~/.cache/data_conversion/costs.jsonl), keyed by collection, resolution,
+data type and pixel count of the source layer. The cost model predicts
+runtime and memory of new jobs from seconds and bytes per pixel of similar
+jobs in the history.
+
+The predictions are used to start the longest jobs first, so that a big
+layer doesn't start last and dominate the end of a run, and to pack jobs
+against the memory budget (see ResourceGovernor.submit_all).
+
+usage:
+
+    jobs = plan_jobs('worldclim', [
+        (estimate_layer_memory(src), src, run_gdal, (cmd, src, dest),
+         estimate_layer_disk(src, dest))
+        ...
+    ])
+    pool = governor.executor([job[0] for job in jobs])
+    results = governor.submit_all(pool, jobs, threads=governor.threads)
+"""
+import json
+import os
+import os.path
+import resource
+import statistics
+import threading
+import time
+
+from osgeo import gdal
+
+from data_conversion.governor import JOB_OVERHEAD
+from data_conversion.utils import cached_dataset
+
+
+# interval to sample memory of a running job in seconds
+SAMPLE_INTERVAL = 0.2
+
+
+def history_path():
+    """path of cost history file.
+    """
+    path = os.environ.get('CONVERSION_COST_HISTORY')
+    if path:
+        return path
+    return os.path.expanduser(
+        os.path.join('~', '.cache', 'data_conversion', 'costs.jsonl')
+    )
+
+
+def layer_features(path):
+    """features of source layer at path the cost of a job depends on.
+
+    returns dict with dtype, pixels and resolution (pixel size in CRS
+    units) or None if path can't be opened
+    """
+    ds = cached_dataset(path)
+    if ds is None:
+        return None
+    resolution = ds.GetGeoTransform()[1]
+    return {
+        'dtype': gdal.GetDataTypeName(ds.GetRasterBand(1).DataType),
+        'pixels': ds.RasterXSize * ds.RasterYSize * ds.RasterCount,
+        'resolution': '{:.6g}'.format(resolution),
+    }
+
+
+def raster_itemsize(dtype):
+    """bytes per pixel of gdal data type name (e.g. 'Int16').
+    """
+    return max(gdal.GetDataTypeSize(gdal.GetDataTypeByName(dtype)) // 8, 1)
+
+
+def resident_memory():
+    """current resident memory of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # peak instead of current (kilobytes on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_memory():
+    """peak resident memory of the largest finished subprocess of this
+    process in bytes (e.g. gdal_translate).
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def record(collection, features, seconds, memory, history=None):
+    """append runtime and memory of a job to the history file.
+    """
+    if features is None:
+        return
+    history = history or history_path()
+    os.makedirs(os.path.dirname(os.path.abspath(history)), exist_ok=True)
+    entry = dict(features, collection=collection, seconds=seconds,
+                 memory=memory)
+    # single small appends are atomic, so parallel workers can share the file
+    with open(history, 'a') as hfile:
+        hfile.write(json.dumps(entry) + '\n')
+
+
+def measured(collection, features, fn, *args, **kwargs):
+    """call fn(*args, **kwargs) and record its runtime and memory.
+
+    Memory is the peak growth of this process' resident memory while fn
+    runs or the peak of a subprocess it ran (e.g. gdal_translate),
+    whichever is larger, plus JOB_OVERHEAD. Both undercount memory which
+    was in use before (e.g. a warm block cache), so predictions only ever
+    raise the static estimate (see plan_jobs).
+    """
+    start_memory = resident_memory()
+    start_children = children_memory()
+    peak = [start_memory]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], resident_memory())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.time()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+    seconds = time.time() - start
+    peak[0] = max(peak[0], resident_memory())
+    memory = peak[0] - start_memory
+    # the children's peak is the largest of all subprocesses so far, it
+    # belongs to this job only if it grew meanwhile
+    children = children_memory()
+    if children > start_children:
+        memory = max(memory, children)
+    try:
+        record(collection, features, seconds, memory + JOB_OVERHEAD)
+    except (IOError, OSError) as e:
+        print('Could not record job cost: {}'.format(e))
+    return result
+
+
+class CostModel(object):
+    """Predict runtime and memory of jobs from the history of earlier jobs.
+
+    Seconds per pixel is the median of the most specific group of earlier
+    jobs: same collection, resolution and data type, then same collection
+    and data type, then same data type, then all jobs. Bytes per pixel
+    (on top of JOB_OVERHEAD) is the maximum within the same collection (and
+    resolution and data type, if possible). Without history runtime is
+    assumed proportional to the number of pixels.
+    """
+
+    def __init__(self, history=None):
+        self.history = history or history_path()
+        self._seconds = {}
+        self._memory = {}
+        self._byte_seconds = {}
+        self.fit(self.load())
+
+    def load(self):
+        """read job records from history file.
+        """
+        records = []
+        if not os.path.exists(self.history):
+            return records
+        with open(self.history, 'r') as hfile:
+            for line in hfile:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # partially written line
+                    continue
+        return records
+
+    @staticmethod
+    def keys(collection, features):
+        """group keys from most to least specific.
+        """
+        return [
+            (collection, features['resolution'], features['dtype']),
+            (collection, None, features['dtype']),
+            (None, None, features['dtype']),
+            (None, None, None),
+        ]
+
+    def fit(self, records):
+        """fit per pixel rates for all groups of records.
+        """
+        seconds = {}
+        memory = {}
+        byte_seconds = {}
+        for entry in records:
+            if not entry.get('pixels'):
+                continue
+            keys = self.keys(entry.get('collection'), entry)
+            for key in keys:
+                seconds.setdefault(key, []).append(
+                    entry['seconds'] / entry['pixels'])
+            for key in keys[:2]:
+                memory.setdefault(key, []).append(
+                    max(entry['memory'] - JOB_OVERHEAD, 0) / entry['pixels'])
+            nbytes = entry['pixels'] * raster_itemsize(entry['dtype'])
+            for key in (entry.get('collection'), None):
+                byte_seconds.setdefault(key, []).append(
+                    entry['seconds'] / nbytes)
+        self._seconds = {key: statistics.median(rates)
+                         for key, rates in seconds.items()}
+        self._memory = {key: max(rates) for key, rates in memory.items()}
+        self._byte_seconds = {key: statistics.median(rates)
+                              for key, rates in byte_seconds.items()}
+
+    def predict(self, collection, features):
+        """predict (seconds, memory) of a job.
+
+        seconds is relative (the number of pixels) if there is no history,
+        memory is None if there is no history for the collection.
+        """
+        if features is None:
+            return 0, None
+        keys = self.keys(collection, features)
+        seconds = next(
+            (self._seconds[key] * features['pixels']
+             for key in keys if key in self._seconds),
+            features['pixels']
+        )
+        memory = next(
+            (JOB_OVERHEAD + int(self._memory[key] * features['pixels'])
+             for key in keys[:2] if key in self._memory),
+            None
+        )
+        return seconds, memory
+
+    def predict_bytes(self, collection, nbytes):
+        """predict seconds of a job from the uncompressed size of its source
+        layer (when the layer itself can't be opened cheaply).
+
+        returns None if there is no history
+        """
+        for key in (collection, None):
+            if key in self._byte_seconds:
+                return self._byte_seconds[key] * nbytes
+        return None
+
+
+def plan_jobs(collection, jobs, model=None):
+    """attach predicted costs to jobs and record their cost when run.
+
+    jobs ... list of (memory, src, fn, args, disk), memory is the static
+             estimate (see estimate_layer_memory), src the source layer of
+             the job and disk its disk space (see estimate_layer_disk)
+
+    returns list of (memory, seconds, fn, args, disk) for
+    ResourceGovernor.submit_all; memory is the predicted memory if there is
+    history for the collection and it is larger than the static estimate
+    (measured memory misses memory already in use when the job started)
+    """
+    if model is None:
+        model = CostModel()
+    planned = []
+    for memory, src, fn, args, disk in jobs:
+        features = layer_features(src)
+        seconds, predicted = model.predict(collection, features)
+        if predicted is not None:
+            memory = max(memory, predicted)
+        planned.append((
+            memory, seconds, measured, (collection, features, fn) + tuple(args),
+            disk
+        ))
+    return planned
@@ -1,9 +1,11 @@
+import json
 import os.path
 import uuid
 
 from osgeo import gdal, osr
 
-from data_conversion.utils import transform_pixel, open_gdal_dataset
+from data_conversion.calc import approx_stats
+from data_conversion.utils import transform_pixel, cached_dataset
 
 
 GDAL_JSON_TYPE_MAP = {
@@ -35,7 +37,7 @@ def gen_tif_metadata(tiffile, srcdir, swiftcontainer):
     """read metadata from tiffile
     """
     md = {}
-    ds = open_gdal_dataset(tiffile)
+    ds = cached_dataset(tiffile)
     dsmd = ds.GetMetadata()
     if 'emission_scenario' in dsmd:
         # Future Climate
@@ -65,6 +67,29 @@ def gen_tif_metadata(tiffile, srcdir, swiftcontainer):
     return md
 
 
+def changed_coverages(coverages, tiffiles, srcdir, swiftcontainer, since):
+    """split tiffiles into those with a current coverage in coverages (e.g.
+    from data.json) and those whose coverage has to be (re)generated.
+
+    since ... time the coverages were generated (e.g. mtime of data.json),
+              tiffiles modified afterwards are regenerated
+
+    returns (kept, changed), kept are the coverages of unchanged tiffiles
+    and changed the tiffiles which are new or modified; coverages of
+    tiffiles which don't exist anymore are dropped
+    """
+    by_url = {cov['bccvl:metadata']['url']: cov for cov in coverages}
+    kept = []
+    changed = []
+    for tiffile in tiffiles:
+        url = os.path.join(swiftcontainer, os.path.relpath(tiffile, srcdir))
+        if url in by_url and os.path.getmtime(tiffile) <= since:
+            kept.append(by_url[url])
+        else:
+            changed.append(tiffile)
+    return kept, changed
+
+
 def gen_coverage_uuid(cov, identifier):
     # generate predictable uuid
     # kind + 'id' + genre + variable names + emsc + gcm + year + month
@@ -84,9 +109,17 @@ def gen_coverage_uuid(cov, identifier):
     return str(uid)
 
 
-def gen_tif_coverage(tiffile, url, ratmap=None):
-    ds = open_gdal_dataset(tiffile)
-    return gen_cov_json(ds, url, ratmap)
+def gen_tif_coverage(tiffile, url, ratmap=None, approx_ok=False):
+    ds = cached_dataset(tiffile)
+    return gen_cov_json(ds, url, ratmap, approx_ok)
+
+
+def has_approximate_statistics(coverage):
+    # True if any range statistics have been estimated (see approx_ok)
+    return any(
+        alt.get('dmgr:approximate', False)
+        for alt in coverage['rangeAlternates']['dmgr:tiff'].values()
+    )
 
 
 def gen_dataset_coverage(coverages, aggs=[]):
@@ -256,13 +289,25 @@ def gen_cov_ranges(ds):
     return {}
 
 
-def gen_cov_range_alternates(ds, url):
+def gen_cov_range_alternates(ds, url, approx_ok=False):
     # single band tiff
     # I don't know of any standard prefix to describe rangeAlternates,
     # so let's use one that is hopefully not woll-known.
     # dmgr: for Datamanager
     band = ds.GetRasterBand(1)
     bandmd = band.GetMetadata_Dict()
+    stats = gen_cov_band_statistics(bandmd)
+    vmin, vmax = band.GetMinimum(), band.GetMaximum()
+    if approx_ok and (vmin is None or vmax is None):
+        # no stored statistics, estimate them instead of scanning the
+        # full resolution data
+        rstats = approx_stats(band)
+        vmin, vmax = rstats.minimum, rstats.maximum
+        stats.update({
+            'dmgr:mean': rstats.mean,
+            'dmgr:stddev': rstats.stddev,
+            'dmgr:approximate': rstats.approximate,
+        })
     return {
         "dmgr:tiff": {
             bandmd['standard_name']: {
@@ -274,23 +319,41 @@ def gen_cov_range_alternates(ds, url):
                 "dmgr:offset": band.GetOffset(),
                 "dmgr:scale": band.GetScale(),
                 "dmgr:missingValue": band.GetNoDataValue(),
-                "dmgr:min": band.GetMinimum(),
-                "dmgr:max": band.GetMaximum(),
+                "dmgr:min": vmin,
+                "dmgr:max": vmax,
                 "dmgr:datatype": gdal.GetDataTypeName(band.DataType),
                 "url": url,
                 # "urlTemplate": "http://exampl.com/dataservice/{y}/{x}"
+                # statistics stored during conversion (if any)
+                **stats
             }
         }
     }
 
 
-def gen_cov_json(ds, url, ratmap=None):
+def gen_cov_band_statistics(bandmd):
+    # pick up statistics stored in band metadata by the converters
+    # (see data_conversion.calc.RasterStats), so that there is no need
+    # to scan the whole raster again
+    stats = {}
+    if 'STATISTICS_MEAN' in bandmd:
+        stats['dmgr:mean'] = float(bandmd['STATISTICS_MEAN'])
+    if 'STATISTICS_STDDEV' in bandmd:
+        stats['dmgr:stddev'] = float(bandmd['STATISTICS_STDDEV'])
+    if 'STATISTICS_VALID_COUNT' in bandmd:
+        stats['dmgr:validCount'] = int(bandmd['STATISTICS_VALID_COUNT'])
+    if 'STATISTICS_HISTOGRAM' in bandmd:
+        stats['dmgr:histogram'] = json.loads(bandmd['STATISTICS_HISTOGRAM'])
+    return stats
+
+
+def gen_cov_json(ds, url, ratmap=None, approx_ok=False):
     return {
         "type": "Coverage",
         "domain": gen_cov_domain(ds),
         "parameters": gen_cov_parameters(ds, ratmap),
         "ranges": gen_cov_ranges(ds),
-        "rangeAlternates": gen_cov_range_alternates(ds, url)
+        "rangeAlternates": gen_cov_range_alternates(ds, url, approx_ok)
     }
 
 
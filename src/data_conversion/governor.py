@@ -0,0 +1,316 @@
+"""Resource governor for conversion jobs.
+
+Decides how many layers are converted in parallel and how many GDAL
+threads each of them may use, based on the number of cores and a memory
+budget. Jobs are only started while their estimated memory fits into the
+budget, so that large collections don't run out of memory while small ones
+still keep all cores busy.
+
+The memory budget defaults to 80% of the available memory and can be set
+in bytes with the CONVERSION_MEMORY_BUDGET environment variable; the
+number of cores can be limited with CONVERSION_CPUS.
+
+Jobs are also only started while the file systems they write to (scratch
+and destination) have enough free space for their estimated output, so
+that a full disk doesn't fail jobs half way. CONVERSION_DISK_HEADROOM sets
+the free space in bytes to leave on each file system.
+"""
+import os
+import os.path
+import threading
+from concurrent import futures
+
+from osgeo import gdal
+
+from data_conversion.scratch import kept_in_memory, raster_size, scratch_dir
+from data_conversion.utils import cached_dataset
+
+
+MB = 1024 * 1024
+
+# fixed memory per worker (python, gdal, numpy, gdal_translate subprocess)
+JOB_OVERHEAD = 256 * MB
+
+# pixels per strip held in memory while processing a layer
+# (see data_conversion.calc.CHUNK_PIXELS)
+STRIP_PIXELS = 4 * 1024 * 1024
+
+# limits for GDAL block cache per worker
+MIN_CACHE = 64 * MB
+MAX_CACHE = 1024 * MB
+
+# VSI read cache per worker (speeds up /vsizip/ and /vsicurl/ access)
+VSI_CACHE_SIZE = 64 * MB
+
+# free space to leave on file systems jobs write to
+DISK_HEADROOM = 1024 * MB
+
+# overviews add up to a third of the full resolution raster
+OVERVIEW_FACTOR = 4.0 / 3
+
+# seconds between checks of free disk space while jobs wait for it (space
+# may be freed by other processes as well)
+DISK_POLL_INTERVAL = 10
+
+
+def available_memory():
+    """available memory in bytes.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def estimate_memory(xsize, ysize, datatype, in_memory=False):
+    """estimate memory needed to convert a layer (without GDAL cache).
+
+    in_memory ... whether the converter holds the whole layer as array
+                  (input and output) instead of processing it in strips
+    """
+    itemsize = gdal.GetDataTypeSize(datatype) // 8
+    if in_memory:
+        return JOB_OVERHEAD + 2 * xsize * ysize * itemsize
+    # a strip in its own data type plus float64 copies for statistics
+    pixels = min(xsize * ysize, STRIP_PIXELS)
+    return JOB_OVERHEAD + pixels * (itemsize + 2 * 8)
+
+
+def estimate_layer_memory(path, in_memory=False):
+    """estimate memory needed to convert the layer at path.
+    """
+    ds = cached_dataset(path)
+    if ds is None:
+        raise Exception('Could not open {}'.format(path))
+    band = ds.GetRasterBand(1)
+    memory = estimate_memory(ds.RasterXSize, ds.RasterYSize, band.DataType,
+                             in_memory)
+    size = raster_size(path)
+    if kept_in_memory(size):
+        # intermediate copy of layer in scratch memory
+        memory += size
+    return memory
+
+
+def estimate_disk(xsize, ysize, datatype, bands=1):
+    """estimate disk space of a converted layer with overviews.
+
+    Compression is not taken into account, so this is an upper bound.
+    """
+    itemsize = gdal.GetDataTypeSize(datatype) // 8
+    return int(xsize * ysize * bands * itemsize * OVERVIEW_FACTOR)
+
+
+def estimate_layer_disk(path, dest, scratch=True, datatype=None):
+    """estimate disk space needed to convert the layer at path to dest.
+
+    scratch  ... whether the converter writes an intermediate copy of the
+                 layer (see data_conversion.scratch)
+    datatype ... data type of dest (defaults to the one of the layer)
+
+    returns dict of directory: bytes
+    """
+    ds = cached_dataset(path)
+    if ds is None:
+        raise Exception('Could not open {}'.format(path))
+    if datatype is None:
+        datatype = ds.GetRasterBand(1).DataType
+    disk = {
+        os.path.dirname(os.path.abspath(dest)): estimate_disk(
+            ds.RasterXSize, ds.RasterYSize, datatype, ds.RasterCount)
+    }
+    size = raster_size(path)
+    if scratch and not kept_in_memory(size):
+        tmpdir = scratch_dir()
+        disk[tmpdir] = disk.get(tmpdir, 0) + int(size * OVERVIEW_FACTOR)
+    return disk
+
+
+def filesystem(path):
+    """device id and closest existing directory of path.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev, path
+
+
+def free_space(path):
+    """free disk space in bytes for unprivileged users at path.
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def init_worker(cachemax, threads):
+    """configure GDAL in a worker process.
+
+    Settings are put into the environment as well, so that gdal_translate
+    subprocesses pick them up.
+    """
+    settings = {
+        'GDAL_CACHEMAX': str(cachemax // MB),
+        'GDAL_NUM_THREADS': str(threads),
+        'VSI_CACHE': 'TRUE',
+        'VSI_CACHE_SIZE': str(VSI_CACHE_SIZE),
+    }
+    for key, value in settings.items():
+        os.environ[key] = value
+        gdal.SetConfigOption(key, value)
+    gdal.SetCacheMax(cachemax)
+
+
+class ResourceGovernor(object):
+    """Split cores and memory between conversion jobs.
+
+    usage:
+
+        governor = ResourceGovernor()
+        pool = governor.executor([job[0] for job in jobs])
+        results = governor.submit_all(pool, jobs, threads=governor.threads)
+    """
+
+    def __init__(self, memory=None, cpus=None, disk_headroom=None):
+        if memory is None:
+            memory = os.environ.get('CONVERSION_MEMORY_BUDGET')
+            memory = int(memory) if memory else int(available_memory() * 0.8)
+        if cpus is None:
+            cpus = os.environ.get('CONVERSION_CPUS')
+            cpus = int(cpus) if cpus else (os.cpu_count() or 1)
+        if disk_headroom is None:
+            disk_headroom = int(os.environ.get('CONVERSION_DISK_HEADROOM',
+                                               DISK_HEADROOM))
+        self.memory = memory
+        self.cpus = cpus
+        self.disk_headroom = disk_headroom
+        self.workers = 1
+        self.threads = cpus
+        self.cachemax = MIN_CACHE
+        self._used = 0
+        # bytes reserved by running jobs per device
+        self._disk = {}
+        self._cond = threading.Condition()
+
+    def plan(self, job_memory):
+        """decide workers, threads and cache size for a list of jobs.
+
+        job_memory ... list of estimated memory per job (see estimate_memory)
+        """
+        largest = max(job_memory) if job_memory else JOB_OVERHEAD
+        workers = min(
+            self.cpus,
+            max(len(job_memory), 1),
+            max(self.memory // (largest + MIN_CACHE), 1),
+        )
+        self.workers = workers
+        # remaining cores go to GDAL compression threads of each job
+        self.threads = max(self.cpus // workers, 1)
+        # whatever memory is left is shared as block cache
+        spare = self.memory - workers * largest
+        self.cachemax = int(min(max(spare // workers, MIN_CACHE), MAX_CACHE))
+        return self.workers, self.threads, self.cachemax
+
+    def executor(self, job_memory):
+        """create a process pool sized for the given jobs.
+        """
+        self.plan(job_memory)
+        return futures.ProcessPoolExecutor(
+            self.workers,
+            initializer=init_worker,
+            initargs=(self.cachemax, self.threads),
+        )
+
+    def submit_all(self, pool, jobs, **kwargs):
+        """submit (memory, cost, fn, args, disk) jobs to pool, longest first.
+
+        Jobs are started in order of decreasing cost (e.g. predicted
+        seconds, see data_conversion.costs). If the longest waiting job
+        doesn't fit into the memory budget or onto disk, the longest one
+        that does is started instead, so that memory heavy jobs are packed
+        next to small ones. A job larger than the whole memory budget is
+        started when nothing else runs, but no job is started while its
+        output doesn't fit onto disk (free space is polled every
+        DISK_POLL_INTERVAL seconds). Blocks until all jobs are submitted.
+
+        disk ... dict of directory: bytes the job writes at most (see
+                 estimate_layer_disk)
+
+        returns list of futures in the same order as jobs
+        """
+        waiting = sorted(range(len(jobs)), key=lambda idx: -jobs[idx][1])
+        results = [None] * len(jobs)
+        while waiting:
+            with self._cond:
+                while True:
+                    free = {}
+                    fits = [
+                        idx for idx in waiting
+                        if self._fits(jobs[idx][0], jobs[idx][4], free)
+                    ]
+                    if fits:
+                        break
+                    self._cond.wait(DISK_POLL_INTERVAL)
+                idx = fits[0]
+                waiting.remove(idx)
+                memory = jobs[idx][0] + self.cachemax
+                disk = self._reserve(jobs[idx][4])
+                self._used += memory
+            _, _, fn, args, _ = jobs[idx]
+            try:
+                future = pool.submit(fn, *args, **kwargs)
+            except Exception:
+                self._release(memory, disk)
+                raise
+            # give back memory and disk space as soon as the job is done
+            future.add_done_callback(
+                lambda _, memory=memory, disk=disk: self._release(memory, disk)
+            )
+            results[idx] = future
+        return results
+
+    def _fits(self, memory, disk, free):
+        """whether a job fits next to the running ones.
+
+        free ... cache of free space per device for this check
+        """
+        # a job larger than the memory budget is started when nothing else
+        # runs, disk space is checked regardless
+        if self._used and self._used + memory + self.cachemax > self.memory:
+            return False
+        needed = {}
+        for path, size in disk.items():
+            dev, existing = filesystem(path)
+            if dev not in free:
+                free[dev] = free_space(existing)
+            needed[dev] = needed.get(dev, 0) + size
+        # space written by running jobs is counted twice (it isn't free
+        # anymore and still reserved), so this errs on the safe side
+        return all(
+            free[dev] - self._disk.get(dev, 0) - size >= self.disk_headroom
+            for dev, size in needed.items()
+        )
+
+    def _reserve(self, disk):
+        """reserve disk space of a job, returns bytes per device.
+        """
+        reserved = {}
+        for path, size in disk.items():
+            dev, _ = filesystem(path)
+            reserved[dev] = reserved.get(dev, 0) + size
+        for dev, size in reserved.items():
+            self._disk[dev] = self._disk.get(dev, 0) + size
+        return reserved
+
+    def _release(self, memory, disk=None):
+        with self._cond:
+            self._used -= memory
+            for dev, size in (disk or {}).items():
+                self._disk[dev] -= size
+            self._cond.notify_all()
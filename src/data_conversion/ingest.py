@@ -0,0 +1,307 @@
+"""Convert source archives of collections as they arrive.
+
+New source archives (e.g. a new model for WorldClim) arrive over days.
+Instead of converting whole collections again, ingest polls the source
+folders of collections (see runner.COLLECTIONS) and, once an archive has
+settled (its mtime and size didn't change for a while), runs the job graph
+of the runner for just the new or changed archives (all archives of
+collections whose archives share a target dir): convert them, update
+data.json and datasets.json for the changed layers
+(generate_layer_metadata.py --update) and sync the collection to swift.
+
+Ingested archives are recorded with their mtime and size in a state file
+(CONVERSION_INGEST_STATE, defaults to ~/.cache/data_conversion/ingest.json).
+Without state file, existing archives are taken as converted already
+unless --convert-existing is given. Archives which failed are tried again
+when they change or after --retry seconds.
+
+usage:
+
+    python -m data_conversion.ingest --root . --settle 300 worldclim
+"""
+import argparse
+import json
+import os
+import os.path
+import sys
+import time
+
+from data_conversion.runner import (
+    COLLECTIONS, DONE, Runner, collection_sources, collection_tasks
+)
+
+
+def state_path():
+    """path of ingest state file.
+    """
+    path = os.environ.get('CONVERSION_INGEST_STATE')
+    if path:
+        return path
+    return os.path.expanduser(
+        os.path.join('~', '.cache', 'data_conversion', 'ingest.json')
+    )
+
+
+def archive_signature(path):
+    """[mtime, size] of archive at path or None if it is gone.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class Watcher(object):
+    """Tell which files have settled.
+
+    A file has settled once its mtime and size didn't change for settle
+    seconds, either between polls or because it was last modified longer
+    ago than that.
+    """
+
+    def __init__(self, settle=300):
+        self.settle = settle
+        # path: (signature, time the signature was first seen)
+        self._seen = {}
+
+    def poll(self, paths):
+        """returns dict of path: signature of settled paths.
+        """
+        now = time.time()
+        seen = {}
+        settled = {}
+        for path in paths:
+            signature = archive_signature(path)
+            if signature is None:
+                continue
+            previous = self._seen.get(path)
+            if previous is not None and previous[0] == signature:
+                since = previous[1]
+            else:
+                since = min(now, signature[0] / 1e9)
+            seen[path] = (signature, since)
+            if now - since >= self.settle:
+                settled[path] = signature
+        # forget files which disappeared
+        self._seen = seen
+        return settled
+
+
+class Ingest(object):
+    """Convert new and changed archives of collections.
+
+    state ... {'ingested': {path: signature},
+               'failed': {path: [signature, time]}}
+    """
+
+    def __init__(self, root, names, runner, settle=300, retry=3600,
+                 convert_slots=1, upload=True, state=None):
+        self.root = root
+        self.names = names
+        self.runner = runner
+        self.watcher = Watcher(settle)
+        self.retry = retry
+        self.convert_slots = convert_slots
+        self.upload = upload
+        self.state_file = state or state_path()
+        self.state = self.load()
+
+    def load(self):
+        """read state file, returns None if there is none.
+        """
+        if not os.path.exists(self.state_file):
+            return None
+        with open(self.state_file, 'r') as sfile:
+            return json.load(sfile)
+
+    def save(self):
+        """write state file (atomically, the ingest may be killed).
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)),
+                    exist_ok=True)
+        tmpname = self.state_file + '.partial'
+        with open(tmpname, 'w') as sfile:
+            json.dump(self.state, sfile, indent=2)
+        os.replace(tmpname, self.state_file)
+
+    def sources(self):
+        """dict of collection name: list of source archives.
+        """
+        return {
+            name: collection_sources(COLLECTIONS[name], self.root)
+            for name in self.names
+        }
+
+    def baseline(self):
+        """take all existing archives as ingested.
+        """
+        self.state = {'ingested': {}, 'failed': {}}
+        for paths in self.sources().values():
+            for path in paths:
+                signature = archive_signature(path)
+                if signature is not None:
+                    self.state['ingested'][path] = signature
+        self.save()
+        print('Recorded {} existing archives as converted'.format(
+            len(self.state['ingested'])))
+
+    def pending(self, paths):
+        """settled archives among paths which are new or changed.
+
+        returns list of (path, signature)
+        """
+        now = time.time()
+        pending = []
+        for path, signature in sorted(self.watcher.poll(paths).items()):
+            if self.state['ingested'].get(path) == signature:
+                continue
+            failed = self.state['failed'].get(path)
+            if (failed and failed[0] == signature and
+                    now - failed[1] < self.retry):
+                continue
+            pending.append((path, signature))
+        return pending
+
+    def run_once(self):
+        """convert pending archives of all collections.
+
+        returns (ingested, failed) lists of archives
+        """
+        if self.state is None:
+            self.state = {'ingested': {}, 'failed': {}}
+        tasks = {}
+        for name, paths in self.sources().items():
+            pending = self.pending(paths)
+            if not pending:
+                continue
+            print('{}: {} new or changed archives'.format(name, len(pending)))
+            tasks[name] = (pending, collection_tasks(
+                name, COLLECTIONS[name], self.root, self.convert_slots,
+                upload=self.upload, sources=[path for path, _ in pending],
+                update=True
+            ))
+        if not tasks:
+            return [], []
+        self.runner.run([
+            task for _, ctasks in tasks.values() for task in ctasks
+        ])
+        ingested = []
+        failed = []
+        for pending, ctasks in tasks.values():
+            # metadata and upload of the collection have to succeed as well,
+            # otherwise the archive is tried again later (see retry)
+            finished = all(
+                task.state == DONE for task in ctasks
+                if task.stage != 'convert'
+            )
+            converted = {
+                source: task.state == DONE
+                for task in ctasks if task.stage == 'convert'
+                for source in task.sources
+            }
+            # signature as polled, the archive may have changed meanwhile
+            for path, signature in pending:
+                if finished and converted.get(path):
+                    self.state['ingested'][path] = signature
+                    self.state['failed'].pop(path, None)
+                    ingested.append(path)
+                else:
+                    self.state['failed'][path] = [signature, time.time()]
+                    failed.append(path)
+        self.save()
+        return ingested, failed
+
+    def run(self, interval=60):
+        """poll for new archives forever.
+        """
+        while True:
+            ingested, failed = self.run_once()
+            for path in ingested:
+                print('Ingested {}'.format(path))
+            for path in failed:
+                print('Failed to ingest {}'.format(path))
+            time.sleep(interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=('Watch source folders of collections and convert new '
+                     'or changed archives as they arrive')
+    )
+    parser.add_argument(
+        'collections', nargs='*',
+        help='collections to watch: {} (default all)'.format(
+            ', '.join(sorted(COLLECTIONS)))
+    )
+    parser.add_argument(
+        '--root', action='store', default='.',
+        help='data_conversion checkout with the collection folders'
+    )
+    parser.add_argument(
+        '--interval', action='store', type=int, default=60,
+        help='seconds between polls of the source folders'
+    )
+    parser.add_argument(
+        '--settle', action='store', type=int, default=300,
+        help=('seconds an archive has to stay unchanged before it is '
+              'converted')
+    )
+    parser.add_argument(
+        '--retry', action='store', type=int, default=3600,
+        help='seconds before an unchanged archive which failed is tried again'
+    )
+    parser.add_argument(
+        '--once', action='store_true',
+        help='convert pending archives once and exit'
+    )
+    parser.add_argument(
+        '--convert-existing', action='store_true',
+        help='convert existing archives as well on the first run'
+    )
+    parser.add_argument(
+        '--slots', action='store', type=int,
+        help='number of cpus to use (default all)'
+    )
+    parser.add_argument(
+        '--convert-slots', action='store', type=int,
+        help='cpus per conversion task (default half of all)'
+    )
+    parser.add_argument(
+        '--no-upload', action='store_true',
+        help='skip uploads to swift'
+    )
+    parser.add_argument(
+        '--logdir', action='store',
+        help='write output of each task to a log file in this folder'
+    )
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    for name in opts.collections:
+        if name not in COLLECTIONS:
+            raise Exception('Unknown collection {}'.format(name))
+    runner = Runner(slots=opts.slots, logdir=opts.logdir)
+    ingest = Ingest(
+        os.path.abspath(opts.root), opts.collections or sorted(COLLECTIONS),
+        runner, settle=opts.settle, retry=opts.retry,
+        convert_slots=opts.convert_slots or max(runner.slots // 2, 1),
+        upload=not opts.no_upload
+    )
+    if ingest.state is None and not opts.convert_existing:
+        ingest.baseline()
+    if not opts.once:
+        ingest.run(opts.interval)
+    ingested, failed = ingest.run_once()
+    for path in ingested:
+        print('Ingested {}'.format(path))
+    for path in failed:
+        print('Failed to ingest {}'.format(path))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
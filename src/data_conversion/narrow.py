@@ -0,0 +1,139 @@
+"""Lossless data type narrowing for converted layers.
+
+Many layers are stored in wider data types than their values need. The
+functions here pick the narrowest data type that can hold all values (and
+the nodata value) exactly, based on statistics collected while writing or
+scanning a layer (see data_conversion.calc.RasterStats).
+
+Layers are narrowed before overviews are built (see narrow_raster), so
+that overviews are resampled from the values which are stored in the end.
+"""
+import numpy as np
+from osgeo import gdal
+
+from data_conversion.calc import raster_calc, compute_stats
+from data_conversion.utils import open_gdal_dataset
+from data_conversion.vocabs import PREDICTORS
+
+
+# integer data types ordered from narrowest to widest with their value range
+INTEGER_TYPES = [
+    (gdal.GDT_Byte, 0, 255),
+    (gdal.GDT_Int16, -32768, 32767),
+    (gdal.GDT_UInt16, 0, 65535),
+    (gdal.GDT_Int32, -2147483648, 2147483647),
+]
+
+
+def is_integer_type(datatype):
+    return datatype in [dt for dt, _, _ in INTEGER_TYPES] + [gdal.GDT_UInt32]
+
+
+def _fits(value, vmin, vmax):
+    return value is not None and float(value).is_integer() and vmin <= value <= vmax
+
+
+def _pick_nodata(rstats, vmin, vmax):
+    # find a nodata value outside the range of valid values
+    if rstats.maximum < vmax:
+        return vmax
+    if rstats.minimum > vmin:
+        return vmin
+    return None
+
+
+def narrowest_datatype(rstats, datatype, nodata=None, adjust_nodata=False,
+                       keep_kind=False):
+    """Find narrowest data type that stores all values exactly.
+
+    rstats   ... RasterStats of layer
+    datatype ... current gdal data type
+    nodata   ... current nodata value
+    adjust_nodata ... if False, only data types that can hold the current
+                      nodata value are considered. If True a new nodata
+                      value may be chosen, in which case nodata pixels
+                      need to be rewritten (see narrow_raster)
+    keep_kind ... never convert float layers to integer types
+
+    Float layers with NaN or infinite values which are not nodata (see
+    RasterStats.nonfinite) are never converted to integer types, as those
+    values have no integer representation.
+
+    returns (datatype, nodata) tuple
+    """
+    if not rstats.count:
+        # no valid data at all, nothing sensible to decide on
+        return datatype, nodata
+    if (rstats.integral and not rstats.nonfinite
+            and not (keep_kind and not is_integer_type(datatype))):
+        for dt, vmin, vmax in INTEGER_TYPES:
+            if rstats.minimum < vmin or rstats.maximum > vmax:
+                continue
+            if nodata is None or _fits(nodata, vmin, vmax):
+                return _if_narrower(datatype, nodata, dt, nodata)
+            if adjust_nodata:
+                new_nodata = _pick_nodata(rstats, vmin, vmax)
+                if new_nodata is not None:
+                    return _if_narrower(datatype, nodata, dt, new_nodata)
+    if datatype == gdal.GDT_Float64 and rstats.float32_exact:
+        # float32 can't represent every value within range exactly, so
+        # nodata needs to round trip as well
+        if nodata is None or float(np.float32(nodata)) == nodata:
+            return gdal.GDT_Float32, nodata
+    return datatype, nodata
+
+
+def _if_narrower(datatype, nodata, new_datatype, new_nodata):
+    # only switch if it actually saves space, or turns floats into integers
+    # which compress better with the integer predictor
+    if (gdal.GetDataTypeSize(new_datatype) < gdal.GetDataTypeSize(datatype)
+            or (not is_integer_type(datatype) and is_integer_type(new_datatype))):
+        return new_datatype, new_nodata
+    return datatype, nodata
+
+
+def narrow_raster(src, dest, rstats=None, creation_options=None):
+    """Rewrite src into dest using the narrowest exact data type.
+
+    Statistics are computed from src if rstats is not given. The nodata
+    value is adjusted if the original one does not fit into the narrower
+    type. Band and dataset metadata, scale and offset are copied over.
+
+    returns new datatype or None if src can't be narrowed (dest is not
+    written in this case)
+    """
+    srcds = open_gdal_dataset(src)
+    if srcds is None:
+        raise Exception('Could not open {}'.format(src))
+    srcband = srcds.GetRasterBand(1)
+    if rstats is None:
+        rstats = compute_stats(srcband)
+    nodata = srcband.GetNoDataValue()
+    datatype, new_nodata = narrowest_datatype(
+        rstats, srcband.DataType, nodata, adjust_nodata=True
+    )
+    if datatype == srcband.DataType:
+        return None
+    if creation_options is None:
+        creation_options = ['TILED=YES', 'COMPRESS=DEFLATE']
+    creation_options = [
+        opt for opt in creation_options if not opt.upper().startswith('PREDICTOR=')
+    ]
+    creation_options.append('PREDICTOR={}'.format(PREDICTORS[datatype]))
+    raster_calc('A', {'A': src}, dest, datatype=datatype, nodata=new_nodata,
+                creation_options=creation_options)
+    # copy metadata over
+    ds = gdal.Open(dest, gdal.GA_Update)
+    band = ds.GetRasterBand(1)
+    ds.SetMetadata(srcds.GetMetadata())
+    band.SetMetadata(srcband.GetMetadata())
+    band.SetScale(srcband.GetScale() or 1.0)
+    band.SetOffset(srcband.GetOffset() or 0.0)
+    if srcband.GetUnitType():
+        band.SetUnitType(srcband.GetUnitType())
+    # statistics have been reset with band metadata, restore them
+    rstats.apply(band)
+    ds.FlushCache()
+    del band
+    del ds
+    return datatype
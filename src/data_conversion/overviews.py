@@ -0,0 +1,47 @@
+"""Internal overview pyramids for converted layers.
+
+Overviews have to be built on the intermediate file before the final
+gdal_translate with COPY_SRC_OVERVIEWS=YES, which then places them ahead of
+the full resolution data as required for cloud optimised GeoTIFFs.
+"""
+
+# resampling method per vocabulary measure_type
+RESAMPLING = {
+    'continuous': 'AVERAGE',
+    'categorical': 'MODE',
+}
+
+# stop adding overview levels once the overview fits into a tile
+MIN_OVERVIEW_SIZE = 256
+
+
+def overview_levels(xsize, ysize, min_size=MIN_OVERVIEW_SIZE):
+    """list of overview decimation factors for a raster of given size.
+    """
+    levels = []
+    factor = 2
+    # the previous level does not fit into a tile yet
+    while max(xsize, ysize) / (factor // 2) > min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def build_overviews(ds, measure_type=None):
+    """build internal overviews for open (updatable) dataset.
+
+    measure_type ... vocabulary measure_type of layer; continuous layers are
+                     averaged, categorical layers use the most common value
+                     so that no new category values are invented, anything
+                     else uses nearest neighbour
+
+    returns list of overview levels built
+    """
+    levels = overview_levels(ds.RasterXSize, ds.RasterYSize)
+    if not levels:
+        return levels
+    resampling = RESAMPLING.get(measure_type, 'NEAREST')
+    if ds.BuildOverviews(resampling, levels) != 0:
+        raise Exception('Could not build overviews for {}'.format(
+            ds.GetDescription()))
+    return levels
@@ -0,0 +1,247 @@
+"""Package converted datasets as zip files.
+
+Files are written in this process straight into the zip file. Rasters that
+are already compressed (e.g. DEFLATE or LZW GeoTIFFs) are stored as they
+are, compressing them again costs a lot of time and gains almost nothing.
+Everything else (metadata.json, uncompressed rasters, ...) is deflated.
+Zip files larger than 4GB are written as ZIP64. Single members of existing
+zip files (e.g. bccvl/metadata.json) can be replaced without rewriting the
+whole archive.
+
+DatasetPackager moves layers into the zip files of their datasets as soon
+as their conversion job is done, so that the datasets are never staged on
+disk as a whole.
+"""
+import fnmatch
+import os
+import os.path
+import shutil
+import zipfile
+
+from osgeo import gdal
+
+from data_conversion.publish import discard, partial_path, publish
+
+
+# raster formats which may carry internal compression
+RASTER_EXTENSIONS = ('.tif', '.tiff')
+
+# formats which are compressed anyway
+COMPRESSED_EXTENSIONS = ('.gz', '.zip', '.png', '.jpg', '.jpeg')
+
+
+def is_compressed(path):
+    """whether file at path is compressed already.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in COMPRESSED_EXTENSIONS:
+        return True
+    if ext in RASTER_EXTENSIONS:
+        ds = gdal.Open(path)
+        if ds is None:
+            return False
+        compression = ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE')
+        return compression not in (None, 'NONE')
+    return False
+
+
+class DatasetZip(object):
+    """Zip file which dataset files are added to as soon as they are done.
+
+    usage:
+
+        with DatasetZip('bccvl/dataset.zip') as dszip:
+            dszip.write('/tmp/layer.tif', 'dataset/data/layer.tif')
+            dszip.writestr('dataset/bccvl/metadata.json', json.dumps(md))
+    """
+
+    def __init__(self, zipname):
+        self.zipname = zipname
+        self._zip = zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED,
+                                    allowZip64=True)
+        self._dirs = set()
+
+    def write(self, path, arcname):
+        """add file (or directory entry) at path as arcname.
+        """
+        if os.path.isdir(path):
+            if arcname.rstrip('/') not in self._dirs:
+                self._dirs.add(arcname.rstrip('/'))
+                self._zip.write(path, arcname)
+            return
+        if is_compressed(path):
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        self._zip.write(path, arcname, compress_type)
+
+    def writestr(self, arcname, data):
+        """add data (str or bytes) as arcname.
+        """
+        self._zip.writestr(arcname, data, zipfile.ZIP_DEFLATED)
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def zip_directory(ziproot, dest, exclude=()):
+    """zip folder ziproot into dest/<basename of ziproot>.zip.
+
+    Paths in the zip file start with the basename of ziproot. Files
+    matching any of the glob patterns in exclude are skipped.
+
+    returns path to zip file
+    """
+    ziproot = os.path.abspath(ziproot)
+    workdir = os.path.dirname(ziproot)
+    zipname = os.path.abspath(
+        os.path.join(dest, os.path.basename(ziproot) + '.zip')
+    )
+    try:
+        with DatasetZip(zipname) as dszip:
+            for root, dirs, files in os.walk(ziproot):
+                dirs.sort()
+                dszip.write(root, os.path.relpath(root, workdir))
+                for name in sorted(files):
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+                        continue
+                    path = os.path.join(root, name)
+                    dszip.write(path, os.path.relpath(path, workdir))
+    except Exception:
+        if os.path.exists(zipname):
+            os.remove(zipname)
+        raise Exception("can't zip {0}".format(ziproot))
+    return zipname
+
+
+def replace_member(zipname, arcname, data):
+    """replace (or add) member arcname in existing zip file with data.
+
+    The new member is appended and only the central directory is
+    rewritten, without the entry of the old member. The old member's data
+    stays in the file as unreferenced bytes, which is fine for small files
+    like metadata.json.
+    """
+    with zipfile.ZipFile(zipname, 'a', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as zipf:
+        # drop old entry, so that it is not written to the central directory
+        zipf.filelist = [
+            info for info in zipf.filelist if info.filename != arcname
+        ]
+        zipf.NameToInfo.pop(arcname, None)
+        zipf.writestr(arcname, data, zipfile.ZIP_DEFLATED)
+
+
+class DatasetPackager(object):
+    """Package datasets while their layers are converted.
+
+    Layers are still converted into the folder of their dataset, but each
+    one is moved into the dataset's zip file as soon as its job is done.
+    The folder only holds the layers in progress instead of the whole
+    dataset. Files left in the folder when the dataset is closed
+    (bccvl/metadata.json) are added last. Zip files are written as
+    .partial and published when complete (see data_conversion.publish).
+
+    usage:
+
+        packager = DatasetPackager()
+        packager.open(dsdir, destdir)
+        run_jobs(jobs, on_done=packager.add)
+        gen_metadatajson(template, dsdir, packager.layers(dsdir))
+        packager.close(dsdir)
+    """
+
+    def __init__(self):
+        # dsdir: (DatasetZip, zipname, layers)
+        self._datasets = {}
+
+    def open(self, dsdir, destdir):
+        """start zip file destdir/<basename of dsdir>.zip for dataset dsdir.
+
+        Paths in the zip file start with the basename of dsdir.
+        """
+        dsdir = os.path.abspath(dsdir)
+        zipname = os.path.abspath(
+            os.path.join(destdir, os.path.basename(dsdir) + '.zip')
+        )
+        dszip = DatasetZip(partial_path(zipname))
+        self._datasets[dsdir] = (dszip, zipname, [])
+
+    def _dataset(self, path):
+        for dsdir in self._datasets:
+            if path.startswith(dsdir + os.path.sep):
+                return dsdir
+        raise Exception('{} is not part of an open dataset'.format(path))
+
+    def _write_dirs(self, dsdir, path):
+        # directory entries of path first, as zip_directory writes them
+        dszip = self._datasets[dsdir][0]
+        workdir = os.path.dirname(dsdir)
+        parent = os.path.dirname(path)
+        parents = []
+        while parent != workdir:
+            parents.append(parent)
+            parent = os.path.dirname(parent)
+        for parent in reversed(parents):
+            dszip.write(parent, os.path.relpath(parent, workdir))
+
+    def add(self, path):
+        """move finished layer at path into the zip file of its dataset.
+        """
+        path = os.path.abspath(path)
+        dsdir = self._dataset(path)
+        self._write_dirs(dsdir, path)
+        self._datasets[dsdir][0].write(
+            path, os.path.relpath(path, os.path.dirname(dsdir))
+        )
+        os.remove(path)
+        self._datasets[dsdir][2].append(path)
+
+    def layers(self, dsdir):
+        """paths of layers added to dataset dsdir so far (they don't exist
+        anymore).
+        """
+        return sorted(self._datasets[os.path.abspath(dsdir)][2])
+
+    def close(self, dsdir):
+        """add remaining files of dsdir, publish the zip file and remove
+        dsdir.
+
+        returns path to zip file
+        """
+        dsdir = os.path.abspath(dsdir)
+        dszip = self._datasets[dsdir][0]
+        workdir = os.path.dirname(dsdir)
+        try:
+            for root, dirs, files in os.walk(dsdir):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    self._write_dirs(dsdir, path)
+                    with open(path, 'rb') as mdfile:
+                        dszip.writestr(os.path.relpath(path, workdir),
+                                       mdfile.read())
+            dszip.close()
+        except Exception:
+            dszip.close()
+            discard(dszip.zipname)
+            raise Exception("can't zip {0}".format(dsdir))
+        finally:
+            zipname = self._datasets.pop(dsdir)[1]
+        publish(dszip.zipname, zipname)
+        shutil.rmtree(dsdir)
+        return zipname
+
+    def abort(self):
+        """discard zip files of all open datasets.
+        """
+        for dszip, _, _ in self._datasets.values():
+            dszip.close()
+            discard(dszip.zipname)
+        self._datasets = {}
@@ -0,0 +1,125 @@
+"""Run layer conversions of a collection in parallel.
+
+Shared conversion engine for converters which turn many source layers into
+GeoTIFFs. Layers are converted with in-process GDAL calls in a process pool
+sized by ResourceGovernor, instead of one gdal_translate subprocess after
+the other.
+
+usage:
+
+    jobs = [
+        (estimate_layer_memory(src), translate_layer, (src, dest))
+        for src, dest in layers
+    ]
+    run_jobs(jobs)
+"""
+import os
+import os.path
+from concurrent import futures
+
+from osgeo import gdal
+
+from data_conversion.calc import scale_raster
+from data_conversion.costs import plan_jobs
+from data_conversion.governor import ResourceGovernor, estimate_layer_disk
+
+
+# gdal_translate options used by legacy converters
+DEFAULT_TRANSLATE_OPTIONS = [
+    '-of', 'GTiff', '-co', 'COMPRESS=LZW', '-co', 'TILED=YES'
+]
+
+
+def translate_layer(src, dest, options=None, threads=1):
+    """gdal_translate src to dest in this process.
+
+    options ... gdal_translate argument list (defaults to
+                DEFAULT_TRANSLATE_OPTIONS)
+    threads ... number of threads to compress blocks with
+    """
+    if options is None:
+        options = DEFAULT_TRANSLATE_OPTIONS
+    options = list(options) + ['-co', 'NUM_THREADS={}'.format(threads)]
+    ds = gdal.Translate(dest, src, options=options)
+    if ds is None:
+        raise Exception("can't gdal_translate {0}".format(src))
+    ds.FlushCache()
+    del ds
+
+
+def scale_layer(src, dest, factor, metadata_only=False,
+                datatype=gdal.GDT_Float64, creation_options=None, threads=1):
+    """scale src by factor and write result to dest (see scale_raster).
+    """
+    if creation_options is None:
+        creation_options = ['COMPRESS=LZW', 'TILED=YES']
+    scale_raster(
+        src, dest, factor, metadata_only=metadata_only, datatype=datatype,
+        creation_options=creation_options, num_threads=threads
+    )
+
+
+def job_disk(fn, args):
+    """estimate disk space of a job (see estimate_layer_disk).
+    """
+    src, dest = args[:2]
+    datatype = None
+    if fn is scale_layer:
+        # scaled pixels are rewritten in a wider type unless only metadata
+        # changes
+        metadata_only = args[3] if len(args) > 3 else False
+        if not metadata_only:
+            datatype = args[4] if len(args) > 4 else gdal.GDT_Float64
+    return estimate_layer_disk(src, dest, scratch=False, datatype=datatype)
+
+
+def default_collection():
+    """collection name for cost history, legacy converters are run from
+    their collection folder.
+    """
+    return os.environ.get('CONVERSION_COLLECTION',
+                          os.path.basename(os.getcwd()))
+
+
+def run_jobs(jobs, governor=None, collection=None, on_done=None):
+    """run conversion jobs in parallel as far as cores and memory allow.
+
+    jobs ... list of (memory, fn, args) tuples, fn is called in a worker
+             process as fn(*args, threads=n); memory is the estimated
+             memory of the job (see governor.estimate_layer_memory), the
+             first two arguments are the source layer and destination
+
+    Longest jobs (predicted from earlier runs of collection, see
+    data_conversion.costs) are started first. All jobs are run, even if
+    some of them fail. The first error is raised afterwards.
+
+    on_done ... called with the destination of each job which succeeded,
+                as soon as it is done (e.g. DatasetPackager.add)
+    """
+    if not jobs:
+        return
+    if governor is None:
+        governor = ResourceGovernor()
+    if collection is None:
+        collection = default_collection()
+    planned = plan_jobs(collection, [
+        (memory, args[0], fn, args, job_disk(fn, args))
+        for memory, fn, args in jobs
+    ])
+    errors = []
+    with governor.executor([job[0] for job in planned]) as pool:
+        results = governor.submit_all(pool, planned, threads=governor.threads)
+        # planned jobs pass (collection, features, fn) + args to the worker
+        dests = dict(zip(results, (job[3][4] for job in planned)))
+        for result in futures.as_completed(results):
+            if result.exception():
+                print("Job failed: {}".format(result.exception()))
+                errors.append(result.exception())
+            elif on_done is not None:
+                try:
+                    on_done(dests[result])
+                except Exception as e:
+                    print("Job failed: {}".format(e))
+                    errors.append(e)
+    if errors:
+        raise errors[0]
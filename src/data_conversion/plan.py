@@ -0,0 +1,153 @@
+"""Dry run planning of conversions (the --plan mode of converters).
+
+Lists the layers a conversion would produce with estimated sizes and
+runtimes, without converting anything. Only central directories of source
+archives are read, nothing is decompressed, so planning a whole collection
+takes seconds even if the archives are on slow storage.
+
+Estimates per layer:
+
+- input bytes:   compressed size of the layer's files in the source archive
+- raster bytes:  uncompressed size of the layer's data file
+- output bytes:  about the compressed input size (output layers are
+                 DEFLATE compressed like the zip members)
+- scratch bytes: intermediate raster on disk if too large for memory (see
+                 data_conversion.scratch)
+- seconds:       from the cost model (see data_conversion.costs), unknown
+                 without history
+
+Layers whose output is newer than their source archive are flagged as up
+to date.
+"""
+import os
+import os.path
+import zipfile
+
+from data_conversion.costs import CostModel
+from data_conversion.governor import ResourceGovernor
+from data_conversion.scratch import kept_in_memory
+
+
+def layer_members(infolist, name):
+    """ZipInfos of all files of the layer at member name.
+
+    ESRI grids (a folder or a .adf file in it) consist of all files in
+    their folder, other layers of all files with the same stem (e.g.
+    .asc and .prj).
+    """
+    name = name.rstrip('/')
+    if name.endswith('.adf') or any(
+            info.is_dir() and info.filename.rstrip('/') == name
+            for info in infolist):
+        folder = name if not name.endswith('.adf') else os.path.dirname(name)
+        return [
+            info for info in infolist
+            if not info.is_dir() and os.path.dirname(info.filename) == folder
+        ]
+    stem = os.path.splitext(name)[0]
+    return [
+        info for info in infolist
+        if info.filename == name or info.filename.startswith(stem + '.')
+    ]
+
+
+def plan_archive(collection, srcfile, layers, model=None):
+    """estimate conversion of layers in srcfile.
+
+    layers ... list of (member, destpath) tuples, member is the name of the
+               layer in the zip file
+
+    returns list of dicts, one per layer
+    """
+    if model is None:
+        model = CostModel()
+    src_mtime = os.path.getmtime(srcfile)
+    with zipfile.ZipFile(srcfile) as srczip:
+        infolist = srczip.infolist()
+    rows = []
+    for member, destpath in layers:
+        members = layer_members(infolist, member)
+        if not members:
+            continue
+        data = max(members, key=lambda info: info.file_size)
+        raster_bytes = data.file_size
+        rows.append({
+            'src': '{}/{}'.format(srcfile, member),
+            'dest': destpath,
+            'input_bytes': sum(info.compress_size for info in members),
+            'raster_bytes': raster_bytes,
+            'output_bytes': data.compress_size,
+            'scratch_bytes': 0 if kept_in_memory(raster_bytes) else raster_bytes,
+            'seconds': model.predict_bytes(collection, raster_bytes),
+            'uptodate': (os.path.exists(destpath) and
+                         os.path.getmtime(destpath) >= src_mtime),
+        })
+    return rows
+
+
+def format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            return '{:.1f}{}'.format(nbytes, unit)
+        nbytes /= 1024.0
+    return '{:.1f}TB'.format(nbytes)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def makespan(seconds, workers):
+    """wall time to run jobs of given seconds longest first on workers.
+    """
+    finish = [0.0] * max(workers, 1)
+    for job in sorted(seconds, reverse=True):
+        idx = finish.index(min(finish))
+        finish[idx] += job
+    return max(finish)
+
+
+def print_plan(rows, workers=None):
+    """print planned layers and totals.
+
+    workers ... number of layers converted in parallel (defaults to
+                number of cpus of ResourceGovernor)
+    """
+    if workers is None:
+        workers = ResourceGovernor().cpus
+    print('{:>10} {:>10} {:>10} {:>10} {:>9}  {}'.format(
+        'input', 'raster', 'output', 'scratch', 'time', 'layer'))
+    for row in rows:
+        print('{:>10} {:>10} {:>10} {:>10} {:>9}  {}{}'.format(
+            format_bytes(row['input_bytes']),
+            format_bytes(row['raster_bytes']),
+            format_bytes(row['output_bytes']),
+            format_bytes(row['scratch_bytes']),
+            format_seconds(row['seconds']),
+            row['dest'],
+            ' (up to date)' if row['uptodate'] else '',
+        ))
+    print('{} layers, {} up to date'.format(
+        len(rows), len([row for row in rows if row['uptodate']])))
+    # largest intermediate files may exist at the same time
+    scratch = sorted((row['scratch_bytes'] for row in rows), reverse=True)
+    print('input {}, output {}, scratch {} (peak with {} workers)'.format(
+        format_bytes(sum(row['input_bytes'] for row in rows)),
+        format_bytes(sum(row['output_bytes'] for row in rows)),
+        format_bytes(sum(scratch[:workers])),
+        workers,
+    ))
+    # up to date layers are converted as well, but not published again
+    seconds = [row['seconds'] for row in rows]
+    if rows and None not in seconds:
+        print('cpu time {}, wall time about {} with {} workers'.format(
+            format_seconds(sum(seconds)),
+            format_seconds(makespan(seconds, workers)),
+            workers,
+        ))
+    else:
+        print('runtime unknown (no cost history)')
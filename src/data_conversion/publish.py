@@ -0,0 +1,165 @@
+"""Publish converted layers atomically.
+
+Layers are written as <name>.partial next to their final location and
+renamed to <name> once complete. The rename happens within one directory
+(and so one filesystem), which is atomic: a file in the destination is
+either the previous version or the complete new one, never half written,
+and nothing has to be copied between a work dir and the destination.
+
+A crash leaves only *.partial files behind, which recover() removes before
+the next run.
+
+If the new file has the same content as the published one, the published
+file is kept as it is, so that its mtime doesn't change and it isn't
+uploaded again.
+
+usage:
+
+    with atomic_output(dest) as partial:
+        translate(cmd, src, partial)
+"""
+import contextlib
+import os
+import os.path
+
+from data_conversion.utils import remove_stale_files, same_content
+
+
+PARTIAL_SUFFIX = '.partial'
+
+# sidecar files gdal may write next to a raster
+SIDECAR_SUFFIXES = ('.aux.xml', '.ovr', '.msk')
+
+
+def partial_path(path):
+    """path to write the unfinished version of path to.
+    """
+    return path + PARTIAL_SUFFIX
+
+
+def is_partial(path):
+    """whether path is an unfinished file (or one of its sidecars).
+    """
+    name = os.path.basename(path)
+    if name.endswith(PARTIAL_SUFFIX):
+        return True
+    return any(
+        name.endswith(PARTIAL_SUFFIX + suffix) for suffix in SIDECAR_SUFFIXES
+    )
+
+
+def fsync_path(path):
+    """flush file or directory at path to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def discard(partial):
+    """remove partial and its sidecars.
+    """
+    for name in (partial,) + tuple(partial + suffix for suffix in SIDECAR_SUFFIXES):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def unchanged(partial, path):
+    """whether partial and its sidecars have the same content as path.
+    """
+    for suffix in ('',) + SIDECAR_SUFFIXES:
+        new, old = partial + suffix, path + suffix
+        if os.path.exists(new) != os.path.exists(old):
+            return False
+        if os.path.exists(new) and not same_content(new, old):
+            return False
+    return True
+
+
+def publish(partial, path):
+    """rename finished partial (and its sidecars) to path.
+
+    Sidecars are renamed first, so that path shows up last, and only with
+    its sidecars in place. partial is discarded if path has the same
+    content already.
+
+    returns True if path has been replaced
+    """
+    if not os.path.isfile(partial):
+        raise Exception('Nothing to publish at {}'.format(partial))
+    if unchanged(partial, path):
+        discard(partial)
+        return False
+    fsync_path(partial)
+    for suffix in SIDECAR_SUFFIXES:
+        if os.path.exists(partial + suffix):
+            os.replace(partial + suffix, path + suffix)
+        elif os.path.exists(path + suffix):
+            # sidecar of previous version
+            os.remove(path + suffix)
+    os.replace(partial, path)
+    fsync_path(os.path.dirname(os.path.abspath(path)))
+    return True
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """context manager which yields a path to write path's content to.
+
+    The written file is published as path if the block finishes without
+    error, and discarded otherwise.
+    """
+    partial = partial_path(path)
+    discard(partial)
+    try:
+        yield partial
+        publish(partial, path)
+    except BaseException:
+        discard(partial)
+        raise
+
+
+def recover(root):
+    """crash recovery: remove *.partial files left behind below root.
+
+    Must not run while another converter writes into root.
+
+    returns list of removed files
+    """
+    removed = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            if is_partial(name):
+                path = os.path.join(dirpath, name)
+                os.remove(path)
+                removed.append(path)
+    return removed
+
+
+def remove_stale(root, published):
+    """remove files below root which are not in published (or sidecars of
+    them), e.g. layers dropped from a collection.
+
+    returns list of removed files
+    """
+    keep = []
+    for path in published:
+        keep.append(path)
+        keep.extend(path + suffix for suffix in SIDECAR_SUFFIXES)
+    return remove_stale_files(root, keep)
+
+
+def remove_empty_dirs(path, root):
+    """remove path and its parents up to (excluding) root if they are empty.
+    """
+    path = os.path.abspath(path)
+    root = os.path.abspath(root)
+    while path != root and path.startswith(root + os.path.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            # not empty (or gone)
+            break
+        path = os.path.dirname(path)
@@ -0,0 +1,330 @@
+"""Run convert, metadata and upload stages of collections as one job graph.
+
+Each collection is converted archive by archive (convert_layers.py), then
+its layer metadata is generated (generate_layer_metadata.py) and finally
+the result is uploaded to swift (rclone sync). Stages of all selected
+collections go into one dependency graph, which is run with one global
+budget of cpu slots, so that metadata generation and upload of a finished
+collection overlap with conversion of the next one.
+
+Converters get their share of the budget via CONVERSION_CPUS and
+CONVERSION_MEMORY_BUDGET (see ResourceGovernor).
+
+usage:
+
+    python -m data_conversion.runner --root . worldclim australia-5km
+"""
+import argparse
+import glob
+import os
+import os.path
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from data_conversion.governor import available_memory
+
+
+# path   ... collection folder relative to root
+# sources ... glob pattern of source archives relative to path
+# dest   ... output folder relative to path
+# container ... swift container to upload dest to (None for no upload)
+# shared ... whether archives are converted into the same target dir, they
+#            are converted by one task then (a converter clears unfinished
+#            files of its target dir, which must not happen while another
+#            one writes into it)
+Collection = namedtuple(
+    'Collection', ['path', 'sources', 'dest', 'container', 'shared'],
+    defaults=(False,)
+)
+
+COLLECTIONS = {
+    'worldclim': Collection(
+        'climate/worldclim', 'source/**/*.zip', 'bccvl', 'worldclim_layers'
+    ),
+    'australia-5km': Collection(
+        'climate/australia-5km', 'source/*.zip', 'bccvl/layers',
+        'australia_5km_layers'
+    ),
+    'national-soil-grids': Collection(
+        'environmental/national-soil-grids', 'source/*.zip', 'bccvl',
+        'national_soil_grids', shared=True
+    ),
+}
+
+# rclone remote used for uploads (see upload_to_swift.sh)
+RCLONE_ENV = {
+    'RCLONE_CONFIG_REMOTE_TYPE': 'swift',
+    'RCLONE_CONFIG_REMOTE_ENV_AUTH': 'true',
+}
+
+# task states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+FINISHED = (DONE, FAILED, SKIPPED)
+
+# order in which ready tasks are started, stages which finish a collection
+# go first
+STAGE_PRIORITY = {'upload': 0, 'metadata': 1, 'convert': 2}
+
+
+class Task(object):
+    """One stage of a collection, run as subprocess.
+
+    slots ... share of the cpu budget the task uses
+    cost  ... relative runtime, larger tasks of a stage are started first
+    tolerant ... run once all deps have finished, even if some failed
+    sources ... source archives the task converts
+    """
+
+    def __init__(self, collection, stage, cmd, cwd, deps=(), slots=1,
+                 label=None, cost=0, tolerant=False, sources=()):
+        self.collection = collection
+        self.stage = stage
+        self.cmd = cmd
+        self.cwd = cwd
+        self.deps = list(deps)
+        self.slots = slots
+        self.cost = cost
+        self.tolerant = tolerant
+        self.sources = list(sources)
+        self.name = ':'.join(filter(None, (collection, stage, label)))
+        self.state = PENDING
+        self.returncode = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return '<Task {} {}>'.format(self.name, self.state)
+
+
+def collection_sources(collection, root):
+    """source archives of collection.
+    """
+    cwd = os.path.join(root, collection.path)
+    return sorted(glob.glob(os.path.join(cwd, collection.sources),
+                            recursive=True))
+
+
+def collection_tasks(name, collection, root, convert_slots=1, upload=True,
+                     sources=None, update=False):
+    """build task graph for collection.
+
+    sources ... source archives to convert (defaults to all)
+    update  ... only update metadata of changed layers instead of
+                regenerating all of it; layers of archives which converted
+                fine are updated even if others failed (failed conversions
+                leave published layers untouched)
+
+    returns list of tasks, dependencies before dependents
+    """
+    cwd = os.path.join(root, collection.path)
+    if sources is None:
+        sources = collection_sources(collection, root)
+    if not sources:
+        print('No sources for collection {}'.format(name))
+        return []
+    if collection.shared:
+        # all archives in the source folder at once
+        srcdir = os.path.join(cwd, os.path.dirname(collection.sources))
+        tasks = [
+            Task(name, 'convert',
+                 [sys.executable, 'convert_layers.py', srcdir,
+                  collection.dest],
+                 cwd, slots=convert_slots,
+                 cost=sum(os.path.getsize(source) for source in sources),
+                 sources=sources)
+        ]
+    else:
+        tasks = [
+            Task(name, 'convert',
+                 [sys.executable, 'convert_layers.py', source,
+                  collection.dest],
+                 cwd, slots=convert_slots, label=os.path.relpath(source, cwd),
+                 # larger archives take longer
+                 cost=os.path.getsize(source), sources=[source])
+            for source in sources
+        ]
+    metadata = Task(name, 'metadata',
+                    [sys.executable, 'generate_layer_metadata.py',
+                     '--update' if update else '--force', collection.dest],
+                    cwd, deps=tasks, tolerant=update)
+    tasks.append(metadata)
+    if upload and collection.container:
+        tasks.append(Task(name, 'upload',
+                          ['rclone', 'sync', collection.dest,
+                           'remote:{}'.format(collection.container)],
+                          cwd, deps=[metadata]))
+    return tasks
+
+
+class Runner(object):
+    """Run a task graph within a budget of cpu slots and memory.
+
+    A task starts once all its dependencies are done and its slots fit
+    into the budget. Dependents of failed tasks are skipped, unless they
+    are tolerant.
+    """
+
+    def __init__(self, slots=None, memory=None, logdir=None):
+        if slots is None:
+            slots = os.environ.get('CONVERSION_CPUS')
+            slots = int(slots) if slots else (os.cpu_count() or 1)
+        if memory is None:
+            memory = os.environ.get('CONVERSION_MEMORY_BUDGET')
+            memory = int(memory) if memory else int(available_memory() * 0.8)
+        self.slots = slots
+        self.memory = memory
+        self.logdir = logdir
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def task_env(self, task, slots):
+        """environment for task, sized to its share of the budget.
+        """
+        env = dict(os.environ)
+        env['CONVERSION_CPUS'] = str(slots)
+        env['CONVERSION_MEMORY_BUDGET'] = str(self.memory * slots // self.slots)
+        if task.stage == 'upload':
+            env.update(RCLONE_ENV)
+        return env
+
+    def _run_task(self, task, slots):
+        start = time.time()
+        logfile = None
+        try:
+            if self.logdir:
+                logname = re.sub(r'[^\w.-]+', '_', task.name) + '.log'
+                logfile = open(os.path.join(self.logdir, logname), 'w')
+            ret = subprocess.run(
+                task.cmd, cwd=task.cwd, env=self.task_env(task, slots),
+                stdout=logfile, stderr=subprocess.STDOUT if logfile else None
+            )
+            task.returncode = ret.returncode
+        except OSError as e:
+            print('Task {} failed to start: {}'.format(task.name, e))
+            task.returncode = -1
+        finally:
+            if logfile is not None:
+                logfile.close()
+        task.elapsed = time.time() - start
+        with self._cond:
+            task.state = DONE if task.returncode == 0 else FAILED
+            print('Task {} {} after {:.0f}s'.format(
+                task.name, task.state, task.elapsed))
+            self._used -= slots
+            self._cond.notify_all()
+
+    @staticmethod
+    def ready(task):
+        """whether dependencies of task allow it to start.
+        """
+        states = FINISHED if task.tolerant else (DONE,)
+        return all(dep.state in states for dep in task.deps)
+
+    def run(self, tasks):
+        """run all tasks.
+
+        returns list of tasks which failed or were skipped
+        """
+        if self.logdir:
+            os.makedirs(self.logdir, exist_ok=True)
+        pending = list(tasks)
+        with self._cond:
+            while True:
+                for task in list(pending):
+                    if task.tolerant:
+                        continue
+                    if any(dep.state in (FAILED, SKIPPED) for dep in task.deps):
+                        task.state = SKIPPED
+                        pending.remove(task)
+                        print('Task {} skipped'.format(task.name))
+                ready = sorted(
+                    (task for task in pending if self.ready(task)),
+                    key=lambda task: (STAGE_PRIORITY.get(task.stage, 0),
+                                      -task.cost)
+                )
+                for task in ready:
+                    # tasks larger than the budget run on their own
+                    slots = min(task.slots, self.slots)
+                    if self._used and self._used + slots > self.slots:
+                        continue
+                    self._used += slots
+                    task.state = RUNNING
+                    pending.remove(task)
+                    print('Task {} started'.format(task.name))
+                    threading.Thread(
+                        target=self._run_task, args=(task, slots), daemon=True
+                    ).start()
+                running = any(task.state == RUNNING for task in tasks)
+                if not running and not pending:
+                    break
+                if not running:
+                    # can't happen unless the graph has cycles
+                    raise Exception('Tasks can not be scheduled: {}'.format(
+                        pending))
+                self._cond.wait()
+        return [task for task in tasks if task.state in (FAILED, SKIPPED)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=('Convert, generate metadata and upload collections '
+                     'as one job graph')
+    )
+    parser.add_argument(
+        'collections', nargs='*',
+        help='collections to process: {} (default all)'.format(
+            ', '.join(sorted(COLLECTIONS)))
+    )
+    parser.add_argument(
+        '--root', action='store', default='.',
+        help='data_conversion checkout with the collection folders'
+    )
+    parser.add_argument(
+        '--slots', action='store', type=int,
+        help='number of cpus to use (default all)'
+    )
+    parser.add_argument(
+        '--convert-slots', action='store', type=int,
+        help='cpus per conversion task (default half of all)'
+    )
+    parser.add_argument(
+        '--no-upload', action='store_true',
+        help='skip uploads to swift'
+    )
+    parser.add_argument(
+        '--logdir', action='store',
+        help='write output of each task to a log file in this folder'
+    )
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    root = os.path.abspath(opts.root)
+    runner = Runner(slots=opts.slots, logdir=opts.logdir)
+    convert_slots = opts.convert_slots or max(runner.slots // 2, 1)
+    for name in opts.collections:
+        if name not in COLLECTIONS:
+            raise Exception('Unknown collection {}'.format(name))
+    tasks = []
+    for name in opts.collections or sorted(COLLECTIONS):
+        tasks.extend(collection_tasks(
+            name, COLLECTIONS[name], root, convert_slots,
+            upload=not opts.no_upload
+        ))
+    failed = runner.run(tasks)
+    for task in failed:
+        print('{}: {}'.format(task.state, task.name))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Scratch storage for intermediate rasters.
+
+Intermediate rasters are kept in memory (/vsimem/) when they are small
+enough, which saves writing and re-reading every layer on disk. Larger
+rasters go to a scratch directory on disk.
+
+/vsimem/ files are only visible within the current process, so rasters
+kept there have to be processed with in-process gdal calls (see
+translate). Set CONVERSION_TMPFS to a tmpfs mount (e.g. /dev/shm) to keep
+small rasters in memory but still visible to subprocesses, and
+CONVERSION_SCRATCH to choose the disk scratch directory (defaults to the
+system temp dir). CONVERSION_VSIMEM_LIMIT sets the maximum (uncompressed)
+size in bytes of rasters kept in memory.
+"""
+import os
+import os.path
+import shlex
+import tempfile
+import uuid
+
+from osgeo import gdal
+
+from data_conversion.utils import cached_dataset, retry_run_cmd
+
+
+# maximum uncompressed raster size kept in memory
+VSIMEM_LIMIT = 512 * 1024 * 1024
+
+
+def raster_size(path):
+    """uncompressed size in bytes of all bands of raster at path.
+    """
+    ds = cached_dataset(path)
+    if ds is None:
+        raise Exception('Could not open {}'.format(path))
+    return sum(
+        ds.RasterXSize * ds.RasterYSize *
+        gdal.GetDataTypeSize(ds.GetRasterBand(idx + 1).DataType) // 8
+        for idx in range(ds.RasterCount)
+    )
+
+
+def kept_in_memory(size):
+    """whether an intermediate raster of size bytes is kept in memory.
+    """
+    limit = int(os.environ.get('CONVERSION_VSIMEM_LIMIT', VSIMEM_LIMIT))
+    return size is not None and size <= limit
+
+
+def scratch_dir():
+    """directory of intermediate rasters on disk.
+    """
+    return os.environ.get('CONVERSION_SCRATCH') or tempfile.gettempdir()
+
+
+def scratch_path(size=None, suffix='.tif'):
+    """return path for an intermediate raster of size bytes.
+
+    The path is in memory if size is known and small enough, otherwise on
+    disk. Remove it with remove_scratch when done.
+    """
+    if kept_in_memory(size):
+        tmpfs = os.environ.get('CONVERSION_TMPFS')
+        if tmpfs:
+            fd, path = tempfile.mkstemp(suffix=suffix, dir=tmpfs)
+            os.close(fd)
+            return path
+        return '/vsimem/{}{}'.format(uuid.uuid4().hex, suffix)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=scratch_dir())
+    os.close(fd)
+    return path
+
+
+def remove_scratch(path):
+    """remove intermediate raster created at scratch_path (and sidecars).
+    """
+    if path.startswith('/vsimem/'):
+        for name in (path, path + '.aux.xml', path + '.ovr'):
+            gdal.Unlink(name)
+        return
+    for name in (path, path + '.aux.xml', path + '.ovr'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def translate(cmd, src, dest):
+    """run gdal_translate command line cmd on src and write dest.
+
+    cmd is a gdal_translate argument list (starting with 'gdal_translate')
+    without source and destination. If src or dest is in /vsimem/ the
+    translation runs in this process, otherwise as subprocess.
+    """
+    if not (src.startswith('/vsimem/') or dest.startswith('/vsimem/')):
+        retry_run_cmd(cmd + [src, dest])
+        return
+    # --config options are not supported by gdal.Translate
+    args = []
+    config = {}
+    items = iter(cmd[1:])
+    for arg in items:
+        if arg == '--config':
+            key = next(items)
+            config[key] = next(items)
+        else:
+            args.append(arg)
+    previous = {key: gdal.GetConfigOption(key) for key in config}
+    try:
+        for key, value in config.items():
+            gdal.SetConfigOption(key, value)
+        ds = gdal.Translate(dest, src, options=args)
+        if ds is None:
+            raise Exception('gdal_translate {} {} {} failed'.format(
+                ' '.join(shlex.quote(arg) for arg in args), src, dest))
+        ds.FlushCache()
+        del ds
+    finally:
+        for key, value in previous.items():
+            gdal.SetConfigOption(key, value)
@@ -0,0 +1,128 @@
+"""Recall offline source archives ahead of their conversion.
+
+Source archives may live on tape (HSM) and have to be recalled before they
+can be read. Waiting for each archive just when its conversion starts adds
+up the recall latency of all archives. Stager reads ahead through the list
+of archives and triggers the recall of the next few of them concurrently,
+while the current one is converted. Archives are handed out in order, once
+they are resident.
+
+The recall is triggered by reading the first bytes of a file (and the
+central directory of zip files), which is what HSM systems react to.
+Another recall function (e.g. calling the HSM's recall command) can be
+passed in. CONVERSION_RECALL_AHEAD sets the number of archives recalled
+ahead (default 4).
+
+usage:
+
+    with Stager(srczips) as stager:
+        for srczip, error in stager:
+            if error is not None:
+                raise error
+            convert(srczip)
+"""
+import os
+import zipfile
+from concurrent import futures
+
+from data_conversion.utils import (
+    PERMANENT, RetryPolicy, RetryStats, classify_message
+)
+
+
+# number of archives recalled ahead
+RECALL_AHEAD = 4
+
+# bytes read to trigger a recall
+RECALL_READ_SIZE = 64 * 1024
+
+# wait up to about 15 minutes for a file to become readable
+RECALL_POLICY = RetryPolicy(
+    attempts=10, initial_delay=15.0, max_delay=120.0
+)
+
+
+def recall_file(path):
+    """trigger recall of path and wait until it can be read.
+
+    raises an exception if path is not readable (yet).
+    """
+    with open(path, 'rb') as fp:
+        fp.read(RECALL_READ_SIZE)
+    if path.lower().endswith('.zip'):
+        # reads central directory at the end of the file
+        zipfile.ZipFile(path).close()
+
+
+class Stager(object):
+    """Hand out paths in order once they are resident, recalling the next
+    ahead paths in background threads.
+
+    Iterating yields (path, error) tuples, error is None if path is
+    readable, otherwise the exception of the last recall attempt. stats
+    maps path to RetryStats of its recall.
+    """
+
+    def __init__(self, paths, ahead=None, recall=recall_file, policy=None):
+        if ahead is None:
+            ahead = int(os.environ.get('CONVERSION_RECALL_AHEAD', RECALL_AHEAD))
+        self.paths = list(paths)
+        self.ahead = max(ahead, 1)
+        self.recall = recall
+        self.policy = RECALL_POLICY if policy is None else policy
+        self.stats = {}
+        self._pool = None
+        self._pending = {}
+
+    def _stage(self, path):
+        stats = self.stats.setdefault(path, RetryStats())
+
+        def attempt():
+            try:
+                self.recall(path)
+            except FileNotFoundError as e:
+                return None, (PERMANENT, str(e))
+            except Exception as e:
+                return None, (classify_message(str(e)), str(e))
+            return None, None
+
+        self.policy.call(attempt, stats)
+
+    def _submit(self, idx):
+        if idx < len(self.paths) and idx not in self._pending:
+            self._pending[idx] = self._pool.submit(
+                self._stage, self.paths[idx]
+            )
+
+    def __iter__(self):
+        if self._pool is None:
+            self._pool = futures.ThreadPoolExecutor(self.ahead)
+        for idx in range(self.ahead):
+            self._submit(idx)
+        for idx, path in enumerate(self.paths):
+            future = self._pending.pop(idx)
+            # keep ahead recalls running while path is converted
+            self._submit(idx + self.ahead)
+            error = future.exception()
+            if error is None:
+                print("File {0} is online".format(path))
+            else:
+                print("Fail to make file {0} online!! ({1})".format(path, error))
+            yield path, error
+        self.close()
+
+    def close(self):
+        """stop recalling (recalls in progress are finished).
+        """
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,10 +1,17 @@
-import glob
+import errno
+import fnmatch
 import os
 import os.path
+import random
+import resource
 import shutil
 import gdal
+import threading
 import time
 import subprocess
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 # convert pixel to projection unit
@@ -28,60 +35,518 @@ def ensure_directory(path):
     return path
 
 
+# block size used to compare file contents
+COMPARE_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def same_content(path, other, block_size=COMPARE_BLOCK_SIZE):
+    """whether files path and other have the same content.
+
+    Compares sizes first and then the files block by block, stopping at
+    the first difference.
+    """
+    try:
+        if os.path.getsize(path) != os.path.getsize(other):
+            return False
+    except OSError:
+        # one of them doesn't exist
+        return False
+    with open(path, 'rb') as fp, open(other, 'rb') as ofp:
+        while True:
+            block = fp.read(block_size)
+            if block != ofp.read(block_size):
+                return False
+            if not block:
+                return True
+
+
+def sync_file(src, dest):
+    """move file src to dest, unless dest has the same content already.
+
+    An unchanged dest keeps its mtime (so it isn't uploaded again) and src
+    is removed. Across filesystems src is copied to dest.partial which is
+    then renamed to dest, so dest is never half written.
+
+    returns True if dest has been replaced
+    """
+    if same_content(src, dest):
+        os.remove(src)
+        return False
+    ensure_directory(os.path.dirname(dest))
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # different filesystem
+        partial = dest + '.partial'
+        shutil.copy2(src, partial)
+        os.replace(partial, dest)
+        os.remove(src)
+    return True
+
+
+def remove_stale_files(root, keep):
+    """remove files below root which are not in keep (list of paths).
+
+    returns list of removed files
+    """
+    keep = set(os.path.abspath(path) for path in keep)
+    removed = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            path = os.path.abspath(os.path.join(dirpath, name))
+            if path not in keep:
+                os.remove(path)
+                removed.append(path)
+    return removed
+
+
 # move contents of srcdir to destdir
-# TODO: some sort of sync would be nice, e.g. remove non existent files in destdir
-def move_files(srcdir, destdir):
+def move_files(srcdir, destdir, delete=False, threads=4):
+    """sync contents of srcdir into destdir.
+
+    Only files which differ from their counterpart in destdir replace it,
+    unchanged files in destdir are left alone. With delete files in destdir
+    which don't exist in srcdir are removed. Files are compared in
+    parallel threads.
+
+    returns list of replaced files in destdir
+    """
     srcdir = os.path.abspath(srcdir)
     destdir = os.path.abspath(destdir)
-    for fname in glob.glob(os.path.join(srcdir, '*')):
-        shutil.move(fname, os.path.join(destdir, os.path.basename(fname)))
+    relpaths = []
+    for dirpath, _, files in os.walk(srcdir):
+        for name in files:
+            relpaths.append(
+                os.path.relpath(os.path.join(dirpath, name), srcdir)
+            )
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        changed = list(pool.map(
+            lambda relpath: sync_file(
+                os.path.join(srcdir, relpath), os.path.join(destdir, relpath)
+            ),
+            relpaths
+        ))
+    if delete:
+        remove_stale_files(
+            destdir, [os.path.join(destdir, relpath) for relpath in relpaths]
+        )
+    return [
+        os.path.join(destdir, relpath)
+        for relpath, replaced in zip(relpaths, changed) if replaced
+    ]
+
+
+def vsi_path(path, member=None):
+    """Build a GDAL path to read path (or member within zip file path)
+    without extracting it.
+
+    gzipped files (and gzipped members of a zip file) are read through
+    /vsigzip/.
+    """
+    if member:
+        path = '/vsizip/{}/{}'.format(path, member)
+    if path.endswith('.gz'):
+        path = '/vsigzip/' + path
+    return path
+
+
+def zip_members(zipname, pattern='*'):
+    """List members of zipfile matching pattern (directories excluded).
+    """
+    with zipfile.ZipFile(zipname) as zipf:
+        return [
+            info.filename for info in zipf.infolist()
+            if not info.is_dir() and fnmatch.fnmatch(info.filename, pattern)
+        ]
+
+
+# error classes for RetryPolicy
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# gdal error numbers (CPLE_*) which won't go away by trying again
+PERMANENT_GDAL_ERRORS = {
+    5,  # CPLE_IllegalArg
+    6,  # CPLE_NotSupported
+    7,  # CPLE_AssertionFailed
+    8,  # CPLE_NoWriteAccess
+    10,  # CPLE_ObjectNull
+}
+
+# messages (gdal or stderr of subprocesses) of permanent errors
+PERMANENT_MESSAGES = (
+    'no such file or directory',
+    'does not exist in the file system',
+    'not recognized as a supported file format',
+    'not recognised as a supported file format',
+    'unknown option',
+    'usage:',
+    'too many command options',
+    'permission denied',
+    'illegal',
+    # full disk, retrying won't help while the partial output occupies it
+    # (jobs are admitted by free space, see ResourceGovernor)
+    'no space left on device',
+    'free disk space available is',
+)
+
+# messages of transient errors, e.g. file not yet recalled from tape
+TRANSIENT_MESSAGES = (
+    'input/output error',
+    'i/o error',
+    'resource temporarily unavailable',
+    'stale file handle',
+    'timed out',
+    'connection',
+)
+
+
+def classify_message(message):
+    """classify error message as TRANSIENT or PERMANENT.
+
+    Unknown errors are treated as transient, so they are retried.
+    """
+    message = (message or '').lower()
+    if any(pattern in message for pattern in TRANSIENT_MESSAGES):
+        return TRANSIENT
+    if any(pattern in message for pattern in PERMANENT_MESSAGES):
+        return PERMANENT
+    return TRANSIENT
+
+
+def vsi_local_path(path):
+    """return local file underlying a gdal path (e.g. /vsizip/a.zip/b.tif).
+
+    returns None for remote and in memory paths
+    """
+    if not path.startswith('/vsi'):
+        return path
+    parts = path.split('/')
+    if parts[1] in ('vsizip', 'vsigzip', 'vsitar'):
+        # chained archives like /vsigzip//vsizip/a.zip/b.gz
+        inner = '/' + '/'.join(parts[2:]).lstrip('/')
+        if inner.startswith('/vsi'):
+            return vsi_local_path(inner)
+        # archive is the longest prefix that is an existing file
+        for idx in range(len(parts), 2, -1):
+            candidate = '/' + '/'.join(parts[2:idx]).lstrip('/')
+            if os.path.isfile(candidate):
+                return candidate
+        return inner
+    return None
+
+
+def classify_gdal_error(path, err_no, message):
+    """classify failure to open path with gdal as TRANSIENT or PERMANENT.
+    """
+    if err_no in PERMANENT_GDAL_ERRORS:
+        return PERMANENT
+    local = vsi_local_path(path)
+    if local is not None and not os.path.exists(local):
+        # bad path
+        return PERMANENT
+    return classify_message(message)
+
+
+class RetryStats(object):
+    """What happened while retrying an operation.
+
+    attempts ... number of calls made
+    waited   ... seconds spent sleeping between attempts
+    elapsed  ... seconds from first call until success or giving up
+    errors   ... list of (error class, message) for failed attempts
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.waited = 0.0
+        self.elapsed = 0.0
+        self.errors = []
+
+    def __repr__(self):
+        return '<RetryStats attempts={} waited={:.1f}s elapsed={:.1f}s>'.format(
+            self.attempts, self.waited, self.elapsed)
+
 
+class RetryPolicy(object):
+    """Retry transient failures with jittered exponential backoff.
 
-def open_gdal_dataset(path):
+    The n-th retry waits initial_delay * factor ** (n - 1) seconds (at most
+    max_delay), randomly shortened by up to jitter (a fraction), so that
+    parallel jobs waiting for the same file don't retry in lock step.
+    Permanent errors fail immediately.
+    """
+
+    def __init__(self, attempts=5, initial_delay=5.0, max_delay=120.0,
+                 factor=2.0, jitter=0.5):
+        self.attempts = attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+
+    def delay(self, retry):
+        """seconds to wait before retry number retry (starting at 1).
+        """
+        delay = min(self.initial_delay * self.factor ** (retry - 1),
+                    self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, func, stats=None):
+        """call func until it succeeds.
+
+        func is called without arguments and returns (result, error), where
+        error is None on success or a tuple (error class, message).
+
+        returns result of func, raises an Exception if func failed with a
+        permanent error or did not succeed within the number of attempts.
+        Fills in stats (a RetryStats) if given.
+        """
+        if stats is None:
+            stats = RetryStats()
+        start = time.time()
+        try:
+            while True:
+                stats.attempts += 1
+                result, error = func()
+                if error is None:
+                    return result
+                stats.errors.append(error)
+                kind, message = error
+                if kind == PERMANENT:
+                    raise Exception('{} (permanent error, not retried)'.format(
+                        message))
+                if stats.attempts >= self.attempts:
+                    raise Exception('{} (failed after {} attempts)'.format(
+                        message, stats.attempts))
+                delay = self.delay(stats.attempts)
+                print('{}. Try again in {:.0f} seconds. ({} attempts left)'.format(
+                    message, delay, self.attempts - stats.attempts))
+                time.sleep(delay)
+                stats.waited += delay
+        finally:
+            stats.elapsed = time.time() - start
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def open_gdal_dataset(path, policy=None, stats=None):
     """Open a GDAL dataset.
 
     Try opening the given path, which may be a gdal url (e.g. /vsizip/...)
-    and in case of errors back off and retry again for up to 5 minutes?
+    and in case of transient errors (e.g. I/O errors while the file is
+    recalled from tape) back off and retry (see RetryPolicy). Permanent
+    errors (bad path, unsupported format) are not retried.
+
+    stats ... RetryStats to fill in with attempts and timings
 
     return an open gdal.Dataset or None
     """
-    attempts = 5
-    while attempts:
-        # TODO: we could check if the path exists at all in case it is
-        #       a normal file path; othewise we'd need to parse the
-        #       gdal open string to finde the file name and proto
+    if policy is None:
+        policy = DEFAULT_RETRY_POLICY
+
+    def attempt():
+        gdal.ErrorReset()
         ds = gdal.Open(path)
-        if ds is None:
-            # not open ... sleep for a minute
-            # TODO: can we check some sort of error code?
-            attempts -= 1
-            print("Open {} failed. Try again in a minute. ({} attempts left)".format(path, attempts))
-            time.sleep(60)
-        else:
-            return ds
-    return None
+        if ds is not None:
+            return ds, None
+        err_no = gdal.GetLastErrorNo()
+        message = gdal.GetLastErrorMsg() or 'Open {} failed'.format(path)
+        return None, (classify_gdal_error(path, err_no, message), message)
+
+    try:
+        return policy.call(attempt, stats)
+    except Exception as e:
+        print('Open {} failed: {}'.format(path, e))
+        return None
 
 
-def retry_run_cmd(cmd):
+def retry_run_cmd(cmd, policy=None, stats=None):
     """Run CMD and retry if failed.
 
-    Runs the given command in a subprocess and retries it if it fails.
+    Runs the given command in a subprocess and retries it if it fails with
+    a transient error. Errors are classified by the stderr output of the
+    command, permanent errors (bad path, unknown option) are not retried.
+
+    stats ... RetryStats to fill in with attempts and timings
 
     raises an exception in case execution still fails.
     """
-    attempts = 5
-    while attempts:
+    if policy is None:
+        policy = DEFAULT_RETRY_POLICY
+
+    def attempt():
         try:
             ret = subprocess.run(
-                cmd,
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
             )
-            ret.check_returncode()
-            return
-        except subprocess.CalledProcessError as e:
-            attempts -= 1
-            print("run cmd failed: {}. Try again in a minute. ({} attempts left)".format(e, attempts))
-            time.sleep(60)
-    # if we end up here, then the cmd did not succeed
-    raise Exception('Subprocess {} failed.'.format(cmd))
+        except OSError as e:
+            # command not found or not executable
+            return None, (PERMANENT, str(e))
+        if ret.returncode == 0:
+            return None, None
+        stderr = ret.stderr.decode('utf-8', 'replace').strip()
+        message = 'run cmd failed ({}): {}'.format(ret.returncode, stderr)
+        return None, (classify_message(stderr), message)
+
+    try:
+        policy.call(attempt, stats)
+    except Exception as e:
+        raise Exception('Subprocess {} failed: {}'.format(cmd, e))
 
+
+def file_signature(path):
+    """(mtime, size) of the local file underlying gdal path, used to detect
+    files that changed since they were opened.
+
+    returns None for paths without local file (e.g. /vsimem/)
+    """
+    local = vsi_local_path(path)
+    if local is None:
+        return None
+    try:
+        st = os.stat(local)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def default_max_fds():
+    """number of file descriptors cached datasets may use in one worker.
+    """
+    limit = os.environ.get('CONVERSION_DATASET_CACHE_FDS')
+    if limit:
+        return int(limit)
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 4096
+    # leave most descriptors for everything else
+    return max(soft // 4, 8)
+
+
+class DatasetCache(object):
+    """LRU cache of open gdal.Dataset handles.
+
+    Datasets are keyed by path and access mode. The cache is bounded by the
+    number of datasets and by the number of file descriptors they keep open
+    (roughly one per distinct local file of a dataset, a zip archive counts
+    once). The least recently used dataset is closed when a bound is
+    exceeded. While a /vsizip/ member is open, gdal keeps the parsed central
+    directory of its archive, so opening further members of the same
+    archive doesn't read the index again.
+
+    A cached dataset is reopened if its file has been modified since it was
+    opened. In memory files (/vsimem/) are opened but not cached, because
+    there is no local file to detect that they were rewritten. gdal
+    datasets must not be shared between threads or processes, use
+    dataset_cache() to get the cache of the current thread.
+    """
+
+    def __init__(self, max_datasets=64, max_fds=None):
+        self.max_datasets = max_datasets
+        self.max_fds = default_max_fds() if max_fds is None else max_fds
+        self.fds = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (dataset, signature, fds)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def open(self, path, mode=gdal.GA_ReadOnly, policy=None, stats=None):
+        """return open dataset for path, or None if it can't be opened.
+
+        Read only datasets are opened with open_gdal_dataset (see
+        RetryPolicy for policy and stats).
+        """
+        if path.startswith('/vsimem/'):
+            self.misses += 1
+            if mode == gdal.GA_ReadOnly:
+                return open_gdal_dataset(path, policy=policy, stats=stats)
+            return gdal.Open(path, mode)
+        key = (path, mode)
+        signature = file_signature(path)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            # file changed underneath
+            self._close(key)
+        # make sure pending writes of other handles are visible
+        for other in list(self._entries):
+            if other[0] == path:
+                self._entries[other][0].FlushCache()
+        self.misses += 1
+        if mode == gdal.GA_ReadOnly:
+            ds = open_gdal_dataset(path, policy=policy, stats=stats)
+        else:
+            ds = gdal.Open(path, mode)
+        if ds is None:
+            return None
+        fds = len(set(
+            vsi_local_path(name) or name
+            for name in (ds.GetFileList() or [path])
+        )) or 1
+        self._entries[key] = (ds, signature, fds)
+        self.fds += fds
+        self._shrink()
+        return ds
+
+    def evict(self, path):
+        """close all cached datasets of path (e.g. before overwriting it).
+        """
+        for key in [key for key in self._entries if key[0] == path]:
+            self._close(key)
+
+    def clear(self):
+        """close all cached datasets.
+        """
+        for key in list(self._entries):
+            self._close(key)
+
+    def _close(self, key):
+        ds, _, fds = self._entries.pop(key)
+        self.fds -= fds
+        ds.FlushCache()
+        del ds
+
+    def _shrink(self):
+        # always keep the most recent dataset
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_datasets or
+                self.fds > self.max_fds):
+            self._close(next(iter(self._entries)))
+
+
+_dataset_caches = threading.local()
+
+
+def dataset_cache():
+    """DatasetCache of the current thread in this process.
+
+    Forked pool workers get a fresh cache instead of sharing the handles
+    inherited from the parent.
+    """
+    cache = getattr(_dataset_caches, 'cache', None)
+    if cache is None or _dataset_caches.pid != os.getpid():
+        cache = DatasetCache(
+            max_datasets=int(os.environ.get('CONVERSION_DATASET_CACHE', 64))
+        )
+        _dataset_caches.cache = cache
+        _dataset_caches.pid = os.getpid()
+    return cache
+
+
+def cached_dataset(path, mode=gdal.GA_ReadOnly):
+    """open path through the DatasetCache of the current thread.
+
+    Repeated opens of the same path return the same handle. Callers must
+    not close the dataset or keep it beyond the current job.
+    """
+    return dataset_cache().open(path, mode)
@@ -1,3 +1,6 @@
+import json
+import os
+
 from osgeo import gdal
 
 
@@ -15,3 +18,60 @@ PREDICTORS = {
     gdal.GDT_CFloat32: 3,
     gdal.GDT_CFloat64: 3
 }
+
+
+# creation options that are not about the compression codec
+LAYOUT_OPTIONS = ('BLOCKXSIZE', 'BLOCKYSIZE')
+
+_compression_profile = None
+
+
+def load_compression_profile():
+    """load compression profile named in COMPRESSION_PROFILE env var.
+
+    The profile maps collection names (or 'default') to data type names
+    and lists of creation options, as generated by data_conversion.benchmark.
+
+    returns empty dict if no profile is configured
+    """
+    global _compression_profile
+    if _compression_profile is None:
+        path = os.environ.get('COMPRESSION_PROFILE')
+        if path:
+            with open(path, 'r') as pfile:
+                _compression_profile = json.load(pfile)
+        else:
+            _compression_profile = {}
+    return _compression_profile
+
+
+def compression_options(datatype, max_error=None, scale=None,
+                        collection=None):
+    """creation options to compress a layer of given data type.
+
+    max_error ... maximum absolute error in layer units (see 'max_error' in
+                  variable vocabularies). Floating point layers are
+                  compressed with LERC within this error bound, all other
+                  layers are compressed losslessly.
+    scale     ... band scale, used to convert max_error to raw pixel values
+    collection ... name of collection to look up in compression profile
+    """
+    profile = load_compression_profile()
+    dtype = gdal.GetDataTypeName(datatype)
+    options = profile.get(collection, {}).get(
+        dtype, profile.get('default', {}).get(dtype)
+    )
+    if options is None:
+        options = [
+            'COMPRESS=DEFLATE',
+            'PREDICTOR={}'.format(PREDICTORS[datatype]),
+        ]
+    if max_error and datatype in (gdal.GDT_Float32, gdal.GDT_Float64):
+        # keep block layout from profile, but replace codec
+        options = [
+            opt for opt in options if opt.split('=')[0] in LAYOUT_OPTIONS
+        ] + [
+            'COMPRESS=LERC_DEFLATE',
+            'MAX_Z_ERROR={!r}'.format(max_error / (scale or 1.0)),
+        ]
+    return list(options)
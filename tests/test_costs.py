@@ -0,0 +1,75 @@
+import json
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+import pytest
+
+# data_conversion modules import GDAL's python bindings
+pytest.importorskip('osgeo')
+pytest.importorskip('gdal')
+
+from data_conversion import costs  # noqa: E402
+from data_conversion.governor import JOB_OVERHEAD  # noqa: E402
+
+
+FEATURES = {
+    'small.tif': {'dtype': 'Float32', 'pixels': 100, 'resolution': '0.01'},
+    'large.tif': {'dtype': 'Float32', 'pixels': 10000, 'resolution': '0.01'},
+}
+
+
+def run(*args):
+    pass
+
+
+class PlanJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = os.path.join(self.tmpdir.name, 'costs.jsonl')
+        patcher = mock.patch.object(costs, 'layer_features', FEATURES.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_history(self, *entries):
+        with open(self.history, 'w') as hfile:
+            for entry in entries:
+                hfile.write(json.dumps(entry) + '\n')
+
+    def plan(self, memory=1000):
+        return costs.plan_jobs('worldclim', [
+            (memory, src, run, (src, 'dest'), {})
+            for src in ('small.tif', 'large.tif')
+        ], model=costs.CostModel(self.history))
+
+    def test_larger_layers_cost_more_without_history(self):
+        small, large = self.plan()
+        self.assertGreater(large[1], small[1])
+        # static memory estimate is kept
+        self.assertEqual([small[0], large[0]], [1000, 1000])
+
+    def test_jobs_are_measured(self):
+        small, _ = self.plan()
+        self.assertIs(small[2], costs.measured)
+        self.assertEqual(
+            small[3], ('worldclim', FEATURES['small.tif'], run, 'small.tif',
+                       'dest'))
+
+    def test_predicted_memory_only_raises_estimate(self):
+        self.write_history(dict(
+            FEATURES['large.tif'], collection='worldclim', seconds=10.0,
+            memory=JOB_OVERHEAD + 10000 * 100,
+        ))
+        small, large = self.plan(memory=JOB_OVERHEAD + 500000)
+        self.assertEqual(small[0], JOB_OVERHEAD + 500000)
+        self.assertEqual(large[0], JOB_OVERHEAD + 10000 * 100)
+        # seconds per pixel of the recorded job
+        self.assertAlmostEqual(large[1], 10.0)
+        self.assertAlmostEqual(small[1], 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import tempfile
+import threading
+import unittest
+from concurrent import futures
+
+import pytest
+
+# data_conversion modules import GDAL's python bindings
+pytest.importorskip('osgeo')
+pytest.importorskip('gdal')
+
+from data_conversion.governor import ResourceGovernor, free_space  # noqa: E402
+
+
+class TimedPool(object):
+    """stand-in for a process pool, jobs finish after a short while.
+    """
+
+    def __init__(self, seconds=0.1):
+        self.seconds = seconds
+        self.submitted = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted.append(args[0])
+        future = futures.Future()
+        timer = threading.Timer(self.seconds, future.set_result, (None,))
+        timer.start()
+        return future
+
+
+def job(name, memory, cost, disk=None):
+    return (memory, cost, None, (name,), disk or {})
+
+
+class GovernorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.governor = ResourceGovernor(memory=100, cpus=2, disk_headroom=0)
+        # no block cache, so memory adds up to what the jobs state
+        self.governor.cachemax = 0
+
+    def test_fits_memory_budget(self):
+        self.assertTrue(self.governor._fits(60, {}, {}))
+        self.governor._used = 60
+        self.assertTrue(self.governor._fits(40, {}, {}))
+        self.assertFalse(self.governor._fits(41, {}, {}))
+
+    def test_oversized_job_fits_when_idle(self):
+        self.assertTrue(self.governor._fits(500, {}, {}))
+        self.governor._used = 10
+        self.assertFalse(self.governor._fits(500, {}, {}))
+
+    def test_disk_is_checked_when_idle(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            too_large = {tmpdir: free_space(tmpdir) * 2}
+            self.assertFalse(self.governor._fits(10, too_large, {}))
+            self.assertTrue(self.governor._fits(10, {tmpdir: 1}, {}))
+
+    def test_submits_longest_first(self):
+        pool = TimedPool(seconds=0)
+        jobs = [job('short', 10, 1), job('long', 10, 3), job('medium', 10, 2)]
+        results = self.governor.submit_all(pool, jobs)
+        self.assertEqual(pool.submitted, ['long', 'medium', 'short'])
+        self.assertEqual(len(results), 3)
+        futures.wait(results)
+
+    def test_packs_small_jobs_next_to_large_ones(self):
+        pool = TimedPool()
+        jobs = [job('large', 80, 3), job('large2', 80, 2), job('small', 10, 1)]
+        futures.wait(self.governor.submit_all(pool, jobs))
+        # large2 waits for large, small starts meanwhile
+        self.assertEqual(pool.submitted, ['large', 'small', 'large2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
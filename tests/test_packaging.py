@@ -0,0 +1,46 @@
+import os.path
+import tempfile
+import unittest
+import zipfile
+
+import pytest
+
+# data_conversion modules import GDAL's python bindings
+pytest.importorskip('osgeo')
+pytest.importorskip('gdal')
+
+from data_conversion.packaging import replace_member  # noqa: E402
+
+
+class ReplaceMemberTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.zipname = os.path.join(tmpdir.name, 'dataset.zip')
+        with zipfile.ZipFile(self.zipname, 'w') as zipf:
+            zipf.writestr('dataset/data/layer.tif', b'raster')
+            zipf.writestr('dataset/bccvl/metadata.json', b'{"old": 1}')
+
+    def test_replaces_member(self):
+        replace_member(self.zipname, 'dataset/bccvl/metadata.json',
+                       b'{"new": 1}')
+        with zipfile.ZipFile(self.zipname) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(
+                sorted(zipf.namelist()),
+                ['dataset/bccvl/metadata.json', 'dataset/data/layer.tif']
+            )
+            self.assertEqual(zipf.read('dataset/bccvl/metadata.json'),
+                             b'{"new": 1}')
+            self.assertEqual(zipf.read('dataset/data/layer.tif'), b'raster')
+
+    def test_adds_missing_member(self):
+        replace_member(self.zipname, 'dataset/README', b'readme')
+        with zipfile.ZipFile(self.zipname) as zipf:
+            self.assertEqual(len(zipf.namelist()), 3)
+            self.assertEqual(zipf.read('dataset/README'), b'readme')
+
+
+if __name__ == '__main__':
+    unittest.main()
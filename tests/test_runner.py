@@ -0,0 +1,59 @@
+import sys
+import tempfile
+import unittest
+
+import pytest
+
+# data_conversion modules import GDAL's python bindings
+pytest.importorskip('osgeo')
+pytest.importorskip('gdal')
+
+from data_conversion.runner import (  # noqa: E402
+    DONE, FAILED, SKIPPED, Runner, Task
+)
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = tempfile.gettempdir()
+        self.runner = Runner(slots=2, memory=1024)
+
+    def task(self, stage, returncode=0, **kwargs):
+        cmd = [sys.executable, '-c',
+               'import sys; sys.exit({})'.format(returncode)]
+        return Task('test', stage, cmd, self.cwd, **kwargs)
+
+    def test_runs_dependencies_first(self):
+        convert = self.task('convert')
+        metadata = self.task('metadata', deps=[convert])
+        self.assertEqual(self.runner.run([convert, metadata]), [])
+        self.assertEqual([convert.state, metadata.state], [DONE, DONE])
+
+    def test_skips_dependents_of_failed_tasks(self):
+        convert = self.task('convert', returncode=1)
+        metadata = self.task('metadata', deps=[convert])
+        upload = self.task('upload', deps=[metadata])
+        failed = self.runner.run([convert, metadata, upload])
+        self.assertEqual(failed, [convert, metadata, upload])
+        self.assertEqual([convert.state, metadata.state, upload.state],
+                         [FAILED, SKIPPED, SKIPPED])
+        self.assertIsNone(metadata.returncode)
+
+    def test_tolerant_task_runs_after_failure(self):
+        failing = self.task('convert', returncode=1)
+        converted = self.task('convert')
+        metadata = self.task('metadata', deps=[failing, converted],
+                             tolerant=True)
+        failed = self.runner.run([failing, converted, metadata])
+        self.assertEqual(failed, [failing])
+        self.assertEqual(metadata.state, DONE)
+
+    def test_task_larger_than_budget_runs_alone(self):
+        task = self.task('convert', slots=8)
+        self.assertEqual(self.runner.run([task]), [])
+        self.assertEqual(task.state, DONE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+
+import pytest
+
+# data_conversion modules import GDAL's python bindings
+pytest.importorskip('osgeo')
+pytest.importorskip('gdal')
+
+from data_conversion.staging import Stager  # noqa: E402
+from data_conversion.utils import RetryPolicy  # noqa: E402
+
+
+# retries would take minutes, tests fail fast instead
+SLOW_POLICY = RetryPolicy(attempts=10, initial_delay=60.0, max_delay=60.0)
+
+
+class StagerTest(unittest.TestCase):
+
+    def test_recalls_ahead_while_consuming(self):
+        recalled = {}
+
+        def recall(path):
+            recalled.setdefault(path, threading.Event()).set()
+
+        paths = ['a.zip', 'b.zip', 'c.zip']
+        with Stager(paths, ahead=2, recall=recall) as stager:
+            for path, error in stager:
+                self.assertIsNone(error)
+                if path == 'a.zip':
+                    # b.zip is recalled while a.zip is still being converted
+                    event = recalled.setdefault('b.zip', threading.Event())
+                    self.assertTrue(event.wait(5))
+
+    def test_overlaps_recall_with_consumption(self):
+        def recall(path):
+            time.sleep(0.2)
+
+        paths = ['{}.zip'.format(idx) for idx in range(4)]
+        start = time.time()
+        with Stager(paths, ahead=4, recall=recall) as stager:
+            for path, error in stager:
+                self.assertIsNone(error)
+                time.sleep(0.2)
+        # serial recall and conversion would take 1.6 seconds
+        self.assertLess(time.time() - start, 1.4)
+
+    def test_keeps_order(self):
+        paths = ['{}.zip'.format(idx) for idx in range(5)]
+
+        def recall(path):
+            # earlier paths take longer to recall
+            time.sleep(0.05 * (len(paths) - paths.index(path)))
+
+        with Stager(paths, ahead=5, recall=recall) as stager:
+            result = [path for path, error in stager]
+        self.assertEqual(result, paths)
+
+    def test_permanent_error_is_returned_immediately(self):
+        def recall(path):
+            if path == 'missing.zip':
+                raise FileNotFoundError('No such file: {}'.format(path))
+
+        paths = ['missing.zip', 'b.zip']
+        start = time.time()
+        with Stager(paths, ahead=2, recall=recall,
+                    policy=SLOW_POLICY) as stager:
+            result = list(stager)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([path for path, _ in result], paths)
+        self.assertIsNotNone(result[0][1])
+        self.assertIsNone(result[1][1])
+        self.assertEqual(stager.stats['missing.zip'].attempts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
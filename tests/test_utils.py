@@ -0,0 +1,82 @@
+import unittest
+
+import pytest
+
+# data_conversion modules import GDAL's python bindings
+pytest.importorskip('osgeo')
+pytest.importorskip('gdal')
+
+from data_conversion.utils import (  # noqa: E402
+    PERMANENT, TRANSIENT, RetryPolicy, RetryStats, classify_message
+)
+
+
+# no waiting between attempts
+FAST_POLICY = RetryPolicy(attempts=3, initial_delay=0.0, max_delay=0.0)
+
+
+def failing(*errors):
+    """func for RetryPolicy.call failing with errors before it succeeds.
+    """
+    errors = list(errors)
+
+    def func():
+        if errors:
+            return None, errors.pop(0)
+        return 'done', None
+    return func
+
+
+class ClassifyMessageTest(unittest.TestCase):
+
+    def test_permanent(self):
+        for message in ('No such file or directory',
+                        "`x.tif' not recognized as a supported file format.",
+                        'Usage: gdal_translate ...',
+                        'No space left on device'):
+            self.assertEqual(classify_message(message), PERMANENT, message)
+
+    def test_transient(self):
+        for message in ('Input/output error',
+                        'Resource temporarily unavailable',
+                        'Connection reset by peer'):
+            self.assertEqual(classify_message(message), TRANSIENT, message)
+
+    def test_unknown_is_retried(self):
+        self.assertEqual(classify_message('something odd'), TRANSIENT)
+        self.assertEqual(classify_message(None), TRANSIENT)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_retries_transient_errors(self):
+        stats = RetryStats()
+        result = FAST_POLICY.call(
+            failing((TRANSIENT, 'i/o error'), (TRANSIENT, 'i/o error')), stats
+        )
+        self.assertEqual(result, 'done')
+        self.assertEqual(stats.attempts, 3)
+        self.assertEqual(len(stats.errors), 2)
+
+    def test_permanent_error_fails_immediately(self):
+        stats = RetryStats()
+        with self.assertRaises(Exception):
+            FAST_POLICY.call(failing((PERMANENT, 'no such file')), stats)
+        self.assertEqual(stats.attempts, 1)
+
+    def test_gives_up_after_attempts(self):
+        stats = RetryStats()
+        with self.assertRaises(Exception):
+            FAST_POLICY.call(failing(*[(TRANSIENT, 'i/o error')] * 5), stats)
+        self.assertEqual(stats.attempts, 3)
+
+    def test_delay_grows_up_to_max_delay(self):
+        policy = RetryPolicy(initial_delay=1.0, max_delay=4.0, factor=2.0,
+                             jitter=0.0)
+        self.assertEqual(
+            [policy.delay(retry) for retry in range(1, 5)], [1.0, 2.0, 4.0, 4.0]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()